@@ -0,0 +1,49 @@
+import sys
+import os
+import time
+
+# Add the project root to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+import pywt
+import cv2
+from backend.core.dwt_engine import haar_round_trip, embed_bits_in_dwt
+
+SIZES = [(480, 640), (1080, 1920), (3000, 4000), (3001, 4001)]
+REPEATS = 3
+
+def transform_round_trip(Y):
+    """The DWT-IDWT simulation embed_bits_in_dwt used to run"""
+    LL, (LH, HL, HH) = pywt.dwt2(Y, 'haar')
+    recovered_Y = pywt.idwt2((LL, (LH, HL, HH)), 'haar')
+    return np.clip(np.round(recovered_Y), 0, 255).astype(np.uint8)
+
+def best_time(func, *args):
+    best = float('inf')
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    rng = np.random.default_rng(0)
+    bits = list(rng.integers(0, 2, 4096))
+
+    print(f"{'Size':>12}  {'Identical':>9}  {'DWT-IDWT ms':>11}  {'Closed form ms':>14}  {'Saved ms/MP':>11}  {'Embed ms/MP':>11}")
+    for height, width in SIZES:
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        Y = cv2.cvtColor(image, cv2.COLOR_RGB2YCrCb)[..., 0].copy()
+        megapixels = height * width / 1e6
+
+        identical = np.array_equal(transform_round_trip(Y), haar_round_trip(Y))
+        old_time = best_time(transform_round_trip, Y)
+        new_time = best_time(haar_round_trip, Y)
+        embed_time = best_time(embed_bits_in_dwt, image, bits)
+
+        print(f"{f'{width}x{height}':>12}  {str(identical):>9}  {old_time * 1e3:>11.1f}  {new_time * 1e3:>14.1f}  "
+              f"{(old_time - new_time) * 1e3 / megapixels:>11.1f}  {embed_time * 1e3 / megapixels:>11.1f}")
+
+if __name__ == "__main__":
+    main()
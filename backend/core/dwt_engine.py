@@ -1,10 +1,15 @@
 import numpy as np
-import pywt
 import cv2
 from backend.utils.logger import setup_logger
+from backend.utils.color_pipeline import COLOR_PIPELINES, rgb_to_luma, apply_luma_delta
 
 logger = setup_logger(__name__)
 
+# 'pywt' reproduces the floating-point pywt Haar round trip (odd sizes grow
+# by one row/column); 'lifting' is the exact integer Haar lifting transform,
+# which leaves Y unchanged at any size
+TRANSFORMS = ('pywt', 'lifting')
+
 # -----------------------------------
 # 🔧 Parity-Based Embedding in Y
 # -----------------------------------
@@ -13,16 +18,14 @@ def embed_bits_into_y_parity(Y_channel: np.ndarray, bitstream: list[int]) -> np.
     if len(bitstream) > len(flat):
         raise ValueError("Bitstream too long for Y channel")
 
-    for i, bit in enumerate(bitstream):
-        val = flat[i]
-        if bit == 0:
-            flat[i] = val - (val % 2)  # force even
-        else:
-            flat[i] = val - (val % 2) + 1  # force odd
+    # Clear the LSB, then set it for 1 bits (0 forces even, anything else odd)
+    bits = (np.asarray(bitstream) != 0).astype(flat.dtype)
+    payload = flat[:len(bits)]
+    payload &= ~flat.dtype.type(1)
+    payload |= bits
 
     # ✅ Parity verification
-    recovered = [int(val % 2) for val in flat[:len(bitstream)]]
-    mismatches = sum(a != b for a, b in zip(recovered, bitstream))
+    mismatches = int(np.count_nonzero((payload & 1) != bits))
     logger.debug(f"Y-parity embed check: {len(bitstream)} bits embedded, {mismatches} mismatches")
 
     return flat.reshape(Y_channel.shape)
@@ -31,25 +34,63 @@ def embed_bits_into_y_parity(Y_channel: np.ndarray, bitstream: list[int]) -> np.
 # 🔧 Parity-Based Extraction from Y
 # -----------------------------------
 def extract_bits_from_y_parity(Y_channel: np.ndarray, bit_count: int) -> list[int]:
-    flat = Y_channel.flatten()
-    return [int(val % 2) for val in flat[:bit_count]]
+    return (Y_channel.reshape(-1)[:bit_count] & 1).tolist()
+
+# -----------------------------------
+# 🔁 Haar DWT-IDWT round trip, without transforming
+# -----------------------------------
+def haar_round_trip(Y_channel: np.ndarray) -> np.ndarray:
+    """
+    Return exactly what pywt.idwt2(pywt.dwt2(Y, 'haar')) gives after rounding
+    and clipping, for a uint8 plane with unmodified coefficients.
+
+    Haar is perfect-reconstruction with float error far below 0.5, so the
+    rounded result equals Y. For an odd dimension the 'symmetric' boundary
+    mode repeats the last row/column and idwt2 returns that extra sample,
+    which is an edge pad by one.
+    """
+    height, width = Y_channel.shape
+    if height % 2 == 0 and width % 2 == 0:
+        return Y_channel.copy()
+    return np.pad(Y_channel, ((0, height % 2), (0, width % 2)), mode='edge')
+
+# -----------------------------------
+# 🔁 Integer Haar lifting round trip, without transforming
+# -----------------------------------
+def lifting_round_trip(Y_channel: np.ndarray) -> np.ndarray:
+    """
+    Return what an integer Haar lifting DWT-IDWT gives for a plane with
+    unmodified coefficients: lifting is exactly reversible, so that is a copy
+    of Y at any size (unlike the pywt round trip, odd sizes are not padded).
+    """
+    return Y_channel.copy()
 
 # -----------------------------------
 # 📥 Embed bits in Y after DWT-IDWT
 # -----------------------------------
-def embed_bits_in_dwt(image_rgb: np.ndarray, bitstream: list[int]) -> np.ndarray:
+def embed_bits_in_dwt(image_rgb: np.ndarray, bitstream: list[int], color_pipeline: str = 'ycrcb',
+                      transform: str = 'pywt') -> np.ndarray:
+    if color_pipeline not in COLOR_PIPELINES:
+        raise ValueError(f"Unknown color pipeline '{color_pipeline}', expected one of {COLOR_PIPELINES}")
+    if transform not in TRANSFORMS:
+        raise ValueError(f"Unknown transform '{transform}', expected one of {TRANSFORMS}")
     ycrcb = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2YCrCb)
     Y, Cr, Cb = cv2.split(ycrcb)
 
-    # DWT-IDWT simulation (to simulate compression effects if needed later)
-    LL, (LH, HL, HH) = pywt.dwt2(Y, 'haar')
-    coeffs = (LL, (LH, HL, HH))
-    recovered_Y = pywt.idwt2(coeffs, 'haar')
-    recovered_Y = np.clip(np.round(recovered_Y), 0, 255).astype(np.uint8)
+    # DWT-IDWT simulation: the coefficients are never modified, so either
+    # round trip is resolved in closed form (see haar_round_trip, lifting_round_trip)
+    if transform == 'lifting':
+        recovered_Y = lifting_round_trip(Y)
+    else:
+        recovered_Y = haar_round_trip(Y)
 
     logger.debug(f"Embedding {len(bitstream)} bits in Y channel parity")
     modified_Y = embed_bits_into_y_parity(recovered_Y, bitstream)
 
+    # Luma-delta: push the Y change straight into RGB (only when the shape is unchanged)
+    if color_pipeline == 'luma_delta' and modified_Y.shape == Y.shape:
+        return apply_luma_delta(image_rgb, Y, modified_Y)
+
     # --- PATCH: Ensure all channels have the same shape and dtype ---
     if modified_Y.shape != Cr.shape:
         logger.warning(f"Resizing Cr from {Cr.shape} to {modified_Y.shape}")
@@ -72,12 +113,59 @@ def embed_bits_in_dwt(image_rgb: np.ndarray, bitstream: list[int]) -> np.ndarray
 # -----------------------------------
 # 📤 Extract bits from Y channel parity
 # -----------------------------------
-def extract_bits_from_dwt(image_rgb: np.ndarray) -> list[int]:
-    ycrcb = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2YCrCb)
-    Y, _, _ = cv2.split(ycrcb)
+class ParityBitView:
+    """
+    Lazy, read-only sequence of the Y parity bits of an RGB image, in
+    row-major pixel order (the order embed_bits_in_dwt writes them)
+    - Nothing is computed up front; luma is derived only for the pixels
+      that are indexed, bit-exact with cv2.COLOR_RGB2YCrCb
+    - Supports len(), integer indexing and slicing (slices return lists
+      of ints), which is all the bitstream parsers use
+    """
+
+    def __init__(self, image_rgb: np.ndarray):
+        self._pixels = image_rgb.reshape(-1, image_rgb.shape[2])
+
+    def __len__(self) -> int:
+        return len(self._pixels)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return (rgb_to_luma(self._pixels[key]) & 1).tolist()
+        return int(rgb_to_luma(self._pixels[key]) & 1)
+
+    def __repr__(self) -> str:
+        return f"ParityBitView({len(self)} bits)"
+
+class ParityBitReader:
+    """
+    Reads Y parity bits on demand, in embedding order
+    - Provides read(count) and `remaining`, as bit_utils.detect_and_parse_reader expects
+    - Only the pixels being read are converted to luma, so the headers of an
+      unmarked image are rejected after a few hundred pixels
+    """
+
+    def __init__(self, image_rgb: np.ndarray):
+        self.bits = ParityBitView(image_rgb)
+        self.position = 0
+
+    @property
+    def remaining(self) -> int:
+        """Number of bits left before the reader runs out of pixels"""
+        return len(self.bits) - self.position
+
+    def read(self, count: int) -> list[int]:
+        """Return the next count bits (fewer if the pixels run out)"""
+        count = max(0, min(count, self.remaining))
+        bits = self.bits[self.position:self.position + count]
+        self.position += count
+        return bits
+
+def open_parity_reader(image_rgb: np.ndarray) -> ParityBitReader:
+    return ParityBitReader(image_rgb)
 
-    flat = Y.flatten()
-    bits = [int(val % 2) for val in flat]
+def extract_bits_from_dwt(image_rgb: np.ndarray) -> ParityBitView:
+    bits = ParityBitView(image_rgb)
 
     logger.debug(f"Extracted first 32 bits: {bits[:32]}")
     logger.debug(f"Total bits extracted: {len(bits)}")
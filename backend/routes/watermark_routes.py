@@ -1,9 +1,14 @@
 import os
+import json
 import uuid
+import mimetypes
 import logging
-from flask import Blueprint, request, jsonify
-from backend.utils.image_utils import load_image, save_image, image_to_base64
+import threading
+from flask import Blueprint, Response, request, jsonify, send_from_directory
+from werkzeug.security import safe_join
+from backend.utils.image_utils import load_image, ImageArtifact
 from backend.utils.bit_utils import (
+    BitBuffer,
     string_to_bits,
     bits_to_string,
     int_to_bits,
@@ -13,13 +18,14 @@ from backend.utils.bit_utils import (
     image_to_sha256_bits,
     prepare_bitstream_with_hash_and_messages,
     parse_bitstream_with_hash_and_messages,
-    detect_and_parse_bitstream,
+    detect_and_parse_reader,
 )
 from backend.utils.ipfs_utils import upload_to_pinata
 import zlib
-from backend.core.dwt_engine import embed_bits_in_dwt, extract_bits_from_dwt
+from backend.core.dwt_engine import embed_bits_in_dwt, open_parity_reader
 from backend.utils.logger import setup_logger
-import time
+from backend.utils.job_queue import get_job_queue
+from backend.utils.pipeline import Pipeline
 from backend.utils.blockchain_utils import store_watermark_on_chain, get_watermark_from_chain, get_all_watermark_logs, get_watermark_chain
 from web3 import Web3
 from datetime import datetime
@@ -35,6 +41,44 @@ WATERMARKED_FOLDER = os.path.join(UPLOAD_FOLDER, "watermarked")
 os.makedirs(ORIGINAL_FOLDER, exist_ok=True)
 os.makedirs(WATERMARKED_FOLDER, exist_ok=True)
 
+PUBLISH_STAGES = ['check_chain_record', 'upload_original', 'upload_watermarked', 'blockchain']
+PUBLISH_INPUTS = ['image', 'embed', 'probe_parent', 'original', 'encode_watermarked', 'orig_path', 'wm_path']
+SSE_KEEPALIVE_SECONDS = 15
+CHAIN_LOCK = threading.Lock()  # Serialises transactions (one account, one nonce) and chain file updates
+
+RESPONSE_FORMATS = ('base64', 'url', 'binary', 'preview')
+PREVIEW_EXT = '.jpg'  # Displayable everywhere; WebP is also supported by ImageArtifact.preview
+FILE_MAX_AGE = 24 * 3600  # Stored files never change: every request gets new file names
+
+def requested_format():
+    """Response format of a /watermark request (form field or query argument), None if unknown"""
+    response_format = request.form.get("format", request.args.get("format", "base64"))
+    return response_format if response_format in RESPONSE_FORMATS else None
+
+def image_response(response_format, artifact, filename, metadata, status=200):
+    """
+    Build a /watermark response in the requested format
+    - base64: metadata JSON with the image inline under "image" (the default)
+    - url: metadata JSON only; the image is fetched from "image_url" (/files/<name>)
+    - binary: the image bytes, with the metadata JSON in an X-Watermark-Metadata header
+    - preview: metadata JSON with a downscaled JPEG inline under "preview" (tens of
+      kilobytes, for display only); the full image is fetched from "image_url"
+    """
+    metadata = dict(metadata, image_url=f"/files/{filename}")
+    if response_format == "binary":
+        response = Response(artifact.data, status=status, mimetype=mimetypes.guess_type(filename)[0])
+        response.headers["Content-Disposition"] = f'inline; filename="{filename}"'
+        response.headers["X-Watermark-Metadata"] = json.dumps(metadata)
+        response.headers["Access-Control-Expose-Headers"] = "X-Watermark-Metadata"
+        return response
+    if response_format == "base64":
+        metadata["image"] = artifact.to_base64()
+    elif response_format == "preview":
+        preview = artifact.preview(ext=PREVIEW_EXT)
+        metadata["preview"] = preview.to_base64()
+        metadata["preview_type"] = mimetypes.guess_type(f"preview{PREVIEW_EXT}")[0]
+    return jsonify(metadata), status
+
 def update_chain_file(original_hash, parent_hash):
     """
     Update the chain file with new watermark information.
@@ -94,6 +138,199 @@ def update_chain_file(original_hash, parent_hash):
         logger.error(f"Error updating chain file: {e}")
         return False
 
+def upload_image(artifact, path, label):
+    """Upload the encoded bytes of one image to Pinata under the name of path; returns its CID, or None if the upload failed"""
+    try:
+        cid = upload_to_pinata(path, data=artifact.data)
+        logger.info(f"{label.capitalize()} image uploaded to Pinata. CID: {cid}")
+        return cid
+    except Exception as e:
+        logger.error(f"Failed to upload {label} image to Pinata: {e}", exc_info=True)
+        return None
+
+def log_watermark_on_chain(image, watermarked_image, all_messages, parent_hash, parent_hash_extracted, orig_cid, wm_cid):
+    """
+    Store the watermark record on chain and extend the chain file.
+    Returns the transaction hash, or None if logging failed.
+    """
+    tx_hash = None
+    try:
+        # Compute SHA256 hashes for both images (hex string)
+        orig_hash_bits = image_to_sha256_bits(image)
+        original_hash = orig_hash_bits.to_hex()
+        wm_hash_bits = image_to_sha256_bits(watermarked_image)
+        watermarked_hash = wm_hash_bits.to_hex()
+        logger.info(f"Original image SHA256 hash: {original_hash}")
+        logger.info(f"Watermarked image SHA256 hash: {watermarked_hash}")
+
+        # Prepare message string and CRC
+        combined_message_string = ''.join(all_messages)
+        crc_value = zlib.crc32(combined_message_string.encode()) & 0xFFFF
+        logger.info(f"Combined message string: {combined_message_string}")
+        logger.info(f"CRC value: {crc_value}")
+
+        # Use the extracted parent hash if available, otherwise use zero hash
+        if parent_hash_extracted:
+            logger.info(f"Using extracted parent hash: {parent_hash}")
+        else:
+            logger.info(f"No parent hash extracted, using zero hash: {parent_hash}")
+
+        # Convert hex hashes to bytes32
+        original_hash_bytes = bytes.fromhex(original_hash)
+        watermarked_hash_bytes = bytes.fromhex(watermarked_hash)
+        parent_hash_bytes = bytes.fromhex(parent_hash)
+
+        with CHAIN_LOCK:
+            tx_hash = store_watermark_on_chain(
+                original_hash=original_hash_bytes,
+                watermarked_hash=watermarked_hash_bytes,
+                watermark_data=combined_message_string,
+                original_cid=orig_cid or '',
+                watermarked_cid=wm_cid or '',
+                crc=crc_value,
+                parent_hash=parent_hash_bytes
+            )
+            logger.info(f"Logged watermark to blockchain. Tx hash: {tx_hash}")
+
+            # Update chain file after successful blockchain transaction, still
+            # under the lock so concurrent publishes do not lose each other's update
+            if tx_hash:
+                update_chain_file(original_hash, parent_hash)
+                logger.info("Chain file updated successfully")
+            else:
+                logger.warning("Blockchain transaction failed, chain file not updated")
+            
+    except Exception as e:
+        logger.error(f"Blockchain logging failed: {e}")
+    return tx_hash
+
+def run_stage(job, name, key, func, *args):
+    """
+    Call func(*args) as stage name of job (None when running synchronously).
+    The value is published as job.result[key]; None marks the stage failed.
+    """
+    if job is not None:
+        job.start_stage(name)
+    value = func(*args)
+    if job is not None:
+        job.finish_stage(name, ok=value is not None, **{key: value})
+    return value
+
+def add_publish_stages(pipeline, job=None):
+    """
+    Add the parent record lookup, IPFS upload and blockchain logging stages
+    (PUBLISH_STAGES) to pipeline. They take the PUBLISH_INPUTS, as earlier stages
+    or as pipeline inputs, and report to job if given. Uploads send the in-memory
+    artifacts, so they do not wait for the files to be written.
+    """
+    pipeline.add("check_chain_record", lambda probe_parent: run_stage(
+        job, 'check_chain_record', 'parent_on_chain', check_chain_record, probe_parent),
+        deps=["probe_parent"], pool="io")
+    pipeline.add("upload_original", lambda original, orig_path: run_stage(
+        job, 'upload_original', 'original_cid', upload_image, original, orig_path, 'original'),
+        deps=["original", "orig_path"], pool="io")
+    pipeline.add("upload_watermarked", lambda encode_watermarked, wm_path: run_stage(
+        job, 'upload_watermarked', 'watermarked_cid', upload_image, encode_watermarked, wm_path, 'watermarked'),
+        deps=["encode_watermarked", "wm_path"], pool="io")
+    pipeline.add("blockchain", lambda image, embed, probe_parent, upload_original, upload_watermarked: run_stage(
+        job, 'blockchain', 'tx_hash', log_watermark_on_chain,
+        image, embed[0], embed[1], probe_parent[0], probe_parent[1], upload_original, upload_watermarked),
+        deps=["image", "embed", "probe_parent", "upload_original", "upload_watermarked"], pool="io")
+    return pipeline
+
+def publish_watermark(job, **inputs):
+    """
+    Background half of an async /watermark request: runs the PUBLISH_STAGES on the
+    request pipeline's results and returns {parent_on_chain, original_cid, watermarked_cid, tx_hash}
+    """
+    result = add_publish_stages(Pipeline("publish"), job).run(**inputs)
+    logger.info(f"Publish pipeline stages: {result.summary()}")
+    return {"parent_on_chain": result["check_chain_record"], "original_cid": result["upload_original"],
+            "watermarked_cid": result["upload_watermarked"], "tx_hash": result["blockchain"]}
+
+def probe_parent(image):
+    """
+    Try to extract an existing hash and messages for chaining.
+    Returns (parent_hash, parent_hash_extracted, existing_messages), with the zero hash if there is none.
+    """
+    logger.debug("Attempting to extract existing hash and messages for appending support")
+    parent_hash = '00' * 32  # Default to zero hash
+    parent_hash_extracted = False
+    existing_messages = []
+    try:
+        # Read parity bits only as far as the headers allow
+        reader = open_parity_reader(image)
+        hash_bits, existing_messages, format_type = detect_and_parse_reader(reader, max_bits=reader.remaining)
+        logger.debug(f"Read {reader.position} bits from image for parent hash extraction.")
+        logger.debug(f"Detected format: {format_type}, found {len(existing_messages)} existing messages.")
+        
+        if format_type in ('hash_based', 'v3') and len(hash_bits) == 256:
+            # Compute parent hash from extracted hash_bits
+            parent_hash = BitBuffer(hash_bits).to_hex()
+            parent_hash_extracted = True
+            logger.info(f"Extracted parent hash from image: {parent_hash}")
+        else:
+            logger.info(f"Legacy format detected or no hash available. Using zero hash.")
+    except Exception as e:
+        logger.warning(f"No valid watermark found in image for chaining. Using zero hash. Details: {e}")
+    return parent_hash, parent_hash_extracted, existing_messages
+
+def hash_image(image):
+    uploaded_image_hash = image_to_sha256_bits(image).to_hex()
+    logger.info(f"SHA256 of uploaded image: {uploaded_image_hash}")
+    return uploaded_image_hash
+
+def check_file_chain(hash_original, probe_parent):
+    """File-level validation: an extracted parent hash should be the hash of the uploaded file"""
+    parent_hash, parent_hash_extracted, _ = probe_parent
+    if parent_hash_extracted:
+        if parent_hash == hash_original:
+            logger.info("File-level chain intact: parent hash matches uploaded image hash.")
+        else:
+            logger.warning(f"File-level chain broken: parent hash ({parent_hash}) does not match uploaded image hash ({hash_original}).")
+    else:
+        logger.info("No parent hash extracted; treating as genesis watermark.")
+
+def check_chain_record(probe_parent):
+    """
+    Blockchain-level validation: the parent hash should have a watermark record.
+    Returns whether the record was found, or None if the lookup failed.
+    """
+    parent_hash = probe_parent[0]
+    try:
+        blockchain_metadata = get_watermark_from_chain(parent_hash)
+        if blockchain_metadata:
+            logger.info(f"Blockchain chain intact: found watermark record for parent hash {parent_hash}.")
+        else:
+            logger.warning(f"Blockchain chain broken: no watermark record found for parent hash {parent_hash}.")
+        return bool(blockchain_metadata)
+    except Exception as e:
+        logger.error(f"Blockchain validation failed for parent hash {parent_hash}: {e}")
+        return None
+
+def embed_messages(image, existing_messages, message):
+    """Append message to the existing ones and embed them all; returns (watermarked_image, all_messages)"""
+    all_messages = existing_messages + [message]
+    logger.info(f"Total messages to embed: {len(all_messages)}")
+
+    # Prepare bitstream: [256-bit hash][16-bit length][msg bits] ...
+    logger.debug("Preparing bitstream with SHA256 hash and multi-message framing")
+    combined_stream = prepare_bitstream_with_hash_and_messages(image, all_messages)
+    combined_length = len(combined_stream)
+    logger.info(f"Combined bitstream length: {combined_length} bits")
+
+    # Embed into image
+    logger.debug("Embedding combined bitstream into image via DWT parity")
+    watermarked_image = embed_bits_in_dwt(image, combined_stream)
+    logger.info("Embedding complete without mismatches")
+    return watermarked_image, all_messages
+
+def save_as(artifact, path, label):
+    logger.debug(f"Saving {label} image to {path}")
+    artifact.save(path)
+    logger.info(f"{label.capitalize()} image saved successfully")
+    return path
+
 @watermark_bp.route("/watermark", methods=["POST"])
 def watermark_image():
     logger.info("POST /watermark called")
@@ -109,174 +346,87 @@ def watermark_image():
             return jsonify({"error": "Message is required."}), 400
         logger.debug(f"Received file: filename={image_file.filename}, content_type={image_file.content_type}")
         logger.debug(f"Received message of length {len(message)} characters")
+        response_format = requested_format()
+        if response_format is None:
+            logger.error("Unknown response format requested")
+            return jsonify({"error": f"Unknown format. Expected one of {list(RESPONSE_FORMATS)}."}), 400
+        async_mode = request.form.get("mode", request.args.get("mode", "sync")) == "async"
 
-        # Load image
+        # Load image, keeping the uploaded bytes as the stored original
         logger.debug("Loading original image from uploaded file")
-        image = load_image(image_file)
+        original = ImageArtifact.from_upload(image_file)
+        image = original.array
         logger.info(f"Original image loaded: shape={image.shape}, dtype={image.dtype}")
 
-        # Try to extract existing hash and messages for chaining
-        logger.debug("Attempting to extract existing hash and messages for appending support")
-        parent_hash = '00' * 32  # Default to zero hash
-        parent_hash_extracted = False
-        existing_messages = []
-        try:
-            raw_bits = extract_bits_from_dwt(image)
-            logger.debug(f"Extracted {len(raw_bits)} bits from image for parent hash extraction.")
-            hash_bits, existing_messages, format_type = detect_and_parse_bitstream(raw_bits)
-            logger.debug(f"Detected format: {format_type}, found {len(existing_messages)} existing messages.")
-            
-            if format_type == 'hash_based' and len(hash_bits) == 256:
-                # Compute parent hash from extracted hash_bits
-                parent_hash_bytes = bytearray()
-                for i in range(0, 256, 8):
-                    byte = 0
-                    for b in hash_bits[i:i+8]:
-                        byte = (byte << 1) | b
-                    parent_hash_bytes.append(byte)
-                parent_hash = parent_hash_bytes.hex()
-                parent_hash_extracted = True
-                logger.info(f"Extracted parent hash from image: {parent_hash}")
-            else:
-                logger.info(f"Legacy format detected or no hash available. Using zero hash.")
-        except Exception as e:
-            logger.warning(f"No valid watermark found in image for chaining. Using zero hash. Details: {e}")
-
-        # File-level validation
-        uploaded_image_hash = image_to_sha256_bits(image)
-        logger.info(f"SHA256 of uploaded image: {uploaded_image_hash}")
-        if parent_hash_extracted:
-            if parent_hash == uploaded_image_hash:
-                logger.info("File-level chain intact: parent hash matches uploaded image hash.")
-            else:
-                logger.warning(f"File-level chain broken: parent hash ({parent_hash}) does not match uploaded image hash ({uploaded_image_hash}).")
-        else:
-            logger.info("No parent hash extracted; treating as genesis watermark.")
-
-        # Blockchain-level validation
-        try:
-            blockchain_metadata = get_watermark_from_chain(parent_hash)
-            if blockchain_metadata:
-                logger.info(f"Blockchain chain intact: found watermark record for parent hash {parent_hash}.")
-            else:
-                logger.warning(f"Blockchain chain broken: no watermark record found for parent hash {parent_hash}.")
-        except Exception as e:
-            logger.error(f"Blockchain validation failed for parent hash {parent_hash}: {e}")
-
-        # Append new message
-        all_messages = existing_messages + [message]
-        logger.info(f"Total messages to embed: {len(all_messages)}")
-
-        # Prepare bitstream: [256-bit hash][16-bit length][msg bits] ...
-        logger.debug("Preparing bitstream with SHA256 hash and multi-message framing")
-        combined_stream = prepare_bitstream_with_hash_and_messages(image, all_messages)
-        combined_length = len(combined_stream)
-        logger.info(f"Combined bitstream length: {combined_length} bits")
-
-        # Embed into image
-        logger.debug("Embedding combined bitstream into image via DWT parity")
-        watermarked_image = embed_bits_in_dwt(image, combined_stream)
-        logger.info("Embedding complete without mismatches")
-
-        # Save original and watermarked images
         uid = uuid.uuid4().hex
-        orig_filename = f"{uid}_orig.png"
+        orig_filename = f"{uid}_orig{original.ext}"
         wm_filename   = f"{uid}_wm.png"
         orig_path = os.path.join(ORIGINAL_FOLDER, orig_filename)
         wm_path   = os.path.join(WATERMARKED_FOLDER, wm_filename)
 
-        logger.debug(f"Saving original image to {orig_path}")
-        save_image(image, orig_path)
-        logger.info("Original image saved successfully")
-
-        logger.debug(f"Saving watermarked image to {wm_path}")
-        save_image(watermarked_image, wm_path)
-        logger.info("Watermarked image saved successfully")
-
-        # Upload both images to Pinata
-        logger.info("Starting upload of original and watermarked images to Pinata Cloud (IPFS)...")
-        ipfs_start_time = time.time()
-        try:
-            orig_cid = upload_to_pinata(orig_path)
-            logger.info(f"Original image uploaded to Pinata. CID: {orig_cid}")
-        except Exception as e:
-            logger.error(f"Failed to upload original image to Pinata: {e}", exc_info=True)
-            orig_cid = None
-        try:
-            wm_cid = upload_to_pinata(wm_path)
-            logger.info(f"Watermarked image uploaded to Pinata. CID: {wm_cid}")
-        except Exception as e:
-            logger.error(f"Failed to upload watermarked image to Pinata: {e}", exc_info=True)
-            wm_cid = None
-        ipfs_elapsed = time.time() - ipfs_start_time
-        logger.info(f"IPFS upload step completed in {ipfs_elapsed:.2f} seconds.")
-
-        # --- Blockchain logging integration ---
-        try:
-            # Compute SHA256 hashes for both images (hex string)
-            orig_hash_bits = image_to_sha256_bits(image)
-            original_hash = bytearray(int(''.join(str(b) for b in orig_hash_bits[i:i+8]), 2) for i in range(0, 256, 8)).hex()
-            wm_hash_bits = image_to_sha256_bits(watermarked_image)
-            watermarked_hash = bytearray(int(''.join(str(b) for b in wm_hash_bits[i:i+8]), 2) for i in range(0, 256, 8)).hex()
-            logger.info(f"Original image SHA256 hash: {original_hash}")
-            logger.info(f"Watermarked image SHA256 hash: {watermarked_hash}")
-
-            # Prepare message string and CRC
-            combined_message_string = ''.join(all_messages)
-            crc_value = zlib.crc32(combined_message_string.encode()) & 0xFFFF
-            logger.info(f"Combined message string: {combined_message_string}")
-            logger.info(f"CRC value: {crc_value}")
-
-            # Use the extracted parent hash if available, otherwise use zero hash
-            if parent_hash_extracted:
-                logger.info(f"Using extracted parent hash: {parent_hash}")
-            else:
-                logger.info(f"No parent hash extracted, using zero hash: {parent_hash}")
-
-            # Convert hex hashes to bytes32
-            original_hash_bytes = bytes.fromhex(original_hash)
-            watermarked_hash_bytes = bytes.fromhex(watermarked_hash)
-            parent_hash_bytes = bytes.fromhex(parent_hash)
+        # Every stage starts as soon as its inputs are ready: hashing, the parent
+        # probe and saving (and uploading) the original overlap. The watermarked
+        # image is encoded once for the file, IPFS and the response. The chain
+        # lookup is a network call, so it runs with the publish stages: inline
+        # when synchronous, in the background job otherwise
+        pipeline = Pipeline("watermark")
+        pipeline.add("probe_parent", probe_parent, deps=["image"])
+        pipeline.add("hash_original", hash_image, deps=["image"])
+        pipeline.add("check_file_chain", check_file_chain, deps=["hash_original", "probe_parent"])
+        pipeline.add("save_original", lambda original: save_as(original, orig_path, "original"), deps=["original"], pool="io")
+        pipeline.add("embed", lambda image, probe_parent: embed_messages(image, probe_parent[2], message),
+                     deps=["image", "probe_parent"])
+        pipeline.add("encode_watermarked", lambda embed: ImageArtifact.from_array(embed[0]), deps=["embed"])
+        pipeline.add("save_watermarked", lambda encode_watermarked: save_as(encode_watermarked, wm_path, "watermarked"),
+                     deps=["encode_watermarked"], pool="io")
+        if not async_mode:
+            add_publish_stages(pipeline)
+        result = pipeline.run(image=image, original=original, orig_path=orig_path, wm_path=wm_path)
+        logger.info(f"Watermark pipeline stages: {result.summary()}")
 
-            tx_hash = store_watermark_on_chain(
-                original_hash=original_hash_bytes,
-                watermarked_hash=watermarked_hash_bytes,
-                watermark_data=combined_message_string,
-                original_cid=orig_cid or '',
-                watermarked_cid=wm_cid or '',
-                crc=crc_value,
-                parent_hash=parent_hash_bytes
-            )
-            logger.info(f"Logged watermark to blockchain. Tx hash: {tx_hash}")
-            
-            # Update chain file after successful blockchain transaction
-            if tx_hash:
-                update_chain_file(original_hash, parent_hash)
-                logger.info("Chain file updated successfully")
-            else:
-                logger.warning("Blockchain transaction failed, chain file not updated")
-                
-        except Exception as e:
-            logger.error(f"Blockchain logging failed: {e}")
-        # --- End blockchain logging integration ---
+        if async_mode:
+            # Run the IPFS and chain stages in the background and report them through /jobs/<id>
+            job = get_job_queue().create(PUBLISH_STAGES)
+            get_job_queue().submit(job, publish_watermark, **{name: result[name] for name in PUBLISH_INPUTS})
+            logger.info(f"Publishing deferred to job {job.id}")
+            logger.info("POST /watermark completed successfully (async)")
+            return image_response(response_format, result["encode_watermarked"], wm_filename, {
+                "job_id": job.id,
+                "status_url": f"/jobs/{job.id}",
+                "events_url": f"/jobs/{job.id}/events",
+                "original_filename": orig_filename,
+                "watermarked_filename": wm_filename
+            }, status=202)
 
-        # Encode watermarked image to base64
-        logger.debug(f"Encoding watermarked image at {wm_path} to base64")
-        b64_data = image_to_base64(wm_path)
-        logger.info("Base64 encoding complete")
         logger.info("POST /watermark completed successfully")
-        return jsonify({
+        return image_response(response_format, result["encode_watermarked"], wm_filename, {
             "original_filename": orig_filename,
             "watermarked_filename": wm_filename,
-            "original_cid": orig_cid,
-            "watermarked_cid": wm_cid,
-            "image": b64_data
-        }), 200
+            "original_cid": result["upload_original"],
+            "watermarked_cid": result["upload_watermarked"]
+        })
     except Exception as e:
         logger.exception("Embedding failed due to unexpected error")
         return jsonify({"error": "Failed to embed watermark."}), 500
 
 
+@watermark_bp.route("/files/<filename>", methods=["GET"])
+def serve_file(filename):
+    """
+    Stream a stored original or watermarked image
+    conditional=True makes Flask answer If-None-Match (304) and Range (206) from the file's ETag
+    ?download=1 serves it as an attachment, so browsers save it even from another origin
+    """
+    as_attachment = request.args.get("download") == "1"
+    for folder in (WATERMARKED_FOLDER, ORIGINAL_FOLDER):
+        path = safe_join(folder, filename)
+        if path and os.path.isfile(path):
+            logger.debug(f"Serving {path}")
+            return send_from_directory(folder, filename, conditional=True, etag=True, max_age=FILE_MAX_AGE,
+                                       as_attachment=as_attachment)
+    logger.warning(f"Requested file not found: {filename}")
+    return jsonify({"error": "File not found."}), 404
+
 @watermark_bp.route("/extract", methods=["POST"])
 def extract_watermark():
     logger.info("POST /extract called")
@@ -290,12 +440,10 @@ def extract_watermark():
         image = load_image(image_file)
         logger.info(f"Watermarked image loaded: shape={image.shape}, dtype={image.dtype}")
 
-        # Extract full bitstream
-        logger.debug("Extracting full parity bitstream via DWT engine")
-        raw_bits = extract_bits_from_dwt(image)
-        total_bits = len(raw_bits)
-        logger.info(f"Extracted total bitstream length: {total_bits} bits")
-        logger.debug(f"First 32 bits of bitstream: {raw_bits[:32]}")
+        # Open a parity reader; bits are decoded as the headers require
+        logger.debug("Opening parity bit reader via DWT engine")
+        reader = open_parity_reader(image)
+        logger.info(f"Parity bitstream capacity: {reader.remaining} bits")
 
         # Parse hash and messages with format detection
         hash_bits = None
@@ -303,18 +451,12 @@ def extract_watermark():
         hash_hex = None
         format_type = None
         try:
-            hash_bits, messages, format_type = detect_and_parse_bitstream(raw_bits)
-            logger.info(f"Detected format: {format_type}, extracted {len(messages)} messages")
+            hash_bits, messages, format_type = detect_and_parse_reader(reader, max_bits=reader.remaining)
+            logger.info(f"Read {reader.position} bits; detected format: {format_type}, extracted {len(messages)} messages")
             
             # Convert hash bits to hex string for return (if available)
-            if format_type == 'hash_based' and len(hash_bits) == 256:
-                hash_bytes = bytearray()
-                for i in range(0, 256, 8):
-                    byte = 0
-                    for b in hash_bits[i:i+8]:
-                        byte = (byte << 1) | b
-                    hash_bytes.append(byte)
-                hash_hex = hash_bytes.hex()
+            if format_type in ('hash_based', 'v3') and len(hash_bits) == 256:
+                hash_hex = BitBuffer(hash_bits).to_hex()
                 logger.info(f"Extracted SHA256 hash: {hash_hex}")
             else:
                 logger.info("No hash available (legacy format)")
@@ -354,6 +496,39 @@ def extract_watermark():
         return jsonify({"error": "Failed to extract watermark."}), 500
 
 
+@watermark_bp.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        logger.warning(f"Status requested for unknown job {job_id}")
+        return jsonify({"error": "Job not found."}), 404
+    return jsonify(job.snapshot()), 200
+
+@watermark_bp.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """Server-sent events: a 'progress' event per job change and a final 'done' event"""
+    job = get_job_queue().get(job_id)
+    if job is None:
+        logger.warning(f"Events requested for unknown job {job_id}")
+        return jsonify({"error": "Job not found."}), 404
+
+    def stream():
+        version = -1
+        while True:
+            if not job.wait_for_change(version, timeout=SSE_KEEPALIVE_SECONDS):
+                yield ": keepalive\n\n"
+                continue
+            snapshot = job.snapshot()
+            version = snapshot["version"]
+            finished = snapshot["status"] in ("done", "failed")
+            yield f"event: {'done' if finished else 'progress'}\ndata: {json.dumps(snapshot)}\n\n"
+            if finished:
+                return
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @watermark_bp.route("/blockchain/logs", methods=["GET"])
 def blockchain_logs():
     try:
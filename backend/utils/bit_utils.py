@@ -1,55 +1,130 @@
 import logging
 import hashlib
+import itertools
+import binascii
+import zlib
 import numpy as np
 
 logger = logging.getLogger(__name__)
 
 SIGNATURE = 0xABCD  # Magic number to identify valid watermarked stream
+FRAME_MAGIC_V3 = 0xABD3  # Magic number of the compact v3 frame
+FRAME_VERSION = 3
+FRAME_FLAG_ZLIB = 0x80  # v3 messages are one zlib-compressed block
+ENGINE_TAGS = {'unknown': 0, 'dwt': 1, 'dct': 2, 'robust_dwt': 3}
+V3_HASH_BYTES = 16  # Default truncated SHA256 length in v3 frames
+MAX_MESSAGE_BYTES = 1024  # Longest message the parsers accept
+MAX_RECORDS_BYTES = 64 * 1024  # Cap on inflated v3 message records
 
-def string_to_bits(s: str) -> list[int]:
+class BitBuffer:
+    """
+    Compact bitstream backed by a np.uint8 array holding one 0/1 value per bit
+    - Slicing returns a BitBuffer view of the same array (no copy)
+    - Behaves like the list[int] bitstreams it replaces: len(), iteration,
+      integer indexing, + with lists or BitBuffers, and == against lists
+    - np.asarray(buffer) is the backing array, so engines take it as is
+    - to_bytes()/to_hex() pack with np.packbits (MSB first, zero-padded)
+    """
+    __slots__ = ('bits',)
+
+    def __init__(self, bits=()):
+        if isinstance(bits, BitBuffer):
+            bits = bits.bits
+        self.bits = np.asarray(bits, dtype=np.uint8).reshape(-1)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'BitBuffer':
+        return cls(np.unpackbits(np.frombuffer(data, dtype=np.uint8)))
+
+    @classmethod
+    def from_hex(cls, text: str) -> 'BitBuffer':
+        return cls.from_bytes(bytes.fromhex(text))
+
+    def to_bytes(self) -> bytes:
+        return np.packbits(self.bits).tobytes()
+
+    def to_hex(self) -> str:
+        return self.to_bytes().hex()
+
+    def to_int(self) -> int:
+        padding = np.zeros(-len(self.bits) % 8, dtype=np.uint8)
+        return int.from_bytes(np.packbits(np.concatenate([padding, self.bits])).tobytes(), 'big')
+
+    def tolist(self) -> list[int]:
+        return self.bits.tolist()
+
+    def __array__(self, dtype=None, copy=None):
+        # NumPy 2 relies on copy being honoured: np.array(buffer) passes copy=True
+        bits = self.bits if dtype is None else self.bits.astype(dtype, copy=False)
+        return bits.copy() if copy else bits
+
+    def __len__(self) -> int:
+        return len(self.bits)
+
+    def __iter__(self):
+        return iter(self.bits.tolist())
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return BitBuffer(self.bits[key])
+        return int(self.bits[key])
+
+    def __add__(self, other) -> 'BitBuffer':
+        return BitBuffer(np.concatenate([self.bits, BitBuffer(other).bits]))
+
+    def __radd__(self, other) -> 'BitBuffer':
+        return BitBuffer(np.concatenate([BitBuffer(other).bits, self.bits]))
+
+    def __eq__(self, other):
+        if not isinstance(other, (BitBuffer, list, tuple, np.ndarray)):
+            return NotImplemented
+        return np.array_equal(self.bits, np.asarray(other))
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"BitBuffer({self.bits.tolist()})"
+
+def string_to_bits(s: str) -> BitBuffer:
     if not isinstance(s, str):
         logger.error("Input to string_to_bits is not a string.")
         raise TypeError("Expected string input")
     logger.debug(f"Converting string to bits: '{s}'")
-    byte_data = s.encode('utf-8')
-    bits = [int(bit) for byte in byte_data for bit in format(byte, '08b')]
+    bits = BitBuffer.from_bytes(s.encode('utf-8'))
     logger.debug(f"String converted to {len(bits)} bits.")
     return bits
 
-def bits_to_string(bits: list[int]) -> str:
+def bits_to_string(bits: list[int] | BitBuffer) -> str:
     if len(bits) % 8 != 0:
         logger.error("Bit length is not a multiple of 8.")
         raise ValueError("Bit length must be a multiple of 8 to convert to string.")
     logger.debug(f"Reconstructing string from bits. Bit length = {len(bits)}")
-    bytes_list = [
-        int("".join(str(bit) for bit in bits[i:i+8]), 2)
-        for i in range(0, len(bits), 8)
-    ]
     try:
-        result = bytes(bytes_list).decode('utf-8')
+        result = BitBuffer(bits).to_bytes().decode('utf-8')
     except UnicodeDecodeError as e:
         logger.error(f"Failed to decode bytes to string: {e}")
         raise ValueError("Invalid byte sequence; cannot decode.")
     logger.debug(f"Bits successfully converted to string: '{result}'")
     return result
 
-def int_to_bits(n: int, length=16) -> list[int]:
+def int_to_bits(n: int, length=16) -> BitBuffer:
     if n < 0 or n >= 2**length:
         logger.error(f"Integer {n} is out of range for {length} bits.")
         raise ValueError(f"Integer must be in [0, {2**length-1}] to fit in {length} bits.")
-    bits = [int(b) for b in format(n, f'0{length}b')]
+    bits = BitBuffer.from_bytes(n.to_bytes(-(-length // 8), 'big'))[-length:] if length else BitBuffer()
     logger.debug(f"Converted integer {n} to {length}-bit header: {bits}")
     return bits
 
-def bits_to_int(bits: list[int]) -> int:
-    if not all(bit in (0, 1) for bit in bits):
+def bits_to_int(bits: list[int] | BitBuffer) -> int:
+    values = np.asarray(bits)
+    if values.size == 0 or not np.isin(values, (0, 1)).all():
         logger.error("Bit list contains non-binary values.")
         raise ValueError("Bits must be 0 or 1 only.")
-    value = int("".join(str(b) for b in bits), 2)
+    value = BitBuffer(values).to_int()
     logger.debug(f"Converted bits to integer: {value}")
     return value
 
-def add_header(message_bits: list[int]) -> list[int]:
+def add_header(message_bits: list[int] | BitBuffer) -> BitBuffer:
     """
     Prepend a 16-bit header indicating the length of message_bits.
     Returns header_bits + message_bits.
@@ -79,10 +154,10 @@ def extract_header(full_bitstream: list[int]) -> tuple[int, list[int]]:
     logger.debug(f"Message length from header: {message_length}")
     return message_length, message_bits
 
-def get_signature_bits() -> list[int]:
+def get_signature_bits() -> BitBuffer:
     return int_to_bits(SIGNATURE, length=16)
 
-def prepare_bitstream_with_headers(messages: list[str]) -> list[int]:
+def prepare_bitstream_with_headers(messages: list[str]) -> BitBuffer:
     """
     Prepends a 16-bit magic signature and headers for each message.
     Format: [SIGNATURE][HDR1][MSG1]...[HDRn][MSGn]
@@ -134,14 +209,14 @@ def parse_bitstream_with_headers(bitstream: list[int]) -> list[str]:
     return messages
 
 # New: Convert image (numpy array) to SHA256 hash bits (256 bits)
-def image_to_sha256_bits(image: np.ndarray) -> list[int]:
+def image_to_sha256_bits(image: np.ndarray) -> BitBuffer:
     if not isinstance(image, np.ndarray):
         logger.error("Input to image_to_sha256_bits is not a numpy array.")
         raise TypeError("Expected numpy.ndarray input")
     # Convert image to bytes
     image_bytes = image.tobytes()
     sha256_hash = hashlib.sha256(image_bytes).digest()  # 32 bytes
-    bits = [int(bit) for byte in sha256_hash for bit in format(byte, '08b')]
+    bits = BitBuffer.from_bytes(sha256_hash)
     if len(bits) != 256:
         logger.error(f"SHA256 hash did not produce 256 bits, got {len(bits)} bits.")
         raise ValueError("SHA256 hash must be 256 bits.")
@@ -149,7 +224,7 @@ def image_to_sha256_bits(image: np.ndarray) -> list[int]:
     return bits
 
 # New: Prepare bitstream with hash and multi-message framing
-def prepare_bitstream_with_hash_and_messages(image: np.ndarray, messages: list[str]) -> list[int]:
+def prepare_bitstream_with_hash_and_messages(image: np.ndarray, messages: list[str]) -> BitBuffer:
     logger.debug("Preparing bitstream with SHA256 hash and multi-message framing...")
     hash_bits = image_to_sha256_bits(image)
     bitstream = hash_bits
@@ -169,7 +244,7 @@ def parse_bitstream_with_hash_and_messages(bitstream: list[int]) -> tuple[list[i
     hash_bits = bitstream[:256]
     messages = []
     cursor = 256
-    MAX_MESSAGE_BITS = 1024 * 8  # 1024 bytes (8kb) per message, adjust as needed
+    MAX_MESSAGE_BITS = MAX_MESSAGE_BYTES * 8  # 1024 bytes (8kb) per message
     while cursor + 16 <= len(bitstream):
         length_bits = bitstream[cursor:cursor+16]
         msg_len = bits_to_int(length_bits)
@@ -189,34 +264,337 @@ def parse_bitstream_with_hash_and_messages(bitstream: list[int]) -> tuple[list[i
     logger.debug(f"Extracted hash bits and {len(messages)} messages.")
     return hash_bits, messages
 
-# New: Detect watermark format and parse accordingly
-def detect_and_parse_bitstream(bitstream: list[int]) -> tuple[list[int], list[str], str]:
+# New: Compact versioned (v3) framing
+# [MAGIC 16][VERSION 4|ENGINE 4][FLAGS 2|HASH BYTES 6][HASH][CRC16][BODY], byte aligned
+# BODY is [VARINT LEN][UTF-8]... [0x00], or with FRAME_FLAG_ZLIB one
+# [VARINT LEN][zlib of those records] block
+def varint_bytes(n: int) -> bytes:
+    """Unsigned LEB128: 7 bits per byte, low group first, high bit set on all but the last byte"""
+    if n < 0:
+        raise ValueError("Varint must be non-negative.")
+    out = bytearray()
+    while True:
+        byte, n = n & 0x7F, n >> 7
+        out.append(byte | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+def frame_crc(data: bytes) -> int:
+    """CRC-16/CCITT of the v3 frame header and hash"""
+    return binascii.crc_hqx(data, 0xFFFF)
+
+def message_records(messages: list[str]) -> bytes:
+    """Varint-length UTF-8 records followed by the zero-length terminator"""
+    records = bytearray()
+    for msg in messages:
+        data = msg.encode('utf-8')
+        if not data:
+            logger.error("Empty message cannot be framed.")
+            raise ValueError("Messages must not be empty.")
+        if len(data) > MAX_MESSAGE_BYTES:
+            logger.error(f"Message of {len(data)} bytes exceeds {MAX_MESSAGE_BYTES} bytes.")
+            raise ValueError(f"Messages must be at most {MAX_MESSAGE_BYTES} bytes.")
+        records += varint_bytes(len(data)) + data
+    return bytes(records + b'\x00')
+
+def prepare_bitstream_v3(image: np.ndarray, messages: list[str], engine: str = 'unknown',
+                         hash_bytes: int = V3_HASH_BYTES, compress: bool | str = 'auto') -> BitBuffer:
     """
-    Detects the watermark format and parses accordingly.
-    Returns (hash_bits, messages, format_type).
-    format_type can be 'legacy' (with signature) or 'hash_based' (with SHA256 hash).
+    Build a compact v3 frame: the first hash_bytes of the image SHA256 (0-32),
+    the engine tag, and the messages as varint-length records, zlib-compressed
+    when compress is True, or when that is shorter with compress='auto'.
     """
+    logger.debug("Preparing v3 bitstream...")
+    if engine not in ENGINE_TAGS:
+        raise ValueError(f"Unknown engine tag: {engine}. Expected one of {list(ENGINE_TAGS)}")
+    if not 0 <= hash_bytes <= 32:
+        raise ValueError("hash_bytes must be in [0, 32].")
+    records = message_records(messages)
+    packed = zlib.compress(records, 9)
+    packed = varint_bytes(len(packed)) + packed
+    use_zlib = compress is True or (compress == 'auto' and len(packed) < len(records))
+    header = (int_to_bits(FRAME_MAGIC_V3, 16).to_bytes()
+              + bytes([FRAME_VERSION << 4 | ENGINE_TAGS[engine],
+                       (FRAME_FLAG_ZLIB if use_zlib else 0) | hash_bytes])
+              + image_to_sha256_bits(image).to_bytes()[:hash_bytes])
+    frame = header + frame_crc(header).to_bytes(2, 'big') + (packed if use_zlib else records)
+    bitstream = BitBuffer.from_bytes(frame)
+    logger.debug(f"Total v3 bitstream prepared: {len(bitstream)} bits (zlib={use_zlib})")
+    return bitstream
+
+# New: Bit sources for the streaming parser
+class SequenceBitReader:
+    """Reader over an in-memory bitstream (list, BitBuffer or lazy view), in the engine reader interface"""
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.position = 0
+
+    @property
+    def remaining(self) -> int:
+        return len(self.bits) - self.position
+
+    def read(self, count: int):
+        chunk = self.bits[self.position:self.position + max(count, 0)]
+        self.position += len(chunk)
+        return chunk
+
+class IteratorBitReader:
+    """Reader over any iterator of bits; the length is unknown until it runs out"""
+
+    def __init__(self, bits):
+        self.bits = iter(bits)
+        self.position = 0
+        self.remaining = float('inf')
+
+    def read(self, count: int) -> list[int]:
+        chunk = [int(bit) for bit in itertools.islice(self.bits, max(count, 0))]
+        self.position += len(chunk)
+        if len(chunk) < count:
+            self.remaining = 0
+        return chunk
+
+def as_bit_reader(source):
+    """Wrap a bit source in the read(count)/remaining reader interface (engine readers pass through)"""
+    if hasattr(source, 'read') and hasattr(source, 'remaining'):
+        return source
+    if hasattr(source, '__len__') and hasattr(source, '__getitem__'):
+        return SequenceBitReader(source)
+    return IteratorBitReader(source)
+
+class PrefixedBitReader:
+    """Serves bits that were already read from reader before reading on, so a parser can back off"""
+
+    def __init__(self, prefix, reader):
+        self.prefix = list(prefix)
+        self.reader = reader
+
+    @property
+    def remaining(self):
+        return len(self.prefix) + self.reader.remaining
+
+    def read(self, count: int) -> list[int]:
+        head, self.prefix = self.prefix[:count], self.prefix[count:]
+        return head + list(self.reader.read(count - len(head))) if count > len(head) else head
+
+# New: Streaming format detection and parsing
+def iter_parse_bitstream(source, max_bits: int | None = None):
+    """
+    Generator-based parser for the legacy, hash_based and v3 formats.
+    source is an engine bit reader, a list or BitBuffer, or any iterator of bits.
+    Yields ('format', format_type), then ('engine', name) for v3 and
+    ('hash', hash_bits) for hash_based and v3 streams, then ('message', text)
+    for each message as soon as its bits are read. Only the bits needed for
+    the next item are read, so callers can stop after format detection or
+    after the first message.
+    Raises ValueError if the format cannot be detected.
+    """
+    reader = as_bit_reader(source)
+    total = reader.remaining if max_bits is None else min(max_bits, reader.remaining)
     logger.debug("Detecting watermark format...")
-    
-    if len(bitstream) < 16:
+
+    sig_bits = reader.read(16) if total >= 16 else []
+    if len(sig_bits) < 16:
         logger.error("Bitstream too short to detect format.")
         raise ValueError("Bitstream too short to detect format.")
-    
-    # Check if it's legacy format (starts with signature)
-    sig_bits = bitstream[:16]
-    extracted_sig = bits_to_int(sig_bits)
-    if extracted_sig == SIGNATURE:
-        logger.debug("Detected legacy format (with signature)")
-        messages = parse_bitstream_with_headers(bitstream)
-        # For legacy format, we don't have a hash, so return empty hash bits
-        return [], messages, 'legacy'
-    
-    # Check if it's hash-based format (starts with 256-bit hash)
-    elif len(bitstream) >= 256:
-        logger.debug("Detected hash-based format (with SHA256 hash)")
-        hash_bits, messages = parse_bitstream_with_hash_and_messages(bitstream)
-        return hash_bits, messages, 'hash_based'
-    
-    else:
+
+    signature = bits_to_int(sig_bits)
+    if signature == SIGNATURE:
+        yield from _iter_legacy(reader, total)
+        return
+
+    if signature == FRAME_MAGIC_V3:
+        header_bits, valid = _read_v3_header(reader, total)
+        if valid:
+            yield from _iter_v3(reader, total, sig_bits + header_bits)
+            return
+        # A SHA256 that happens to start with the v3 magic: re-read as hash_based
+        reader = PrefixedBitReader(header_bits, reader)
+
+    hash_bits = sig_bits + reader.read(240) if total >= 256 else sig_bits
+    if len(hash_bits) < 256:
         logger.error("Unknown watermark format")
         raise ValueError("Unknown watermark format")
+    yield from _iter_hash_based(reader, total, hash_bits)
+
+def _iter_legacy(reader, total):
+    logger.debug("Detected legacy format (with signature)")
+    yield 'format', 'legacy'
+    cursor = 16
+    messages = 0
+    while cursor + 16 <= total:
+        length_bits = reader.read(16)
+        if len(length_bits) < 16:
+            break
+        msg_len = bits_to_int(length_bits)
+        cursor += 16
+        message_bits = reader.read(msg_len) if cursor + msg_len <= total else []
+        if len(message_bits) < msg_len:
+            logger.warning("Incomplete message at end of bitstream. Ignoring.")
+            break
+        cursor += msg_len
+        try:
+            text = bits_to_string(message_bits)
+        except ValueError as e:
+            logger.warning(f"Failed to decode one message block: {e}")
+            continue
+        messages += 1
+        yield 'message', text
+    logger.debug(f"Read {cursor} bits, extracted {messages} messages.")
+
+def _iter_hash_based(reader, total, hash_bits):
+    logger.debug("Detected hash-based format (with SHA256 hash)")
+    yield 'format', 'hash_based'
+    yield 'hash', hash_bits
+    cursor = 256
+    messages = 0
+    MAX_MESSAGE_BITS = MAX_MESSAGE_BYTES * 8  # Must match parse_bitstream_with_hash_and_messages
+    while cursor + 16 <= total:
+        length_bits = reader.read(16)
+        if len(length_bits) < 16:
+            break
+        msg_len = bits_to_int(length_bits)
+        cursor += 16
+        msg_bits = reader.read(msg_len) if 0 < msg_len <= MAX_MESSAGE_BITS and cursor + msg_len <= total else []
+        if msg_len <= 0 or len(msg_bits) < msg_len:
+            logger.warning(f"Invalid or out-of-bounds message length at cursor {cursor-16}: {msg_len}. Stopping parse.")
+            break
+        cursor += msg_len
+        try:
+            text = bits_to_string(msg_bits)
+        except ValueError as e:
+            logger.warning(f"Failed to decode message at cursor {cursor-msg_len}: {e}. Skipping this message and continuing.")
+            continue
+        messages += 1
+        yield 'message', text
+    logger.debug(f"Read {cursor} bits, extracted hash bits and {messages} messages.")
+
+def _read_v3_header(reader, total):
+    """
+    Read the v3 tag, flags, hash and CRC that follow the magic
+    Returns (bits read after the magic, True if they form a header with a matching CRC)
+    """
+    if total < 48:
+        return BitBuffer(), False
+    header_bits = BitBuffer(reader.read(16))
+    if len(header_bits) < 16:
+        return header_bits, False
+    hash_len = bits_to_int(header_bits[8:16]) & 0x3F
+    if hash_len > 32 or 48 + 8 * hash_len > total:
+        return header_bits, False
+    header_bits += reader.read(8 * hash_len + 16)
+    if len(header_bits) < 8 * hash_len + 32:
+        return header_bits, False
+    header = int_to_bits(FRAME_MAGIC_V3, 16).to_bytes() + header_bits[:-16].to_bytes()
+    if frame_crc(header) != bits_to_int(header_bits[-16:]):
+        logger.debug("v3 magic found but the header CRC does not match.")
+        return header_bits, False
+    return header_bits, True
+
+def _iter_v3(reader, total, header_bits):
+    """Parse a v3 frame whose magic, tag, flags, hash and CRC (header_bits) have been read and checked"""
+    version, engine_tag = bits_to_int(header_bits[16:20]), bits_to_int(header_bits[20:24])
+    if version != FRAME_VERSION:
+        logger.error(f"Unsupported watermark frame version: {version}")
+        raise ValueError(f"Unsupported watermark frame version: {version}")
+    flags = bits_to_int(header_bits[24:32])
+    engine = next((name for name, tag in ENGINE_TAGS.items() if tag == engine_tag), 'unknown')
+    logger.debug(f"Detected v3 format (engine={engine}, flags={flags:#04x})")
+    yield 'format', 'v3'
+    yield 'engine', engine
+    yield 'hash', header_bits[32:-16]
+    cursor = len(header_bits)
+
+    if flags & FRAME_FLAG_ZLIB:
+        block_len, used = read_varint(reader, total - cursor)
+        cursor += used
+        if block_len is None or cursor + 8 * block_len > total:
+            logger.warning(f"Invalid or out-of-bounds compressed block length at cursor {cursor}. Stopping parse.")
+            return
+        block_bits = reader.read(8 * block_len)
+        cursor += len(block_bits)
+        try:
+            inflater = zlib.decompressobj()
+            records = inflater.decompress(BitBuffer(block_bits).to_bytes(), MAX_RECORDS_BYTES)
+        except zlib.error as e:
+            logger.warning(f"Failed to decompress message block: {e}. Stopping parse.")
+            return
+        logger.debug(f"Read {cursor} bits, inflated {len(records)} bytes of message records.")
+        yield from _iter_v3_records(SequenceBitReader(BitBuffer.from_bytes(records)), 8 * len(records))
+        return
+
+    yield from _iter_v3_records(reader, total - cursor)
+
+def _iter_v3_records(reader, total):
+    """Yield the messages of [VARINT LEN][UTF-8]... records up to the zero-length terminator"""
+    cursor = 0
+    messages = 0
+    while True:
+        msg_len, used = read_varint(reader, total - cursor)
+        cursor += used
+        if msg_len is None:
+            logger.warning(f"Missing terminator at record cursor {cursor}. Stopping parse.")
+            break
+        if msg_len == 0:
+            break
+        if msg_len > MAX_MESSAGE_BYTES or cursor + 8 * msg_len > total:
+            logger.warning(f"Invalid or out-of-bounds message length at record cursor {cursor}: {msg_len}. Stopping parse.")
+            break
+        msg_bits = reader.read(8 * msg_len)
+        cursor += len(msg_bits)
+        if len(msg_bits) < 8 * msg_len:
+            logger.warning("Incomplete message at end of bitstream. Ignoring.")
+            break
+        try:
+            text = bits_to_string(msg_bits)
+        except ValueError as e:
+            logger.warning(f"Failed to decode message at record cursor {cursor - 8 * msg_len}: {e}. Skipping this message and continuing.")
+            continue
+        messages += 1
+        yield 'message', text
+    logger.debug(f"Read {cursor} record bits, extracted {messages} messages.")
+
+def read_varint(reader, budget, max_bytes: int = 4) -> tuple[int | None, int]:
+    """Read one LEB128 varint a byte at a time; returns (value or None if cut off, bits read)"""
+    value, used = 0, 0
+    for shift in range(0, 7 * max_bytes, 7):
+        byte_bits = reader.read(8) if used + 8 <= budget else []
+        used += len(byte_bits)
+        if len(byte_bits) < 8:
+            return None, used
+        byte = bits_to_int(byte_bits)
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, used
+    return None, used
+
+# New: Detect watermark format and parse accordingly
+def detect_and_parse_bitstream(bitstream: list[int] | BitBuffer) -> tuple[list[int], list[str], str]:
+    """
+    Detects the watermark format and parses accordingly.
+    Returns (hash_bits, messages, format_type).
+    format_type can be 'legacy' (with signature), 'hash_based' (with SHA256 hash)
+    or 'v3' (compact frame; hash_bits is the truncated hash, possibly empty).
+    """
+    return detect_and_parse_reader(bitstream, max_bits=len(bitstream))
+
+# New: Incremental format detection and parsing over a bit reader
+def detect_and_parse_reader(reader, max_bits: int = 1000) -> tuple[list[int], list[str], str]:
+    """
+    Incremental counterpart of detect_and_parse_bitstream.
+    reader must provide read(count) -> list[int] and a `remaining` bit count
+    (or be any source iter_parse_bitstream accepts). Reads the signature or
+    hash and each length field first and then exactly the bits of the next
+    message, stopping as soon as the stream shows no further valid data.
+    Returns the same result as detect_and_parse_bitstream() on the first
+    max_bits bits of the stream.
+    """
+    hash_bits, messages, format_type = [], [], None
+    for kind, value in iter_parse_bitstream(reader, max_bits):
+        if kind == 'format':
+            format_type = value
+        elif kind == 'hash':
+            hash_bits = value
+        elif kind == 'message':
+            messages.append(value)
+    return hash_bits, messages, format_type
@@ -0,0 +1,47 @@
+import cv2
+import numpy as np
+from backend.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+COLOR_PIPELINES = ('ycrcb', 'luma_delta')
+
+def extract_luma(image: np.ndarray) -> np.ndarray:
+    """
+    Return the Y channel of an RGB image as a view, without splitting Cr/Cb.
+    Values are identical to cv2.split(cv2.cvtColor(image, cv2.COLOR_RGB2YCrCb))[0].
+    """
+    return cv2.cvtColor(image, cv2.COLOR_RGB2YCrCb)[..., 0]
+
+def rgb_to_luma(pixels: np.ndarray) -> np.ndarray:
+    """
+    Y of an (..., 3) array of RGB pixels, bit-exact with cv2.COLOR_RGB2YCrCb
+    (OpenCV's 14-bit fixed-point weights). Meant for small gathered patches.
+    """
+    x = pixels.astype(np.int32)
+    return ((x[..., 0] * 4899 + x[..., 1] * 9617 + x[..., 2] * 1868 + (1 << 13)) >> 14).astype(np.uint8)
+
+def apply_luma_delta(image: np.ndarray, Y: np.ndarray, watermarked_Y: np.ndarray) -> np.ndarray:
+    """
+    Return a copy of image with the luma change (watermarked_Y - Y) added to
+    all three channels, touching only the pixels whose luma changed.
+
+    Adding d to R, G and B adds exactly d to Y, because the luma weights sum
+    to one, so re-extracted luma equals watermarked_Y except where a channel
+    saturates at 0 or 255 (the 'ycrcb' pipeline clips there too).
+
+    Tolerance against the 'ycrcb' pipeline (merge and convert back): at most
+    1 grey level per channel. Unchanged pixels are returned as-is, where the
+    YCrCb round trip re-quantizes them by up to 1 level.
+    """
+    if watermarked_Y.shape != Y.shape:
+        raise ValueError(f"Luma shape changed from {Y.shape} to {watermarked_Y.shape}")
+    delta = watermarked_Y.astype(np.int16) - Y
+    changed = np.flatnonzero(delta)
+    logger.debug(f"Applying luma delta to {len(changed)} of {delta.size} pixels")
+
+    result = image.copy()
+    pixels = result.reshape(-1, image.shape[2])
+    updated = pixels[changed].astype(np.int16) + delta.ravel()[changed, None]
+    pixels[changed] = np.clip(updated, 0, 255)
+    return result
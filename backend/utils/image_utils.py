@@ -1,3 +1,5 @@
+import os
+import threading
 import cv2
 import numpy as np
 import base64
@@ -6,6 +8,123 @@ from io import BytesIO
 
 logger = setup_logger(__name__)
 
+# Leading bytes of the upload formats kept verbatim, with their file extensions
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'BM', '.bmp'),
+    (b'II*\x00', '.tif'),
+    (b'MM\x00*', '.tif'),
+]
+
+# Display previews: long edge in pixels, and the lossy encodings with their quality flag
+PREVIEW_MAX_EDGE = 512
+PREVIEW_QUALITY = 80
+PREVIEW_ENCODINGS = {
+    '.jpg': cv2.IMWRITE_JPEG_QUALITY,
+    '.webp': cv2.IMWRITE_WEBP_QUALITY,
+}
+
+def sniff_extension(image_bytes: bytes):
+    """File extension of encoded image bytes, or None if the format is not recognised"""
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return '.webp'
+    for signature, ext in IMAGE_SIGNATURES:
+        if image_bytes.startswith(signature):
+            return ext
+    return None
+
+def decode_image_bytes(image_bytes: bytes) -> np.ndarray:
+    if not image_bytes:
+        logger.warning("Uploaded file is empty.")
+        raise ValueError("Uploaded file is empty.")
+
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    if image is None:
+        logger.error("cv2.imdecode() returned None. Possibly unsupported format or corrupted file.")
+        raise ValueError("Unable to decode image. Unsupported format or corrupted file.")
+
+    logger.debug(f"Image successfully loaded. Shape: {image.shape}")
+    return image
+
+class ImageArtifact:
+    """
+    An image encoded once and held in memory
+    - data is the encoded file: one cv2.imencode, or the verbatim upload
+    - array is the decoded BGR image
+    - save(), to_base64() and IPFS uploads all reuse data, so the image is
+      never encoded twice or read back from disk
+    """
+
+    def __init__(self, data: bytes, ext: str, array: np.ndarray = None):
+        self.data = data
+        self.ext = ext
+        self.array = array
+
+    @classmethod
+    def from_array(cls, array: np.ndarray, ext: str = '.png', params=()) -> 'ImageArtifact':
+        if array is None or not isinstance(array, np.ndarray):
+            logger.warning("Invalid image array provided to ImageArtifact.from_array().")
+            raise ValueError("Invalid image array provided.")
+        success, buffer = cv2.imencode(ext, array, list(params))
+        if not success:
+            logger.error(f"cv2.imencode() failed to encode image as {ext}.")
+            raise IOError(f"Failed to encode image as {ext}")
+        logger.debug(f"Image encoded once as {ext}: {buffer.nbytes} bytes")
+        return cls(buffer.tobytes(), ext, array)
+
+    @classmethod
+    def from_upload(cls, file) -> 'ImageArtifact':
+        """Read and decode an uploaded file, keeping its bytes (re-encoded as PNG only for unrecognised formats)"""
+        if file is None:
+            logger.warning("No file provided to ImageArtifact.from_upload().")
+            raise ValueError("No file provided.")
+        image_bytes = file.read()
+        image = decode_image_bytes(image_bytes)
+        ext = sniff_extension(image_bytes)
+        if ext is None:
+            logger.debug("Unrecognised upload format; storing it re-encoded as PNG.")
+            return cls.from_array(image)
+        return cls(image_bytes, ext, image)
+
+    def save(self, path: str) -> str:
+        """Write data to path atomically: a temporary file in the same folder, then a rename"""
+        logger.debug(f"Attempting to save {len(self.data)} encoded bytes to path: {path}")
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(self.data)
+            os.replace(temp_path, path)
+        except Exception:
+            logger.exception("Exception occurred in ImageArtifact.save().")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        logger.debug("Image saved successfully.")
+        return path
+
+    def to_base64(self) -> str:
+        return base64.b64encode(self.data).decode('utf-8')
+
+    def preview(self, max_edge: int = PREVIEW_MAX_EDGE, ext: str = '.jpg', quality: int = PREVIEW_QUALITY) -> 'ImageArtifact':
+        """
+        Small lossy copy of array for display, long edge at most max_edge
+        Downscaled with INTER_AREA, which averages pixels instead of aliasing;
+        the preview no longer carries a readable watermark
+        """
+        if ext not in PREVIEW_ENCODINGS:
+            raise ValueError(f"Unsupported preview format: {ext}. Expected one of {list(PREVIEW_ENCODINGS)}")
+        array = self.array
+        height, width = array.shape[:2]
+        scale = max_edge / max(height, width)
+        if scale < 1:
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            array = cv2.resize(array, size, interpolation=cv2.INTER_AREA)
+        preview = ImageArtifact.from_array(array, ext, (PREVIEW_ENCODINGS[ext], quality))
+        logger.debug(f"Preview of {width}x{height} image: {array.shape[1]}x{array.shape[0]} {ext}, {len(preview.data)} bytes")
+        return preview
+
 def load_image(file) -> np.ndarray:
     logger.debug("Attempting to load image from uploaded file...")
     try:
@@ -13,19 +132,7 @@ def load_image(file) -> np.ndarray:
             logger.warning("No file provided to load_image().")
             raise ValueError("No file provided.")
 
-        image_bytes = file.read()
-        if not image_bytes:
-            logger.warning("Uploaded file is empty.")
-            raise ValueError("Uploaded file is empty.")
-
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        if image is None:
-            logger.error("cv2.imdecode() returned None. Possibly unsupported format or corrupted file.")
-            raise ValueError("Unable to decode image. Unsupported format or corrupted file.")
-
-        logger.debug(f"Image successfully loaded. Shape: {image.shape}")
-        return image
+        return decode_image_bytes(file.read())
 
     except Exception as e:
         logger.exception("Exception occurred in load_image().")
@@ -0,0 +1,151 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from backend.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+JOB_TTL_SECONDS = 3600  # Finished jobs stay queryable for an hour
+MAX_JOBS = 1000  # Oldest finished jobs are evicted beyond this
+
+class Job:
+    """
+    Progress record of one background job
+    - stages is an ordered {name: {status, started, finished, seconds, ...}} map,
+      status going pending -> running -> done | failed
+    - status is queued -> running -> done | failed for the job as a whole
+    - version increases on every change, so watchers can wait for the next one
+    """
+
+    def __init__(self, stages):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.stages = {name: {'status': 'pending', 'started': None, 'finished': None, 'seconds': None}
+                       for name in stages}
+        self.result = {}
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.version = 0
+        self._changed = threading.Condition()
+
+    def _update(self, apply):
+        with self._changed:
+            apply()
+            self.version += 1
+            self._changed.notify_all()
+
+    def start_stage(self, name):
+        def apply():
+            self.stages[name].update(status='running', started=time.time())
+        self._update(apply)
+        logger.debug(f"Job {self.id}: stage {name} started")
+
+    def finish_stage(self, name, ok=True, **result):
+        """Mark a stage done (or failed) and merge its result fields into the job result"""
+        def apply():
+            stage = self.stages[name]
+            stage.update(status='done' if ok else 'failed', finished=time.time())
+            stage['seconds'] = round(stage['finished'] - (stage['started'] or stage['finished']), 3)
+            self.result.update(result)
+        self._update(apply)
+        logger.debug(f"Job {self.id}: stage {name} {'done' if ok else 'failed'}")
+
+    def add_result(self, result):
+        self._update(lambda: self.result.update(result))
+
+    def set_status(self, status, error=None):
+        def apply():
+            self.status = status
+            self.error = error
+            if status in ('done', 'failed'):
+                self.finished = time.time()
+        self._update(apply)
+
+    @property
+    def done(self) -> bool:
+        return self.status in ('done', 'failed')
+
+    def snapshot(self) -> dict:
+        """JSON-ready copy of the job state"""
+        with self._changed:
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                'result': dict(self.result),
+                'error': self.error,
+                'created': self.created,
+                'finished': self.finished,
+                'version': self.version,
+            }
+
+    def wait_for_change(self, version, timeout=None) -> bool:
+        """Block until the job version passes version; False on timeout"""
+        with self._changed:
+            return self._changed.wait_for(lambda: self.version > version, timeout)
+
+class JobQueue:
+    """
+    In-process job store with a thread pool running the jobs
+    Jobs live in the memory of the worker process that created them, so
+    status requests must reach the same process (a single gunicorn worker
+    with threads, as in the Procfile).
+    """
+
+    def __init__(self, max_workers=4, ttl=JOB_TTL_SECONDS, max_jobs=MAX_JOBS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, stages) -> Job:
+        job = Job(stages)
+        with self._lock:
+            self._evict()
+            self.jobs[job.id] = job
+        logger.info(f"Created job {job.id} with stages {list(job.stages)}")
+        return job
+
+    def submit(self, job, func, *args, **kwargs):
+        """Run func(job, *args, **kwargs) in the pool; its return value is merged into job.result"""
+        def run():
+            job.set_status('running')
+            try:
+                result = func(job, *args, **kwargs)
+            except Exception as e:
+                logger.exception(f"Job {job.id} failed")
+                job.set_status('failed', error=str(e))
+                return
+            if result:
+                job.add_result(result)
+            job.set_status('done')
+            logger.info(f"Job {job.id} finished in {job.finished - job.created:.2f} seconds")
+        self.executor.submit(run)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def _evict(self):
+        now = time.time()
+        finished = sorted((job.finished, job_id) for job_id, job in self.jobs.items() if job.done)
+        expired = [job_id for when, job_id in finished if now - when > self.ttl]
+        overflow = max(len(self.jobs) - len(expired) - self.max_jobs + 1, 0)
+        expired += [job_id for when, job_id in finished if now - when <= self.ttl][:overflow]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+def get_job_queue() -> JobQueue:
+    """Process-wide job queue, created on first use"""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+        return _job_queue
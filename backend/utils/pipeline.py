@@ -0,0 +1,115 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZES = {
+    'cpu': os.cpu_count() or 4,  # numpy / OpenCV work, which releases the GIL
+    'io': 16,                    # disk writes and network calls
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(kind) -> ThreadPoolExecutor:
+    """Process-wide thread pool for one kind of stage, created on first use"""
+    with _pools_lock:
+        if kind not in _pools:
+            _pools[kind] = ThreadPoolExecutor(max_workers=POOL_SIZES[kind], thread_name_prefix=f'pipeline-{kind}')
+        return _pools[kind]
+
+class Stage:
+    """
+    One step of a Pipeline
+    - func is called with one keyword argument per dependency, holding its result
+    - deps name earlier stages or pipeline inputs
+    - pool is 'cpu' or 'io'
+    """
+
+    def __init__(self, name, func, deps, pool):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.pool = pool
+
+class PipelineResult(dict):
+    """Stage results by name (inputs included), with per-stage timings"""
+
+    def __init__(self, results, timings):
+        super().__init__(results)
+        self.timings = timings
+
+    def summary(self) -> str:
+        return ', '.join(f"{name} {timing['seconds'] * 1e3:.0f} ms" for name, timing in self.timings.items())
+
+class Pipeline:
+    """
+    Small DAG executor: stages run as soon as their dependencies are done,
+    independent stages concurrently on the shared thread pools.
+    A stage that raises stops new stages from starting; run() waits for the
+    running ones and re-raises the first error. Stages must not run a
+    pipeline of their own on the pool they run on.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+
+    def add(self, name, func, deps=(), pool='cpu'):
+        if name in self.stages:
+            raise ValueError(f"Duplicate pipeline stage: {name}")
+        if pool not in POOL_SIZES:
+            raise ValueError(f"Unknown pool: {pool}. Expected one of {list(POOL_SIZES)}")
+        self.stages[name] = Stage(name, func, deps, pool)
+        return self
+
+    def run(self, **inputs) -> PipelineResult:
+        """Run every stage; inputs are available to stages as if they were results"""
+        missing = {dep for stage in self.stages.values() for dep in stage.deps} - set(self.stages) - set(inputs)
+        if missing:
+            raise ValueError(f"Pipeline {self.name} has unknown dependencies: {sorted(missing)}")
+
+        results = dict(inputs)
+        timings = {}
+        pending = dict(self.stages)
+        running = {}
+        error = None
+        start = time.perf_counter()
+
+        def call(stage, kwargs):
+            began = time.perf_counter()
+            value = stage.func(**kwargs)
+            return value, began, time.perf_counter()
+
+        while pending or running:
+            if error is None:
+                ready = [stage for stage in pending.values() if all(dep in results for dep in stage.deps)]
+                for stage in ready:
+                    del pending[stage.name]
+                    kwargs = {dep: results[dep] for dep in stage.deps}
+                    running[get_pool(stage.pool).submit(call, stage, kwargs)] = stage
+            if not running:
+                if pending and error is None:
+                    raise ValueError(f"Pipeline {self.name} has a dependency cycle among: {sorted(pending)}")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    value, began, ended = future.result()
+                except Exception as e:
+                    logger.error(f"Pipeline {self.name}: stage {stage.name} failed: {e}")
+                    error = error or e
+                    continue
+                results[stage.name] = value
+                timings[stage.name] = {'start': round(began - start, 4), 'seconds': round(ended - began, 4)}
+                logger.debug(f"Pipeline {self.name}: stage {stage.name} took {(ended - began) * 1e3:.1f} ms")
+
+        if error is not None:
+            raise error
+        result = PipelineResult(results, timings)
+        logger.debug(f"Pipeline {self.name} finished in {(time.perf_counter() - start) * 1e3:.1f} ms: {result.summary()}")
+        return result
@@ -2,10 +2,31 @@ import numpy as np
 import cv2
 from scipy.fft import dct, idct
 from utils.logger import setup_logger
+from utils.color_pipeline import COLOR_PIPELINES, extract_luma, apply_luma_delta
+from utils.memory_utils import resolve_dtype, reports_peak_memory
+from utils.image_utils import group_by_shape
+import functools
 import random
 
 logger = setup_logger(__name__)
 
+@functools.lru_cache(maxsize=16)
+def coefficient_basis(block_size, position):
+    """
+    Separable vectors of one block-DCT coefficient (scipy's unnormalized DCT-II)
+    - analysis rows/cols give the coefficient as rows @ block @ cols
+    - synthesis is the pixel change of the block per unit change of the coefficient
+    Returns read-only float64 (rows, cols, synthesis)
+    """
+    u, v = position
+    forward = dct(np.eye(block_size), axis=0)
+    inverse = idct(np.eye(block_size), axis=0)
+    rows, cols = forward[u].copy(), forward[v].copy()
+    synthesis = np.outer(inverse[:, u], inverse[:, v])
+    for array in (rows, cols, synthesis):
+        array.setflags(write=False)
+    return rows, cols, synthesis
+
 class DCTWatermarkEngine:
     """
     Robust DCT-based watermarking engine
@@ -14,7 +35,14 @@ class DCTWatermarkEngine:
     - Simple to implement and very effective
     """
     
-    def __init__(self, block_size=8, alpha=30.0, seed=42):
+    # Batch calls stack at most this many luma pixels per sub-batch
+    BATCH_PIXELS = 1 << 24
+    # Coefficients within this of zero read as 0; absorbs round-off that
+    # differs between contraction orders so every path reads the same bits
+    ZERO_TOLERANCE = 1e-3
+    
+    def __init__(self, block_size=8, alpha=30.0, seed=42, color_pipeline='ycrcb',
+                 dtype='float64', track_memory=False):
         """
         Initialize DCT watermarking engine
         
@@ -22,46 +50,95 @@ class DCTWatermarkEngine:
             block_size: Size of DCT blocks (8x8 is standard)
             alpha: Embedding strength (higher = more robust but more visible)
             seed: Random seed for reproducible embedding positions
+            color_pipeline: 'ycrcb' merges the new Y with Cr/Cb and converts back,
+                'luma_delta' adds the luma change straight to the RGB pixels
+            dtype: 'float64' or 'float32' for the block transforms
+            track_memory: Record the peak bytes allocated by each embed or
+                extract call in last_peak_bytes (uses tracemalloc)
         """
+        if color_pipeline not in COLOR_PIPELINES:
+            raise ValueError(f"Unknown color pipeline '{color_pipeline}', expected one of {COLOR_PIPELINES}")
         self.block_size = block_size
         self.alpha = alpha
         self.seed = seed
+        self.color_pipeline = color_pipeline
+        self.dtype = resolve_dtype(dtype)
+        self.track_memory = track_memory
+        self.last_peak_bytes = None
         random.seed(seed)
         
         # Use a single position for simplicity and reliability
         self.embed_position = (4, 4)  # Middle frequency position
+        rows, cols, synthesis = coefficient_basis(block_size, self.embed_position)
+        self._basis_rows, self._basis_cols = rows.astype(self.dtype), cols.astype(self.dtype)
+        self._basis_synthesis = synthesis.astype(self.dtype)
         
-        logger.info(f"DCT Watermark Engine initialized: block_size={block_size}, alpha={alpha}")
+        logger.info(f"DCT Watermark Engine initialized: block_size={block_size}, alpha={alpha}, dtype={self.dtype}")
     
-    def _get_blocks(self, image):
-        """Split image into blocks"""
-        height, width = image.shape
-        blocks = []
-        positions = []
-        
-        for i in range(0, height - self.block_size + 1, self.block_size):
-            for j in range(0, width - self.block_size + 1, self.block_size):
-                block = image[i:i+self.block_size, j:j+self.block_size]
-                blocks.append(block)
-                positions.append((i, j))
-        
-        return blocks, positions
+    def _block_view(self, plane):
+        """
+        Writable (..., blocks_h, blocks_w, size, size) view of the full blocks of
+        plane (any leading axes); rows and columns past the last full block are left out
+        """
+        size = self.block_size
+        height, width = plane.shape[-2:]
+        row_stride, col_stride = plane.strides[-2:]
+        shape = plane.shape[:-2] + (height // size, width // size, size, size)
+        strides = plane.strides[:-2] + (row_stride * size, col_stride * size, row_stride, col_stride)
+        return np.lib.stride_tricks.as_strided(plane, shape, strides)
     
-    def _reconstruct_image(self, blocks, positions, original_shape):
-        """Reconstruct image from blocks"""
-        result = np.zeros(original_shape, dtype=np.float64)
-        count = np.zeros(original_shape, dtype=np.float64)
-        
-        for block, (i, j) in zip(blocks, positions):
-            result[i:i+self.block_size, j:j+self.block_size] += block
-            count[i:i+self.block_size, j:j+self.block_size] += 1
-        
-        # Average overlapping regions
-        count[count == 0] = 1  # Avoid division by zero
-        result = result / count
+    def _split_luma(self, image):
+        """Return (Y, Cr, Cb); the luma-delta pipeline never needs Cr/Cb, so they are None there"""
+        if self.color_pipeline == 'luma_delta':
+            return extract_luma(image), None, None
+        ycrcb = cv2.cvtColor(image, cv2.COLOR_RGB2YCrCb)
+        return cv2.split(ycrcb)
+    
+    def _recombine(self, image, Y, watermarked_Y, Cr, Cb):
+        """Turn the watermarked luma back into an RGB image through the colour pipeline"""
+        if self.color_pipeline == 'luma_delta':
+            return apply_luma_delta(image, Y, watermarked_Y)
+        # Merge channels
+        merged = cv2.merge([watermarked_Y, Cr, Cb])
+        return cv2.cvtColor(merged, cv2.COLOR_YCrCb2RGB)
+    
+    def _block_coefficients(self, blocks):
+        """(4,4) DCT coefficient of each block in a (..., size, size) stack, in the engine dtype"""
+        return np.einsum('...ij,i,j->...', blocks, self._basis_rows, self._basis_cols)
+    
+    def _leading_coefficients(self, blocks, count):
+        """
+        (4,4) coefficients of the first count blocks of a (..., blocks_h, blocks_w, size, size)
+        block view, in row-major block order; reads the view directly, without gathering blocks
+        """
+        full_rows, tail = divmod(count, blocks.shape[-3])
+        head = self._block_coefficients(blocks[..., :full_rows, :, :, :])
+        tail = self._block_coefficients(blocks[..., full_rows:full_rows + 1, :tail, :, :])
+        return np.concatenate([head.reshape(head.shape[:-2] + (-1,)), tail.reshape(tail.shape[:-2] + (-1,))], axis=-1)
+    
+    def _values_to_bits(self, values):
+        """Positive coefficients read as 1, everything else as 0"""
+        return (values > self.ZERO_TOLERANCE).astype(np.uint8).tolist()
+    
+    def _embed_blocks(self, blocks, bits):
+        """
+        Embed bits into the (4,4) coefficient of a (..., size, size) block stack
+        (bits broadcast against the leading axes); returns the pixel blocks
+        clipped to 0..255 in the engine dtype
         
-        return np.clip(result, 0, 255).astype(np.uint8)
+        Only one coefficient changes, so instead of a forward and inverse
+        DCT per block the coefficient is read as a dot product and the
+        block gets the (4,4) basis pattern scaled by the coefficient change.
+        """
+        blocks = blocks.astype(self.dtype)
+        current = self._block_coefficients(blocks)
+        # Bit 1 forces the coefficient positive and above alpha, bit 0 negative
+        magnitude = np.abs(current) + self.alpha
+        delta = np.where(bits == 1, magnitude, -magnitude) - current
+        blocks += delta[..., None, None] * self._basis_synthesis
+        return np.clip(blocks, 0, 255, out=blocks)
     
+    @reports_peak_memory
     def embed_watermark(self, image, watermark_bits):
         """
         Embed watermark bits into image using DCT
@@ -75,50 +152,29 @@ class DCTWatermarkEngine:
         """
         logger.info(f"Embedding {len(watermark_bits)} bits using DCT watermarking")
         
-        # Convert to YCbCr and work on Y channel
-        ycrcb = cv2.cvtColor(image, cv2.COLOR_RGB2YCrCb)
-        Y, Cr, Cb = cv2.split(ycrcb)
-        
-        # Get blocks
-        blocks, positions = self._get_blocks(Y.astype(np.float64))
-        
-        if len(blocks) < len(watermark_bits):
-            raise ValueError(f"Image too small: need {len(watermark_bits)} blocks, got {len(blocks)}")
-        
-        # Embed watermark
-        watermarked_blocks = []
-        for i, block in enumerate(blocks):
-            if i < len(watermark_bits):
-                # Apply DCT
-                dct_block = dct(dct(block, axis=0), axis=1)
-                
-                # Embed bit using simple quantization
-                bit = watermark_bits[i]
-                current_value = dct_block[self.embed_position]
-                
-                if bit == 1:
-                    # Force to positive and above threshold
-                    dct_block[self.embed_position] = abs(current_value) + self.alpha
-                else:
-                    # Force to negative or below threshold
-                    dct_block[self.embed_position] = -abs(current_value) - self.alpha
-                
-                # Apply inverse DCT
-                watermarked_block = idct(idct(dct_block, axis=0), axis=1)
-                watermarked_blocks.append(watermarked_block)
-            else:
-                watermarked_blocks.append(block)
-        
-        # Reconstruct Y channel
-        watermarked_Y = self._reconstruct_image(watermarked_blocks, positions, Y.shape)
+        # Work on the Y channel
+        Y, Cr, Cb = self._split_luma(image)
         
-        # Merge channels
-        merged = cv2.merge([watermarked_Y, Cr, Cb])
-        watermarked_image = cv2.cvtColor(merged, cv2.COLOR_YCrCb2RGB)
+        # Blocks never overlap, so the payload blocks are transformed in one
+        # stack and written straight back through the block view
+        watermarked_Y = Y.copy()
+        blocks = self._block_view(watermarked_Y)
+        blocks_h, blocks_w = blocks.shape[:2]
+        
+        if blocks_h * blocks_w < len(watermark_bits):
+            raise ValueError(f"Image too small: need {len(watermark_bits)} blocks, got {blocks_h * blocks_w}")
+        
+        if len(watermark_bits):
+            block_rows, block_cols = np.divmod(np.arange(len(watermark_bits)), blocks_w)
+            watermarked_blocks = self._embed_blocks(blocks[block_rows, block_cols], np.asarray(watermark_bits))
+            blocks[block_rows, block_cols] = watermarked_blocks.astype(np.uint8)
+        
+        watermarked_image = self._recombine(image, Y, watermarked_Y, Cr, Cb)
         
         logger.info("DCT watermark embedding completed")
         return watermarked_image
     
+    @reports_peak_memory
     def extract_watermark(self, image, bit_count):
         """
         Extract watermark bits from image
@@ -132,32 +188,126 @@ class DCTWatermarkEngine:
         """
         logger.info(f"Extracting {bit_count} bits using DCT watermarking")
         
-        # Convert to YCbCr and work on Y channel
-        ycrcb = cv2.cvtColor(image, cv2.COLOR_RGB2YCrCb)
-        Y, _, _ = cv2.split(ycrcb)
+        # Work on the Y channel only
+        Y = extract_luma(image)
+        
+        blocks = self._block_view(Y)
+        blocks_h, blocks_w = blocks.shape[:2]
+        
+        if blocks_h * blocks_w < bit_count:
+            logger.warning(f"Image too small: need {bit_count} blocks, got {blocks_h * blocks_w}")
+            bit_count = blocks_h * blocks_w
         
-        # Get blocks
-        blocks, _ = self._get_blocks(Y.astype(np.float64))
+        # Only the (4,4) coefficient is needed, so each payload block is
+        # contracted with its separable basis vectors instead of transformed
+        values = self._leading_coefficients(blocks, max(bit_count, 0))
+        extracted_bits = self._values_to_bits(values)
         
-        if len(blocks) < bit_count:
-            logger.warning(f"Image too small: need {bit_count} blocks, got {len(blocks)}")
-            bit_count = len(blocks)
+        logger.info(f"DCT watermark extraction completed: {extracted_bits[:10]}...")
+        return extracted_bits
+    
+    @reports_peak_memory
+    def embed_batch(self, images, bitstreams):
+        """
+        Embed one bitstream into each of several images
         
-        extracted_bits = []
+        Same-shaped images are stacked, and the blocks that carry bits are
+        transformed for the whole sub-batch at once; mixed shapes are split
+        into one sub-batch per shape (and at most BATCH_PIXELS per sub-batch).
+        Output is identical to calling embed_watermark on each image.
         
-        for i in range(bit_count):
-            block = blocks[i]
+        Args:
+            images: List of input images (RGB)
+            bitstreams: List of bit lists, one per image
+        
+        Returns:
+            List of watermarked images, in input order
+        """
+        if len(images) != len(bitstreams):
+            raise ValueError(f"Got {len(images)} images but {len(bitstreams)} bitstreams")
+        logger.info(f"Embedding {len(images)} bitstreams using DCT watermarking")
+        
+        results = [None] * len(images)
+        for shape, indices in group_by_shape(images, self.BATCH_PIXELS):
+            group = [images[i] for i in indices]
+            watermarked = self._embed_group(group, [bitstreams[i] for i in indices])
+            for i, image in zip(indices, watermarked):
+                results[i] = image
+            logger.debug(f"Embedded sub-batch of {len(indices)} images with shape {shape}")
+        
+        logger.info("DCT batch embedding completed")
+        return results
+    
+    def _embed_group(self, images, bitstreams):
+        """Embed into a list of images that all share one shape"""
+        size = self.block_size
+        height, width = images[0].shape[:2]
+        blocks_h, blocks_w = height // size, width // size
+        lengths = np.array([len(bits) for bits in bitstreams])
+        longest = int(lengths.max())
+        if blocks_h * blocks_w < longest:
+            raise ValueError(f"Image too small: need {longest} blocks, got {blocks_h * blocks_w}")
+        
+        planes = [self._split_luma(image) for image in images]
+        Y = np.stack([plane[0] for plane in planes])
+        
+        watermarked_Y = Y.copy()
+        
+        if longest:
+            # Transform only the blocks that carry a bit, for every image at once
+            bits = np.zeros((len(images), longest), dtype=np.uint8)
+            for row, stream in zip(bits, bitstreams):
+                row[:len(stream)] = np.asarray(stream) == 1
+            image_index, block_index = np.nonzero(np.arange(longest) < lengths[:, None])
+            block_rows, block_cols = np.divmod(block_index, blocks_w)
             
-            # Apply DCT
-            dct_block = dct(dct(block, axis=0), axis=1)
+            blocks = self._block_view(watermarked_Y)
+            watermarked_blocks = self._embed_blocks(blocks[image_index, block_rows, block_cols], bits[image_index, block_index])
+            blocks[image_index, block_rows, block_cols] = watermarked_blocks.astype(np.uint8)
+        
+        return [self._recombine(image, Y_plane, wY, Cr, Cb)
+                for image, (Y_plane, Cr, Cb), wY in zip(images, planes, watermarked_Y)]
+    
+    @reports_peak_memory
+    def extract_batch(self, images, bit_count):
+        """
+        Extract bit_count bits from each of several images
+        Only the luma rows and blocks that carry the bits are processed,
+        for each same-shaped sub-batch at once
+        
+        Returns:
+            List of bit lists, in input order
+        """
+        logger.info(f"Extracting {bit_count} bits from {len(images)} images using DCT watermarking")
+        
+        size = self.block_size
+        results = [None] * len(images)
+        for shape, indices in group_by_shape(images, self.BATCH_PIXELS):
+            blocks_w = shape[1] // size
+            capacity = (shape[0] // size) * blocks_w
+            count = min(bit_count, capacity)
+            if count < bit_count:
+                logger.warning(f"Image too small: need {bit_count} blocks, got {capacity}")
+            if count <= 0:
+                for i in indices:
+                    results[i] = []
+                continue
             
-            # Extract bit using simple threshold
-            coeff_value = dct_block[self.embed_position]
-            bit = 1 if coeff_value > 0 else 0
-            extracted_bits.append(bit)
+            stop_row = ((count - 1) // blocks_w + 1) * size
+            Y = np.stack([extract_luma(images[i][:stop_row]) for i in indices])
+            values = self._leading_coefficients(self._block_view(Y), count)
+            for i, bits in zip(indices, self._values_to_bits(values)):
+                results[i] = bits
         
-        logger.info(f"DCT watermark extraction completed: {extracted_bits[:10]}...")
-        return extracted_bits
+        logger.info("DCT batch extraction completed")
+        return results
+    
+    def open_reader(self, image):
+        """
+        Open an incremental reader over the watermark bits of image
+        Blocks are only transformed as their bits are read; see DCTBitReader
+        """
+        return DCTBitReader(self, image)
     
     def get_max_capacity(self, image):
         """Calculate maximum number of bits that can be embedded"""
@@ -166,13 +316,60 @@ class DCTWatermarkEngine:
         blocks_w = width // self.block_size
         return blocks_h * blocks_w
 
+class DCTBitReader:
+    """
+    Reads watermark bits from an image on demand, in embedding order
+    - Only the block rows reached so far are converted to luma
+    - Only the blocks being read are transformed
+    """
+    
+    def __init__(self, engine, image):
+        self.engine = engine
+        self.image = image
+        height, width = image.shape[:2]
+        self.blocks_w = width // engine.block_size
+        self.capacity = (height // engine.block_size) * self.blocks_w
+        self.position = 0
+        self._Y = np.empty((height, width), dtype=np.uint8)
+        self._luma_rows = 0
+    
+    @property
+    def remaining(self):
+        """Number of bits left before the reader runs out of blocks"""
+        return self.capacity - self.position
+    
+    def _ensure_luma(self, stop_row):
+        """Convert image rows up to stop_row to luma, if not done already"""
+        if stop_row > self._luma_rows:
+            self._Y[self._luma_rows:stop_row] = extract_luma(self.image[self._luma_rows:stop_row])
+            self._luma_rows = stop_row
+    
+    def read(self, count):
+        """Return the next count bits (fewer if the blocks run out)"""
+        count = max(0, min(count, self.remaining))
+        if count == 0:
+            return []
+        size = self.engine.block_size
+        last = self.position + count - 1
+        self._ensure_luma((last // self.blocks_w + 1) * size)
+        
+        block_rows, block_cols = np.divmod(np.arange(self.position, last + 1), self.blocks_w)
+        values = self.engine._block_coefficients(self.engine._block_view(self._Y)[block_rows, block_cols])
+        self.position += count
+        return self.engine._values_to_bits(values)
+
 # Convenience functions for easy integration
-def embed_watermark_dct(image, watermark_bits, alpha=30.0):
+def embed_watermark_dct(image, watermark_bits, alpha=30.0, color_pipeline='ycrcb'):
     """Simple function to embed watermark using DCT"""
-    engine = DCTWatermarkEngine(alpha=alpha)
+    engine = DCTWatermarkEngine(alpha=alpha, color_pipeline=color_pipeline)
     return engine.embed_watermark(image, watermark_bits)
 
 def extract_watermark_dct(image, bit_count, alpha=30.0):
     """Simple function to extract watermark using DCT"""
     engine = DCTWatermarkEngine(alpha=alpha)
-    return engine.extract_watermark(image, bit_count) 
\ No newline at end of file
+    return engine.extract_watermark(image, bit_count) 
+
+def open_reader_dct(image, alpha=30.0):
+    """Simple function to open an incremental DCT bit reader"""
+    engine = DCTWatermarkEngine(alpha=alpha)
+    return engine.open_reader(image)
@@ -1,9 +1,13 @@
 import os
+import json
 import uuid
+import mimetypes
 import logging
-from flask import Blueprint, request, jsonify
-from utils.image_utils import load_image, save_image, image_to_base64
+from flask import Blueprint, Response, request, jsonify, send_from_directory
+from werkzeug.security import safe_join
+from utils.image_utils import load_image, ImageArtifact
 from utils.bit_utils import (
+    BitBuffer,
     string_to_bits,
     bits_to_string,
     int_to_bits,
@@ -11,12 +15,12 @@ from utils.bit_utils import (
     get_signature_bits,
     prepare_bitstream_with_headers,
     image_to_sha256_bits,
-    prepare_bitstream_with_hash_and_messages,
+    prepare_bitstream_v3,
     parse_bitstream_with_hash_and_messages,
-    detect_and_parse_bitstream,
+    detect_and_parse_reader,
 )
 import zlib
-from core.dct_engine import embed_watermark_dct, extract_watermark_dct
+from core.dct_engine import embed_watermark_dct, open_reader_dct
 from utils.logger import setup_logger
 import time
 from datetime import datetime
@@ -33,6 +37,39 @@ WATERMARKED_FOLDER = os.path.join(UPLOAD_FOLDER, "watermarked")
 os.makedirs(ORIGINAL_FOLDER, exist_ok=True)
 os.makedirs(WATERMARKED_FOLDER, exist_ok=True)
 
+RESPONSE_FORMATS = ('base64', 'url', 'binary', 'preview')
+PREVIEW_EXT = '.jpg'  # Displayable everywhere; WebP is also supported by ImageArtifact.preview
+FILE_MAX_AGE = 24 * 3600  # Stored files never change: every request gets new file names
+
+def requested_format():
+    """Response format of a /watermark request (form field or query argument), None if unknown"""
+    response_format = request.form.get("format", request.args.get("format", "base64"))
+    return response_format if response_format in RESPONSE_FORMATS else None
+
+def image_response(response_format, artifact, filename, metadata, status=200):
+    """
+    Build a /watermark response in the requested format
+    - base64: metadata JSON with the image inline under "image" (the default)
+    - url: metadata JSON only; the image is fetched from "image_url" (/files/<name>)
+    - binary: the image bytes, with the metadata JSON in an X-Watermark-Metadata header
+    - preview: metadata JSON with a downscaled JPEG inline under "preview" (tens of
+      kilobytes, for display only); the full image is fetched from "image_url"
+    """
+    metadata = dict(metadata, image_url=f"/files/{filename}")
+    if response_format == "binary":
+        response = Response(artifact.data, status=status, mimetype=mimetypes.guess_type(filename)[0])
+        response.headers["Content-Disposition"] = f'inline; filename="{filename}"'
+        response.headers["X-Watermark-Metadata"] = json.dumps(metadata)
+        response.headers["Access-Control-Expose-Headers"] = "X-Watermark-Metadata"
+        return response
+    if response_format == "base64":
+        metadata["image"] = artifact.to_base64()
+    elif response_format == "preview":
+        preview = artifact.preview(ext=PREVIEW_EXT)
+        metadata["preview"] = preview.to_base64()
+        metadata["preview_type"] = mimetypes.guess_type(f"preview{PREVIEW_EXT}")[0]
+    return jsonify(metadata), status
+
 @watermark_bp.route("/watermark", methods=["POST"])
 def watermark_image():
     logger.info("POST /watermark called")
@@ -48,10 +85,15 @@ def watermark_image():
             return jsonify({"error": "Message is required."}), 400
         logger.debug(f"Received file: filename={image_file.filename}, content_type={image_file.content_type}")
         logger.debug(f"Received message of length {len(message)} characters")
+        response_format = requested_format()
+        if response_format is None:
+            logger.error("Unknown response format requested")
+            return jsonify({"error": f"Unknown format. Expected one of {list(RESPONSE_FORMATS)}."}), 400
 
-        # Load image
+        # Load image, keeping the uploaded bytes as the stored original
         logger.debug("Loading original image from uploaded file")
-        image = load_image(image_file)
+        original = ImageArtifact.from_upload(image_file)
+        image = original.array
         logger.info(f"Original image loaded: shape={image.shape}, dtype={image.dtype}")
         
         # Check minimum image size for DCT watermarking
@@ -68,21 +110,15 @@ def watermark_image():
         parent_hash_extracted = False
         existing_messages = []
         try:
-            # Try to extract existing watermark using DCT
-            raw_bits = extract_watermark_dct(image, 1000)  # Extract more bits to be safe
-            logger.debug(f"Extracted {len(raw_bits)} bits from image for parent hash extraction.")
-            hash_bits, existing_messages, format_type = detect_and_parse_bitstream(raw_bits)
+            # Try to extract existing watermark using DCT, reading only as far as the headers allow
+            reader = open_reader_dct(image)
+            hash_bits, existing_messages, format_type = detect_and_parse_reader(reader, max_bits=1000)
+            logger.debug(f"Read {reader.position} bits from image for parent hash extraction.")
             logger.debug(f"Detected format: {format_type}, found {len(existing_messages)} existing messages.")
             
-            if format_type == 'hash_based' and len(hash_bits) == 256:
-                # Compute parent hash from extracted hash_bits
-                parent_hash_bytes = bytearray()
-                for i in range(0, 256, 8):
-                    byte = 0
-                    for b in hash_bits[i:i+8]:
-                        byte = (byte << 1) | b
-                    parent_hash_bytes.append(byte)
-                parent_hash = parent_hash_bytes.hex()
+            if format_type in ('hash_based', 'v3') and len(hash_bits) > 0:
+                # Compute parent hash from extracted hash_bits (a prefix for truncated v3 hashes)
+                parent_hash = BitBuffer(hash_bits).to_hex()
                 parent_hash_extracted = True
                 logger.info(f"Extracted parent hash from image: {parent_hash}")
             else:
@@ -91,10 +127,10 @@ def watermark_image():
             logger.warning(f"No valid watermark found in image for chaining. Using zero hash. Details: {e}")
 
         # File-level validation
-        uploaded_image_hash = image_to_sha256_bits(image)
+        uploaded_image_hash = image_to_sha256_bits(image).to_hex()
         logger.info(f"SHA256 of uploaded image: {uploaded_image_hash}")
         if parent_hash_extracted:
-            if parent_hash == uploaded_image_hash:
+            if uploaded_image_hash.startswith(parent_hash):
                 logger.info("File-level chain intact: parent hash matches uploaded image hash.")
             else:
                 logger.warning(f"File-level chain broken: parent hash ({parent_hash}) does not match uploaded image hash ({uploaded_image_hash}).")
@@ -105,9 +141,9 @@ def watermark_image():
         all_messages = existing_messages + [message]
         logger.info(f"Total messages to embed: {len(all_messages)}")
 
-        # Prepare bitstream: [256-bit hash][16-bit length][msg bits] ...
-        logger.debug("Preparing bitstream with SHA256 hash and multi-message framing")
-        combined_stream = prepare_bitstream_with_hash_and_messages(image, all_messages)
+        # Prepare bitstream: compact v3 frame with a truncated SHA256 and varint-framed, optionally compressed messages
+        logger.debug("Preparing v3 bitstream with truncated SHA256 hash and multi-message framing")
+        combined_stream = prepare_bitstream_v3(image, all_messages, engine='dct')
         combined_length = len(combined_stream)
         logger.info(f"Combined bitstream length: {combined_length} bits")
 
@@ -118,35 +154,31 @@ def watermark_image():
 
         # Save original and watermarked images
         uid = uuid.uuid4().hex
-        orig_filename = f"{uid}_orig.png"
+        orig_filename = f"{uid}_orig{original.ext}"
         wm_filename   = f"{uid}_wm.png"
         orig_path = os.path.join(ORIGINAL_FOLDER, orig_filename)
         wm_path   = os.path.join(WATERMARKED_FOLDER, wm_filename)
 
         logger.debug(f"Saving original image to {orig_path}")
-        save_image(image, orig_path)
+        original.save(orig_path)
         logger.info("Original image saved successfully")
 
+        # Encode the watermarked image once, for both the file and the response
         logger.debug(f"Saving watermarked image to {wm_path}")
-        save_image(watermarked_image, wm_path)
+        watermarked = ImageArtifact.from_array(watermarked_image)
+        watermarked.save(wm_path)
         logger.info("Watermarked image saved successfully")
 
-        # Convert images to base64 for response
-        logger.debug("Converting images to base64 for response")
-        orig_base64 = image_to_base64(orig_path)
-        wm_base64 = image_to_base64(wm_path)
-
         # Compute hashes for response
         orig_hash_bits = image_to_sha256_bits(image)
-        original_hash = bytearray(int(''.join(str(b) for b in orig_hash_bits[i:i+8]), 2) for i in range(0, 256, 8)).hex()
+        original_hash = orig_hash_bits.to_hex()
         wm_hash_bits = image_to_sha256_bits(watermarked_image)
-        watermarked_hash = bytearray(int(''.join(str(b) for b in wm_hash_bits[i:i+8]), 2) for i in range(0, 256, 8)).hex()
+        watermarked_hash = wm_hash_bits.to_hex()
 
         # Prepare response to match frontend expectations
         response_data = {
             "success": True,
             "message": "Watermark embedded successfully using DCT",
-            "image": wm_base64,  # Frontend expects 'image' field
             "original_filename": orig_filename,
             "watermarked_filename": wm_filename,
             "original_hash": original_hash,
@@ -162,12 +194,29 @@ def watermark_image():
         }
 
         logger.info("Watermark embedding completed successfully")
-        return jsonify(response_data), 200
+        return image_response(response_format, watermarked, wm_filename, response_data)
 
     except Exception as e:
         logger.exception("Error in watermark_image endpoint")
         return jsonify({"error": str(e)}), 500
 
+@watermark_bp.route("/files/<filename>", methods=["GET"])
+def serve_file(filename):
+    """
+    Stream a stored original or watermarked image
+    conditional=True makes Flask answer If-None-Match (304) and Range (206) from the file's ETag
+    ?download=1 serves it as an attachment, so browsers save it even from another origin
+    """
+    as_attachment = request.args.get("download") == "1"
+    for folder in (WATERMARKED_FOLDER, ORIGINAL_FOLDER):
+        path = safe_join(folder, filename)
+        if path and os.path.isfile(path):
+            logger.debug(f"Serving {path}")
+            return send_from_directory(folder, filename, conditional=True, etag=True, max_age=FILE_MAX_AGE,
+                                       as_attachment=as_attachment)
+    logger.warning(f"Requested file not found: {filename}")
+    return jsonify({"error": "File not found."}), 404
+
 @watermark_bp.route("/extract", methods=["POST"])
 def extract_watermark():
     logger.info("POST /extract called")
@@ -184,25 +233,16 @@ def extract_watermark():
         image = load_image(image_file)
         logger.info(f"Image loaded: shape={image.shape}, dtype={image.dtype}")
 
-        # Extract watermark using DCT
+        # Extract and parse the watermark using DCT, reading bits as the headers require
         logger.debug("Extracting watermark using DCT")
-        raw_bits = extract_watermark_dct(image, 1000)  # Extract more bits to be safe
-        logger.info(f"Extracted {len(raw_bits)} bits from image")
-
-        # Parse the bitstream
-        logger.debug("Parsing extracted bitstream")
-        hash_bits, messages, format_type = detect_and_parse_bitstream(raw_bits)
+        reader = open_reader_dct(image)
+        hash_bits, messages, format_type = detect_and_parse_reader(reader, max_bits=1000)
+        logger.info(f"Extracted {reader.position} bits from image")
         logger.info(f"Detected format: {format_type}, found {len(messages)} messages")
 
         # Convert hash bits to hex string
-        if len(hash_bits) == 256:
-            hash_bytes = bytearray()
-            for i in range(0, 256, 8):
-                byte = 0
-                for b in hash_bits[i:i+8]:
-                    byte = (byte << 1) | b
-                hash_bytes.append(byte)
-            image_hash = hash_bytes.hex()
+        if len(hash_bits) > 0:
+            image_hash = BitBuffer(hash_bits).to_hex()
         else:
             image_hash = None
 
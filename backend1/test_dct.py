@@ -3,10 +3,17 @@
 Test script for DCT watermarking engine
 """
 
+import sys
 import numpy as np
 import cv2
 from core.dct_engine import DCTWatermarkEngine
-from utils.bit_utils import string_to_bits, bits_to_string
+from utils.bit_utils import (
+    string_to_bits,
+    bits_to_string,
+    prepare_bitstream_with_hash_and_messages,
+    detect_and_parse_bitstream,
+    detect_and_parse_reader,
+)
 from utils.logger import setup_logger
 
 logger = setup_logger(__name__)
@@ -113,30 +120,161 @@ def test_compression_resistance():
         logger.error("❌ Compression resistance test FAILED: Not enough bits extracted!")
         return False
 
+def test_lazy_reader():
+    """Test that header-driven lazy extraction matches a fixed 1000-bit read"""
+    logger.info("Testing lazy header-driven extraction...")
+    
+    test_image = create_test_image(512, 512)
+    engine = DCTWatermarkEngine()
+    bitstream = prepare_bitstream_with_hash_and_messages(test_image, ["first", "second"])
+    watermarked_image = engine.embed_watermark(test_image, bitstream)
+    
+    for name, image in (("watermarked", watermarked_image), ("unmarked", test_image)):
+        reader = engine.open_reader(image)
+        lazy = detect_and_parse_reader(reader, max_bits=1000)
+        eager = detect_and_parse_bitstream(engine.extract_watermark(image, 1000))
+        logger.info(f"{name}: read {reader.position} bits, found {lazy[1]}")
+        if lazy != eager or reader.position >= 1000:
+            logger.error(f"❌ Lazy extraction test FAILED for the {name} image!")
+            return False
+    
+    logger.info("✅ Lazy extraction test PASSED!")
+    return True
+
+def psnr(original, distorted):
+    """Peak signal-to-noise ratio in dB between two uint8 images"""
+    mse = np.mean((original.astype(np.float64) - distorted) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+def test_float32_parity():
+    """Test that the float32 block transforms match float64 in BER and PSNR"""
+    logger.info("Testing float32 transform parity...")
+    
+    test_image = create_test_image(512, 512)
+    message_bits = string_to_bits("float32 parity check")
+    
+    results = {}
+    for dtype in ('float64', 'float32'):
+        engine = DCTWatermarkEngine(dtype=dtype, track_memory=True)
+        watermarked_image = engine.embed_watermark(test_image, message_bits)
+        peak = engine.last_peak_bytes
+        extracted_bits = engine.extract_watermark(watermarked_image, len(message_bits))
+        ber = sum(a != b for a, b in zip(message_bits, extracted_bits)) / len(message_bits)
+        results[dtype] = (ber, psnr(test_image, watermarked_image), peak)
+        logger.info(f"{dtype}: BER {ber:.4f}, PSNR {results[dtype][1]:.2f} dB, embed peak {peak / 2**20:.1f} MiB")
+    
+    (ber64, psnr64, peak64), (ber32, psnr32, peak32) = results['float64'], results['float32']
+    if ber32 > ber64 or abs(psnr32 - psnr64) > 0.5 or peak32 >= peak64:
+        logger.error("❌ float32 parity test FAILED!")
+        return False
+    
+    logger.info("✅ float32 parity test PASSED!")
+    return True
+
+def test_batch_api():
+    """Test that batched embedding and extraction match per-image calls for mixed shapes"""
+    logger.info("Testing batch API...")
+    
+    images = [create_test_image(256, 256), create_test_image(384, 200), create_test_image(256, 256)]
+    bitstreams = [string_to_bits(message) for message in ("first", "second image", "third")]
+    engine = DCTWatermarkEngine()
+    
+    batch = engine.embed_batch(images, bitstreams)
+    single = [engine.embed_watermark(image, bits) for image, bits in zip(images, bitstreams)]
+    extracted = engine.extract_batch(batch, 100)
+    
+    same_images = all(np.array_equal(a, b) for a, b in zip(batch, single))
+    same_bits = extracted == [engine.extract_watermark(image, 100) for image in batch]
+    recovered = all(bits[:len(stream)] == stream for bits, stream in zip(extracted, bitstreams))
+    logger.info(f"Images identical {same_images}, bits identical {same_bits}, recovered {recovered}")
+    if not (same_images and same_bits and recovered):
+        logger.error("❌ Batch API test FAILED!")
+        return False
+    
+    logger.info("✅ Batch API test PASSED!")
+    return True
+
+def test_partial_blocks():
+    """Test that rows and columns past the last full block keep their pixels"""
+    logger.info("Testing partial edge blocks...")
+    
+    image = create_test_image(301, 203)
+    engine = DCTWatermarkEngine(color_pipeline='luma_delta')
+    watermarked = engine.embed_watermark(image, string_to_bits("edge strips"))
+    
+    height, width = (image.shape[0] // 8) * 8, (image.shape[1] // 8) * 8
+    untouched = np.array_equal(watermarked[height:], image[height:]) and np.array_equal(watermarked[:, width:], image[:, width:])
+    logger.info(f"Edge strips untouched: {untouched}")
+    if not untouched:
+        logger.error("❌ Partial block test FAILED!")
+        return False
+    
+    logger.info("✅ Partial block test PASSED!")
+    return True
+
+def test_rank_one_embed():
+    """Test that the rank-one block update matches a full forward and inverse DCT"""
+    logger.info("Testing rank-one embedding against the full DCT...")
+    
+    from scipy.fft import dctn, idctn
+    rng = np.random.default_rng(0)
+    blocks = rng.integers(0, 256, (500, 8, 8)).astype(np.float64)
+    bits = rng.integers(0, 2, 500)
+    engine = DCTWatermarkEngine()
+    
+    dct_blocks = dctn(blocks, axes=(-2, -1))
+    magnitude = np.abs(dct_blocks[:, 4, 4]) + engine.alpha
+    dct_blocks[:, 4, 4] = np.where(bits == 1, magnitude, -magnitude)
+    expected = np.clip(idctn(dct_blocks, axes=(-2, -1)), 0, 255)
+    
+    max_error = np.abs(engine._embed_blocks(blocks, bits) - expected).max()
+    logger.info(f"Max difference from the full DCT path: {max_error:.2e}")
+    if max_error > 1e-9:
+        logger.error("❌ Rank-one embedding test FAILED!")
+        return False
+    
+    logger.info("✅ Rank-one embedding test PASSED!")
+    return True
+
+def run_test(test):
+    """Run one test, counting an exception as a failure so the rest of the suite still runs"""
+    try:
+        return test()
+    except Exception:
+        logger.exception(f"❌ {test.__name__} raised an exception")
+        return False
+
 def main():
     """Run all tests"""
     logger.info("=" * 50)
     logger.info("DCT Watermarking Test Suite")
     logger.info("=" * 50)
     
-    # Test 1: Basic functionality
-    test1_passed = test_dct_watermarking()
-    
-    # Test 2: Compression resistance
-    test2_passed = test_compression_resistance()
+    tests = [
+        ("Basic Functionality", test_dct_watermarking),
+        ("Compression Resistance", test_compression_resistance),
+        ("Lazy Extraction", test_lazy_reader),
+        ("float32 Parity", test_float32_parity),
+        ("Batch API", test_batch_api),
+        ("Partial Blocks", test_partial_blocks),
+        ("Rank-one Embedding", test_rank_one_embed),
+    ]
+    results = [(name, run_test(test)) for name, test in tests]
     
     # Summary
     logger.info("=" * 50)
     logger.info("Test Results Summary:")
-    logger.info(f"Basic Functionality: {'✅ PASSED' if test1_passed else '❌ FAILED'}")
-    logger.info(f"Compression Resistance: {'✅ PASSED' if test2_passed else '❌ FAILED'}")
+    for name, passed in results:
+        logger.info(f"{name}: {'✅ PASSED' if passed else '❌ FAILED'}")
     
-    if test1_passed and test2_passed:
+    all_passed = all(passed for _, passed in results)
+    if all_passed:
         logger.info("🎉 All tests PASSED! DCT watermarking is working correctly.")
     else:
         logger.error("💥 Some tests FAILED! Please check the implementation.")
     
     logger.info("=" * 50)
+    return all_passed
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    sys.exit(0 if main() else 1) 
\ No newline at end of file
@@ -0,0 +1,77 @@
+import threading
+from collections import OrderedDict
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+class EmbeddingPlan:
+    """
+    Precomputed robust coefficient positions for one image geometry
+    - Index arrays are shared between requests and therefore read-only
+    - Capacity is the exact number of robust positions for the geometry
+    - bases holds the ((row approx, row detail), (col approx, col detail))
+      basis LUTs used by sparse mode, or None when the geometry needs the
+      full transform
+    """
+
+    def __init__(self, key, subband_index, rows, cols, bases=None):
+        self.key = key
+        for array in (subband_index, rows, cols):
+            array.setflags(write=False)
+        self.positions = (subband_index, rows, cols)
+        self.capacity = len(rows)
+        self.bases = bases
+
+class PlanCache:
+    """
+    Process-wide bounded LRU cache of embedding plans
+    - Keyed by (Y shape, wavelet, level, seed, layout)
+    - Safe to share between request threads
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """Return the plan for key, calling build(key) to create it on a miss"""
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                self.hits += 1
+                return plan
+            self.misses += 1
+
+        # Build outside the lock; a concurrent miss for the same key just builds twice
+        plan = build(key)
+        with self._lock:
+            self._plans[key] = plan
+            self._plans.move_to_end(key)
+            while len(self._plans) > self.maxsize:
+                evicted_key, _ = self._plans.popitem(last=False)
+                logger.debug(f"Evicted embedding plan {evicted_key}")
+        logger.debug(f"Built embedding plan {key}: capacity={plan.capacity}")
+        return plan
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._plans),
+                "maxsize": self.maxsize,
+            }
+
+    def clear(self):
+        """Drop all plans and reset the counters"""
+        with self._lock:
+            self._plans.clear()
+            self.hits = 0
+            self.misses = 0
+
+plan_cache = PlanCache()
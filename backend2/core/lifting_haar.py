@@ -0,0 +1,89 @@
+import numpy as np
+
+class LiftingCoefficients(list):
+    """
+    pywt.wavedec2-style coefficient list, [LL, (LH, HL, HH) coarsest, ..., (LH, HL, HH) finest],
+    whose arrays are strided integer views into one shared lifting buffer
+    - Writing into a subband writes into buffer, so waverec2 sees the change
+    - shape is the (..., height, width) of the planes before edge padding
+    """
+
+    def __init__(self, subbands, buffer, level, shape):
+        super().__init__(subbands)
+        self.buffer = buffer
+        self.level = level
+        self.shape = shape
+
+def _split(view, axis):
+    """Even and odd samples along axis (the buffer is padded so both have the same length)"""
+    even = view[(slice(None),) * (view.ndim + axis) + (slice(0, None, 2),)]
+    odd = view[(slice(None),) * (view.ndim + axis) + (slice(1, None, 2),)]
+    return even, odd
+
+def _lift(view, axis):
+    """Integer Haar lifting step in place: odd becomes b - a, even becomes a + floor((b - a) / 2)"""
+    even, odd = _split(view, axis)
+    odd -= even
+    even += odd >> 1
+
+def _unlift(view, axis):
+    """Exact inverse of _lift"""
+    even, odd = _split(view, axis)
+    even -= odd >> 1
+    odd += even
+
+def forward_lifting(planes, level, dtype=np.int16):
+    """
+    Multi-level 2-D integer Haar transform of the trailing two axes of planes
+
+    The planes are edge-padded to a multiple of 2**level and copied into an
+    integer buffer, which is then lifted in place: after level k, the view
+    buffer[..., ::2**k, ::2**k] holds the approximation and the samples
+    between hold the details (the usual in-place lifting layout).
+
+    int16 holds 8-bit luma with room for embedding; use int32 for larger
+    coefficient changes.
+    """
+    step = 2 ** level
+    height, width = planes.shape[-2:]
+    padding = [(0, 0)] * (planes.ndim - 2) + [(0, -height % step), (0, -width % step)]
+    buffer = np.pad(planes, padding, mode='edge').astype(dtype)
+    for k in range(level):
+        view = buffer[..., ::2 ** k, ::2 ** k]
+        _lift(view, -2)
+        _lift(view, -1)
+    return buffer
+
+def inverse_lifting(buffer, level):
+    """Undo forward_lifting in place; returns buffer, still padded"""
+    for k in reversed(range(level)):
+        view = buffer[..., ::2 ** k, ::2 ** k]
+        _unlift(view, -1)
+        _unlift(view, -2)
+    return buffer
+
+def subband_views(buffer, level):
+    """
+    Subbands of a lifted buffer in pywt.wavedec2 order, as views
+    LH is the detail along rows (pywt's cH), HL the detail along columns (cV)
+    """
+    step = 2 ** level
+    subbands = [buffer[..., ::step, ::step]]
+    for k in reversed(range(level)):
+        view = buffer[..., ::2 ** k, ::2 ** k]
+        subbands.append((view[..., 1::2, ::2], view[..., ::2, 1::2], view[..., 1::2, 1::2]))
+    return subbands
+
+def wavedec2(planes, level, dtype=np.int16):
+    """Integer Haar decomposition with a pywt.wavedec2-like result (see LiftingCoefficients)"""
+    buffer = forward_lifting(planes, level, dtype)
+    return LiftingCoefficients(subband_views(buffer, level), buffer, level, planes.shape)
+
+def waverec2(coeffs):
+    """
+    Reconstruct the planes from LiftingCoefficients, cropped back to their original size
+    Runs in place on the shared buffer, so the subband views are spent afterwards
+    """
+    buffer = inverse_lifting(coeffs.buffer, coeffs.level)
+    height, width = coeffs.shape[-2:]
+    return buffer[..., :height, :width]
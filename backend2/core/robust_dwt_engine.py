@@ -1,8 +1,18 @@
 import numpy as np
 import cv2
 import pywt
+from core import lifting_haar
+from core.embedding_plan import EmbeddingPlan, plan_cache
+from core.tiling import tile_halo, plan_tiles, bucket_positions, neighbour_indices
+from core.wavelet_basis import get_axis_basis, gather_patches, select_vectors, reconstructs_in_place
+from utils.color_pipeline import COLOR_PIPELINES, extract_luma, rgb_to_luma, apply_luma_delta
+from utils.image_utils import group_by_shape
 from utils.logger import setup_logger
+from utils.memory_utils import resolve_dtype, reports_peak_memory
+import os
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 logger = setup_logger(__name__)
 
@@ -14,7 +24,20 @@ class RobustDWTWatermarkEngine:
     - Better than LSB approach with proper coefficient selection
     """
     
-    def __init__(self, wavelet='haar', level=2, alpha=15.0, seed=42):
+    # Coefficient layout: stride-4 lattice over LH then HL of the coarsest level
+    LAYOUT = 'lh_hl_stride4'
+    MODES = ('full', 'sparse', 'tiled')
+    TRANSFORMS = ('pywt', 'lifting')
+    # In float32, coefficients within this of zero read as 0, absorbing its
+    # transform round-off (~1e-5) so it reads the same bits as float64;
+    # float64 keeps the exact > 0 comparison
+    FLOAT32_ZERO_TOLERANCE = 1e-3
+    # Stacked batch planes are capped at this many bytes; larger stacks fall
+    # out of cache and transform slower than image-by-image calls
+    BATCH_BYTES = 1 << 20
+    
+    def __init__(self, wavelet='haar', level=2, alpha=15.0, seed=42, mode='full', color_pipeline='ycrcb',
+                 dtype='float64', track_memory=False, tile_size=1024, workers=None, transform='pywt'):
         """
         Initialize DWT watermarking engine
         
@@ -23,102 +46,250 @@ class RobustDWTWatermarkEngine:
             level: Decomposition level (1-3 recommended)
             alpha: Embedding strength (higher = more robust but more visible)
             seed: Random seed for reproducible embedding
+            mode: 'full' runs the whole wavelet transform; 'sparse' reads and
+                  updates only the pixels under the robust coefficients
+                  (orthogonal wavelets, falls back to 'full' for unsupported
+                  geometries); 'tiled' runs the full transform tile by tile
+                  on a thread pool (falls back to 'full' when the transform
+                  would change the image size)
+            color_pipeline: 'ycrcb' converts to YCrCb and back; 'luma_delta'
+                  computes only Y and adds the luma change to the RGB
+                  channels (see utils.color_pipeline for the tolerance)
+            dtype: 'float64' or 'float32' for the full wavelet transform;
+                  float32 halves the transform's working memory
+            track_memory: Record the peak bytes allocated by each embed or
+                  extract call in last_peak_bytes (uses tracemalloc)
+            tile_size: Tile edge in pixels for 'tiled' mode, rounded up to a
+                  multiple of 2**level
+            workers: Thread pool size for 'tiled' mode (default: CPU count)
+            transform: 'pywt' for the floating-point wavelet transform;
+                  'lifting' for the integer Haar lifting transform in
+                  core.lifting_haar (wavelet='haar' only, not with 'sparse'
+                  mode), which is exactly reversible and faster. Lifting
+                  coefficients are unnormalized integers, so alpha is
+                  rescaled to the same pixel change and rounded
         """
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown mode '{mode}', expected one of {self.MODES}")
+        if color_pipeline not in COLOR_PIPELINES:
+            raise ValueError(f"Unknown color pipeline '{color_pipeline}', expected one of {COLOR_PIPELINES}")
+        if transform not in self.TRANSFORMS:
+            raise ValueError(f"Unknown transform '{transform}', expected one of {self.TRANSFORMS}")
+        if transform == 'lifting' and (wavelet != 'haar' or mode == 'sparse'):
+            raise ValueError(f"The lifting transform needs wavelet='haar' and a non-sparse mode, got {wavelet}/{mode}")
         self.wavelet = wavelet
         self.level = level
         self.alpha = alpha
         self.seed = seed
+        self.mode = mode
+        self.color_pipeline = color_pipeline
+        self.dtype = resolve_dtype(dtype)
+        self._zero_tolerance = self.FLOAT32_ZERO_TOLERANCE if self.dtype == np.float32 else 0.0
+        self.transform = transform
+        # A level-L lifting detail moves pixels 2**(L-1) times as far as an
+        # orthonormal pywt coefficient of the same size
+        self._embed_alpha = alpha if transform == 'pywt' else max(1, round(alpha / 2 ** (level - 1)))
+        self.track_memory = track_memory
+        self.last_peak_bytes = None
+        step = 2 ** level
+        self.tile_size = -(-tile_size // step) * step
+        self.workers = workers or os.cpu_count()
+        self._executor = None
+        self._executor_lock = threading.Lock()
         random.seed(seed)
         
-        logger.info(f"Robust DWT Watermark Engine initialized: wavelet={wavelet}, level={level}, alpha={alpha}")
+        logger.info(f"Robust DWT Watermark Engine initialized: wavelet={wavelet}, level={level}, alpha={alpha}, mode={mode}, dtype={self.dtype}, transform={transform}")
     
     def _get_robust_coefficients(self, coeffs):
         """
         Select robust coefficients for embedding
-        Returns list of (subband, position) tuples
+        Returns (subband_index, rows, cols) index arrays in embedding order
         """
-        robust_positions = []
-        
         # Support multi-level DWT coefficient unpacking
         # For level=2: coeffs = [LL2, (LH2, HL2, HH2), (LH1, HL1, HH1)]
-        if len(coeffs) >= 3 and isinstance(coeffs[1], tuple):
-            # 2-level DWT (default)
-            LL2 = coeffs[0]
-            (LH2, HL2, HH2) = coeffs[1]
-            # Use LH2 and HL2 as robust subbands
-            subbands = [('LH', LH2), ('HL', HL2)]
-        elif len(coeffs) == 2 and isinstance(coeffs[1], tuple):
-            # 1-level DWT
-            LL, (LH, HL, HH) = coeffs
-            subbands = [('LH', LH), ('HL', HL)]
-        else:
-            logger.warning(f"Unexpected DWT coeffs structure: {type(coeffs)}, len={len(coeffs)}")
-            return robust_positions
-
-        for subband_name, subband in subbands:
-            height, width = subband.shape
-            for i in range(0, height, 4):
-                for j in range(0, width, 4):
-                    if i < height and j < width:
-                        robust_positions.append((subband_name, (i, j)))
-        return robust_positions
-    
-    def embed_watermark(self, image, watermark_bits):
+        # For level=1: coeffs = [LL, (LH, HL, HH)]
+        if coeffs is None or len(coeffs) < 2 or not isinstance(coeffs[1], tuple):
+            logger.warning(f"Unexpected DWT coeffs structure: {type(coeffs)}")
+            empty = np.empty(0, dtype=np.intp)
+            return empty, empty, empty
+
+        # Use LH and HL of the coarsest level as robust subbands
+        LH, HL = coeffs[1][0], coeffs[1][1]
+        return self._lattice_positions([LH.shape, HL.shape])
+
+    def _lattice_positions(self, subband_shapes):
         """
-        Embed watermark bits into image using robust DWT
-        
-        Args:
-            image: Input image (RGB)
-            watermark_bits: List of binary values [0, 1, 0, 1, ...]
-        
-        Returns:
-            Watermarked image
+        Enumerate the stride-4 lattice of each subband as index arrays.
+        Positions are ordered subband by subband, row-major within a subband,
+        which is the order bits are written and read in.
         """
-        logger.info(f"Embedding {len(watermark_bits)} bits using robust DWT watermarking")
-        
-        # Convert to YCbCr and work on Y channel
-        ycrcb = cv2.cvtColor(image, cv2.COLOR_RGB2YCrCb)
-        Y, Cr, Cb = cv2.split(ycrcb)
+        subband_index, rows, cols = [], [], []
+        for s, (height, width) in enumerate(subband_shapes):
+            lattice_rows, lattice_cols = np.mgrid[0:height:4, 0:width:4]
+            rows.append(lattice_rows.ravel())
+            cols.append(lattice_cols.ravel())
+            subband_index.append(np.full(lattice_rows.size, s, dtype=np.intp))
+        return np.concatenate(subband_index), np.concatenate(rows), np.concatenate(cols)
+
+    def get_plan(self, shape):
+        """
+        Return the cached embedding plan for a Y plane of the given shape
+        """
+        key = (tuple(shape[:2]), self.wavelet, self.level, self.seed, self.LAYOUT)
+        return plan_cache.get(key, self._build_plan)
+
+    def _build_plan(self, key):
+        """Compute robust positions from the subband shapes, without transforming"""
+        shape = key[0]
+        coarsest = pywt.wavedecn_shapes(shape, self.wavelet, level=self.level)[1]
+        subband_shape = coarsest['da']  # LH and HL share the same shape
+        positions = self._lattice_positions([subband_shape, subband_shape])
         
-        # Apply DWT
-        coeffs = pywt.wavedec2(Y.astype(np.float64), self.wavelet, level=self.level)
+        bases = tuple(
+            (get_axis_basis(length, self.wavelet, self.level, 'a'),
+             get_axis_basis(length, self.wavelet, self.level, 'd'))
+            for length in shape
+        )
+        if any(basis is None for pair in bases for basis in pair):
+            bases = None
+        return EmbeddingPlan(key, *positions, bases=bases)
+
+    def _sparse_vectors(self, plan, count, start=0):
+        """
+        Per-position patch origins and basis vectors for count positions from start
+        Returns ((row_starts, row_analysis, row_synthesis), (col_starts, col_analysis, col_synthesis))
+        """
+        subband_index, rows, cols = (a[start:start + count] for a in plan.positions)
+        (row_approx, row_detail), (col_approx, col_detail) = plan.bases
+        # LH is a detail coefficient along rows and an approximation along columns, HL the reverse
+        is_lh = subband_index == 0
+        return (select_vectors(row_approx, row_detail, rows, is_lh),
+                select_vectors(col_approx, col_detail, cols, ~is_lh))
+
+    def _probe_coefficients(self, plane, vectors):
+        """
+        Evaluate the selected coefficients directly from their luma patches
+        plane is either the Y channel or the RGB image; for RGB only the
+        gathered patches are converted to luma
+        """
+        (row_starts, row_analysis, _), (col_starts, col_analysis, _) = vectors
+        patches, rows, cols = gather_patches(plane, row_starts, col_starts,
+                                             row_analysis.shape[1], col_analysis.shape[1])
+        if patches.ndim == 4:
+            patches = rgb_to_luma(patches)
+        values = np.einsum('np,npq,nq->n', row_analysis, patches.astype(np.float64), col_analysis)
+        return values, rows, cols
+
+    def _embed_sparse(self, Y, plan, watermark_bits):
+        """
+        Embed by adding coefficient deltas times their spatial basis patches onto Y
+        Cost scales with the payload, not the image area
+        """
+        vectors = self._sparse_vectors(plan, len(watermark_bits))
+        values, rows, cols = self._probe_coefficients(Y, vectors)
         
-        # Get robust coefficient positions
-        robust_positions = self._get_robust_coefficients(coeffs)
+        signs = np.where(np.asarray(watermark_bits) == 1, 1.0, -1.0)
+        delta = signs * (np.abs(values) + self.alpha) - values
+        (_, _, row_synthesis), (_, _, col_synthesis) = vectors
+        contributions = delta[:, None, None] * row_synthesis[:, :, None] * col_synthesis[:, None, :]
         
-        if len(robust_positions) < len(watermark_bits):
-            raise ValueError(f"Not enough robust positions: need {len(watermark_bits)}, got {len(robust_positions)}")
+        # LH and HL patches at the same lattice position overlap; sum per pixel
+        pixels, inverse = np.unique((rows * Y.shape[1] + cols).ravel(), return_inverse=True)
+        change = np.bincount(inverse, weights=contributions.ravel())
         
-        # Embed watermark in robust positions
-        for i, (subband, (row, col)) in enumerate(robust_positions):
-            if i >= len(watermark_bits):
-                break
-                
-            bit = watermark_bits[i]
-            
-            # Get the appropriate subband
-            if subband == 'LH':
-                coeff = coeffs[1][0]  # LH subband
-            elif subband == 'HL':
-                coeff = coeffs[1][1]  # HL subband
-            else:
-                continue
-            
-            # Embed bit using quantization
-            current_value = coeff[row, col]
-            
-            if bit == 1:
-                # Force to positive and above threshold
-                coeff[row, col] = abs(current_value) + self.alpha
-            else:
-                # Force to negative or below threshold
-                coeff[row, col] = -abs(current_value) - self.alpha
+        watermarked_Y = Y.copy()
+        watermarked_Y.flat[pixels] = np.clip(np.rint(Y.flat[pixels] + change), 0, 255)
+        return watermarked_Y
+
+    def _embed_bits(self, coeffs, positions, watermark_bits):
+        """Write all bits into the robust positions with one assignment per subband"""
+        subband_index, rows, cols = (a[:len(watermark_bits)] for a in positions)
+        # bit 1 -> +(|c| + alpha), anything else -> -(|c| + alpha)
+        signs = np.where(np.asarray(watermark_bits) == 1, 1.0, -1.0)
+        for s, coeff in enumerate(coeffs[1][:2]):
+            mask = subband_index == s
+            r, c = rows[mask], cols[mask]
+            coeff[r, c] = signs[mask] * (np.abs(coeff[r, c]) + self._embed_alpha)
+
+    def _embed_bits_batch(self, coeffs, positions, bitstreams):
+        """
+        Write one bitstream per plane of a stacked decomposition
+        Bitstreams may differ in length; each uses the leading robust positions
+        """
+        lengths = [len(bits) for bits in bitstreams]
+        plane_index = np.repeat(np.arange(len(bitstreams)), lengths)
+        bit_index = np.concatenate([np.arange(n) for n in lengths])
+        all_bits = np.concatenate([np.asarray(bits, dtype=np.int64).ravel() for bits in bitstreams])
+        subband_index, rows, cols = (a[bit_index] for a in positions)
+        signs = np.where(all_bits == 1, 1.0, -1.0)
+        for s, coeff in enumerate(coeffs[1][:2]):
+            mask = subband_index == s
+            p, r, c = plane_index[mask], rows[mask], cols[mask]
+            coeff[p, r, c] = signs[mask] * (np.abs(coeff[p, r, c]) + self._embed_alpha)
+
+    def _read_values(self, coeffs, positions):
+        """Gather the coefficient values at positions (per plane for a stacked decomposition)"""
+        subband_index, rows, cols = positions
+        values = np.empty(coeffs[1][0].shape[:-2] + (len(rows),), dtype=coeffs[1][0].dtype)
+        for s, coeff in enumerate(coeffs[1][:2]):
+            mask = subband_index == s
+            values[..., mask] = coeff[..., rows[mask], cols[mask]]
+        return values
+
+    def _read_bits(self, coeffs, positions, bit_count):
+        """
+        Read bit_count bits from the robust positions with one comparison
+        For a stacked decomposition this returns one list of bits per plane
+        """
+        return self._values_to_bits(self._read_values(coeffs, tuple(a[:bit_count] for a in positions)))
+
+    def _values_to_bits(self, values):
+        """Positive coefficients read as 1, everything else as 0"""
+        return (values > self._zero_tolerance).astype(np.uint8).tolist()
+    
+    def _split_luma(self, image):
+        """Return (Y, Cr, Cb); the luma-delta pipeline never needs Cr/Cb, so they are None there"""
+        if self.color_pipeline == 'luma_delta':
+            return extract_luma(image), None, None
+        ycrcb = cv2.cvtColor(image, cv2.COLOR_RGB2YCrCb)
+        return cv2.split(ycrcb)
+
+    def _forward_transform(self, planes):
+        """DWT of one plane or a stack of planes (trailing two axes) with the selected transform"""
+        if self.transform == 'lifting':
+            return lifting_haar.wavedec2(planes, self.level)
+        return pywt.wavedec2(np.asarray(planes, dtype=self.dtype), self.wavelet, level=self.level)
+
+    def _inverse_transform(self, coeffs):
+        """
+        Inverse DWT (of one plane or a stack of planes) back to uint8 luma
+        Empties coeffs so the coefficient arrays are released before the cast
+        """
+        if self.transform == 'lifting':
+            # Integer and exact: only the embedded changes can leave 0..255
+            watermarked_Y = lifting_haar.waverec2(coeffs)
+            del coeffs[:]
+            return np.clip(watermarked_Y, 0, 255).astype(np.uint8)
         
-        # Apply inverse DWT
         watermarked_Y = pywt.waverec2(coeffs, self.wavelet)
+        del coeffs[:]
         
+        # float32 round-off turns exact values such as 100 into 99.99998, which
+        # the cast would truncate, so float32 rounds first; float64 keeps the
+        # original truncation and stays bit-identical
+        if self.dtype == np.float32:
+            np.rint(watermarked_Y, out=watermarked_Y)
         # Ensure values are in valid range
-        watermarked_Y = np.clip(watermarked_Y, 0, 255).astype(np.uint8)
+        np.clip(watermarked_Y, 0, 255, out=watermarked_Y)
+        return watermarked_Y.astype(np.uint8)
+
+    def _recombine(self, image, Y, watermarked_Y, Cr, Cb):
+        """Turn the watermarked luma back into an RGB image through the colour pipeline"""
+        if self.color_pipeline == 'luma_delta':
+            if watermarked_Y.shape == Y.shape:
+                return apply_luma_delta(image, Y, watermarked_Y)
+            logger.debug(f"Luma shape changed to {watermarked_Y.shape}, merging through YCrCb")
+            _, Cr, Cb = cv2.split(cv2.cvtColor(image, cv2.COLOR_RGB2YCrCb))
         
         # --- PATCH: Ensure all channels have the same shape before merging ---
         logger.debug(f"Shapes before merge: Y={watermarked_Y.shape}, Cr={Cr.shape}, Cb={Cb.shape}")
@@ -132,11 +303,138 @@ class RobustDWTWatermarkEngine:
         logger.debug(f"Shapes after resize: Y={watermarked_Y.shape}, Cr={Cr.shape}, Cb={Cb.shape}")
         # Merge channels
         merged = cv2.merge([watermarked_Y, Cr, Cb])
-        watermarked_image = cv2.cvtColor(merged, cv2.COLOR_YCrCb2RGB)
+        return cv2.cvtColor(merged, cv2.COLOR_YCrCb2RGB)
+    
+    def _can_tile(self, shape):
+        """Tiles stitch back exactly only when the transform keeps the plane size"""
+        return all(reconstructs_in_place(n, self.wavelet, self.level) for n in shape[:2])
+
+    def _get_executor(self):
+        """Thread pool for tile jobs, created on first use and shared by later calls"""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='dwt-tile')
+            return self._executor
+
+    def _tile_jobs(self, shape, positions, tile_shape=None):
+        """
+        Lay out tiles (square tile_size tiles by default) and bucket positions by tile
+        Returns (tiles, buckets, reach), where reach is how many tiles away a
+        coefficient can still change pixels (1 with a halo, else 0)
+        """
+        halo = tile_halo(self.wavelet, self.level)
+        tile_shape = tuple(max(n, halo) for n in (tile_shape or (self.tile_size, self.tile_size)))
+        tiles, grid = plan_tiles(shape, tile_shape, halo)
+        buckets = bucket_positions(positions[1], positions[2], 2 ** self.level, tile_shape, grid)
+        return tiles, buckets, (1 if halo else 0)
+
+    def _local_positions(self, coeffs, window, positions):
+        """Shift positions into a tile window's decomposition and drop those outside it"""
+        step = 2 ** self.level
+        subband_index, rows, cols = positions
+        rows, cols = rows - window[0] // step, cols - window[2] // step
+        height, width = coeffs[1][0].shape
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        return (subband_index[inside], rows[inside], cols[inside]), inside
+
+    def _embed_window(self, window_Y, window, positions, bits):
+        """Embed the given bits whose coefficients fall inside a tile window; returns the new window luma"""
+        coeffs = self._forward_transform(window_Y)
+        local, inside = self._local_positions(coeffs, window, positions)
+        self._embed_bits(coeffs, local, bits[inside])
+        return self._inverse_transform(coeffs)
+
+    def _read_window(self, window_Y, window, positions):
+        """Read the coefficient values at positions, which must all lie inside the tile window"""
+        coeffs = self._forward_transform(window_Y)
+        local, _ = self._local_positions(coeffs, window, positions)
+        return self._read_values(coeffs, local)
+
+    def _embed_tiled(self, Y, plan, watermark_bits):
+        """
+        Embed with the full transform, run tile by tile on the thread pool
+        
+        Each tile transforms its window (core plus halo), embeds every bit
+        whose coefficient lies in the window and writes back only its core,
+        so tiles never write the same pixels. Tiles no bit can reach are
+        left untouched.
+        """
+        bits = np.asarray(watermark_bits)
+        positions = tuple(a[:len(bits)] for a in plan.positions)
+        tiles, buckets, reach = self._tile_jobs(Y.shape, positions)
+        watermarked_Y = Y.copy()
+        
+        def embed_tile(tile):
+            index = neighbour_indices(buckets, tile.index, reach)
+            if index is None:
+                return
+            wy0, wy1, wx0, wx1 = tile.window
+            tile_Y = self._embed_window(Y[wy0:wy1, wx0:wx1], tile.window, tuple(a[index] for a in positions), bits[index])
+            y0, y1, x0, x1 = tile.core
+            watermarked_Y[y0:y1, x0:x1] = tile_Y[y0 - wy0:y1 - wy0, x0 - wx0:x1 - wx0]
+        
+        list(self._get_executor().map(embed_tile, tiles))
+        logger.debug(f"Tiled embedding: {len(buckets)} of {len(tiles)} tiles hold bits")
+        return watermarked_Y
+
+    def _read_tiled(self, Y, plan, bit_count):
+        """Read the first bit_count coefficient values, transforming only the tiles that hold them"""
+        positions = tuple(a[:bit_count] for a in plan.positions)
+        tiles, buckets, _ = self._tile_jobs(Y.shape, positions)
+        values = np.empty(bit_count, dtype=self.dtype)
+        
+        def read_tile(tile):
+            index = buckets[tile.index]
+            wy0, wy1, wx0, wx1 = tile.window
+            values[index] = self._read_window(Y[wy0:wy1, wx0:wx1], tile.window, tuple(a[index] for a in positions))
+        
+        list(self._get_executor().map(read_tile, [tile for tile in tiles if tile.index in buckets]))
+        return values
+
+    @reports_peak_memory
+    def embed_watermark(self, image, watermark_bits):
+        """
+        Embed watermark bits into image using robust DWT
+        
+        Args:
+            image: Input image (RGB)
+            watermark_bits: List of binary values [0, 1, 0, 1, ...]
+        
+        Returns:
+            Watermarked image
+        """
+        logger.info(f"Embedding {len(watermark_bits)} bits using robust DWT watermarking")
+        
+        Y, Cr, Cb = self._split_luma(image)
+        
+        # Get robust coefficient positions
+        plan = self.get_plan(Y.shape)
+        
+        if plan.capacity < len(watermark_bits):
+            raise ValueError(f"Not enough robust positions: need {len(watermark_bits)}, got {plan.capacity}")
+        
+        if self.mode == 'sparse' and plan.bases is not None:
+            watermarked_Y = self._embed_sparse(Y, plan, watermark_bits)
+        elif self.mode == 'tiled' and self._can_tile(Y.shape):
+            watermarked_Y = self._embed_tiled(Y, plan, watermark_bits)
+        else:
+            if self.mode != 'full':
+                logger.debug(f"{self.mode.capitalize()} embedding unavailable for shape {Y.shape}, using full transform")
+            # Apply DWT
+            coeffs = self._forward_transform(Y)
+            
+            # Embed watermark in robust positions
+            self._embed_bits(coeffs, plan.positions, watermark_bits)
+            
+            # Apply inverse DWT
+            watermarked_Y = self._inverse_transform(coeffs)
+        
+        watermarked_image = self._recombine(image, Y, watermarked_Y, Cr, Cb)
         
         logger.info("Robust DWT watermark embedding completed")
         return watermarked_image
     
+    @reports_peak_memory
     def extract_watermark(self, image, bit_count):
         """
         Extract watermark bits from image
@@ -150,61 +448,291 @@ class RobustDWTWatermarkEngine:
         """
         logger.info(f"Extracting {bit_count} bits using robust DWT watermarking")
         
-        # Convert to YCbCr and work on Y channel
-        ycrcb = cv2.cvtColor(image, cv2.COLOR_RGB2YCrCb)
-        Y, _, _ = cv2.split(ycrcb)
+        # Get robust coefficient positions
+        plan = self.get_plan(image.shape)
         
-        # Apply DWT
-        coeffs = pywt.wavedec2(Y.astype(np.float64), self.wavelet, level=self.level)
+        if plan.capacity < bit_count:
+            logger.warning(f"Not enough robust positions: need {bit_count}, got {plan.capacity}")
+            bit_count = plan.capacity
         
-        # Get robust coefficient positions
-        robust_positions = self._get_robust_coefficients(coeffs)
+        if self.mode == 'sparse' and plan.bases is not None:
+            # Evaluate only the needed coefficients straight from the RGB patches
+            values, _, _ = self._probe_coefficients(image, self._sparse_vectors(plan, bit_count))
+            extracted_bits = self._values_to_bits(values)
+        else:
+            # Work on the Y channel
+            Y = extract_luma(image)
+            
+            if self.mode == 'tiled' and self._can_tile(Y.shape):
+                extracted_bits = self._values_to_bits(self._read_tiled(Y, plan, bit_count))
+            else:
+                # Apply DWT
+                coeffs = self._forward_transform(Y)
+                
+                # Extract watermark from robust positions
+                extracted_bits = self._read_bits(coeffs, plan.positions, bit_count)
         
-        if len(robust_positions) < bit_count:
-            logger.warning(f"Not enough robust positions: need {bit_count}, got {len(robust_positions)}")
-            bit_count = len(robust_positions)
+        logger.info(f"Robust DWT watermark extraction completed: {extracted_bits[:10]}...")
+        return extracted_bits
+    
+    @reports_peak_memory
+    def embed_batch(self, images, bitstreams):
+        """
+        Embed one bitstream into each of several images
         
-        extracted_bits = []
+        Same-shaped images are stacked and go through a single wavelet
+        transform and bit assignment; mixed shapes are split into one
+        sub-batch per shape, and large groups into sub-batches of at most
+        BATCH_BYTES of transform data. Sparse engines embed image by image,
+        since their cost already scales with the payload, not the area.
         
-        # Extract watermark from robust positions
-        for i, (subband, (row, col)) in enumerate(robust_positions):
-            if i >= bit_count:
-                break
-                
-            # Get the appropriate subband
-            if subband == 'LH':
-                coeff = coeffs[1][0]  # LH subband
-            elif subband == 'HL':
-                coeff = coeffs[1][1]  # HL subband
+        Args:
+            images: List of input images (RGB)
+            bitstreams: List of bit lists, one per image
+        
+        Returns:
+            List of watermarked images, in input order
+        """
+        if len(images) != len(bitstreams):
+            raise ValueError(f"Got {len(images)} images but {len(bitstreams)} bitstreams")
+        logger.info(f"Embedding {len(images)} bitstreams using robust DWT watermarking")
+        
+        results = [None] * len(images)
+        for shape, indices in group_by_shape(images, self._batch_pixels()):
+            group = [images[i] for i in indices]
+            watermarked = self._embed_group(group, [bitstreams[i] for i in indices])
+            for i, image in zip(indices, watermarked):
+                results[i] = image
+            logger.debug(f"Embedded sub-batch of {len(indices)} images with shape {shape}")
+        
+        logger.info("Robust DWT batch embedding completed")
+        return results
+
+    def _batch_pixels(self):
+        """Pixels per stacked sub-batch that keep it within BATCH_BYTES"""
+        return self.BATCH_BYTES // self.dtype.itemsize
+
+    def _embed_group(self, images, bitstreams):
+        """Embed into a list of images that all share one shape"""
+        plan = self.get_plan(images[0].shape)
+        longest = max(len(bits) for bits in bitstreams)
+        if plan.capacity < longest:
+            raise ValueError(f"Not enough robust positions: need {longest}, got {plan.capacity}")
+        
+        planes = [self._split_luma(image) for image in images]
+        if self.mode == 'sparse' and plan.bases is not None:
+            watermarked_Y = [self._embed_sparse(Y, plan, bits) for (Y, _, _), bits in zip(planes, bitstreams)]
+        else:
+            stack = np.empty((len(images),) + images[0].shape[:2], dtype=self.dtype)
+            for plane, (Y, _, _) in zip(stack, planes):
+                plane[...] = Y
+            coeffs = self._forward_transform(stack)
+            del stack
+            self._embed_bits_batch(coeffs, plan.positions, bitstreams)
+            watermarked_Y = self._inverse_transform(coeffs)
+        
+        return [self._recombine(image, Y, wY, Cr, Cb)
+                for image, (Y, Cr, Cb), wY in zip(images, planes, watermarked_Y)]
+
+    @reports_peak_memory
+    def extract_batch(self, images, bit_count):
+        """
+        Extract bit_count bits from each of several images
+        Same-shaped images share stacked wavelet transforms, grouped as in embed_batch
+        
+        Returns:
+            List of bit lists, in input order
+        """
+        logger.info(f"Extracting {bit_count} bits from {len(images)} images using robust DWT watermarking")
+        
+        results = [None] * len(images)
+        for shape, indices in group_by_shape(images, self._batch_pixels()):
+            plan = self.get_plan(shape)
+            count = min(bit_count, plan.capacity)
+            if count < bit_count:
+                logger.warning(f"Not enough robust positions: need {bit_count}, got {plan.capacity}")
+            
+            if self.mode == 'sparse' and plan.bases is not None:
+                vectors = self._sparse_vectors(plan, count)
+                bits = [self._values_to_bits(self._probe_coefficients(images[i], vectors)[0]) for i in indices]
             else:
-                continue
+                stack = np.empty((len(indices),) + shape[:2], dtype=self.dtype)
+                for plane, i in zip(stack, indices):
+                    plane[...] = extract_luma(images[i])
+                coeffs = self._forward_transform(stack)
+                del stack
+                bits = self._read_bits(coeffs, plan.positions, count)
             
-            # Extract bit using threshold
-            coeff_value = coeff[row, col]
-            bit = 1 if coeff_value > 0 else 0
-            extracted_bits.append(bit)
+            for i, image_bits in zip(indices, bits):
+                results[i] = image_bits
         
-        logger.info(f"Robust DWT watermark extraction completed: {extracted_bits[:10]}...")
-        return extracted_bits
+        logger.info("Robust DWT batch extraction completed")
+        return results
     
-    def get_max_capacity(self, image):
-        """Calculate maximum number of bits that can be embedded"""
-        height, width = image.shape[:2]
+    @reports_peak_memory
+    def embed_streaming(self, source, sink, watermark_bits, strip_height=256):
+        """
+        Embed into an image that should never be fully loaded, one horizontal strip at a time
+        
+        Each strip reads its rows plus a halo from source, embeds the bits
+        whose coefficients fall in it and writes its own rows to sink, so
+        peak memory is bounded by the strip height rather than the image
+        area. Strips no bit can reach only go through the colour pipeline.
+        The result matches embed_watermark on the whole image within one
+        level (strips see different round-off before the uint8 cast) and
+        carries the same bits.
+        
+        Args:
+            source: (H, W, 3) RGB uint8 array-like read by row slices, e.g.
+                    np.load(path, mmap_mode='r')
+            sink: Writable array-like of the same shape, e.g.
+                  np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=...)
+            watermark_bits: List of binary values
+            strip_height: Rows per strip, rounded up to a multiple of 2**level
+        
+        Returns:
+            sink
+        """
+        logger.info(f"Streaming {len(watermark_bits)} bits into a {source.shape} image in strips of {strip_height} rows")
+        if sink.shape != source.shape:
+            raise ValueError(f"Sink shape {sink.shape} does not match source shape {source.shape}")
+        if not self._can_tile(source.shape):
+            raise ValueError(f"Streaming needs a size the {self.wavelet} transform reconstructs in place, got {source.shape[:2]}")
+        
+        plan = self.get_plan(source.shape)
+        if plan.capacity < len(watermark_bits):
+            raise ValueError(f"Not enough robust positions: need {len(watermark_bits)}, got {plan.capacity}")
+        
+        step = 2 ** self.level
+        strip_shape = (-(-strip_height // step) * step, source.shape[1])
+        bits = np.asarray(watermark_bits)
+        positions = tuple(a[:len(bits)] for a in plan.positions)
+        strips, buckets, reach = self._tile_jobs(source.shape, positions, strip_shape)
+        
+        for strip in strips:
+            wy0, wy1, _, _ = strip.window
+            y0, y1, _, _ = strip.core
+            core = np.asarray(source[y0:y1])
+            Y, Cr, Cb = self._split_luma(core)
+            
+            index = neighbour_indices(buckets, strip.index, reach)
+            if index is None:
+                watermarked_Y = Y
+            else:
+                window_Y = extract_luma(np.asarray(source[wy0:wy1]))
+                window_Y = self._embed_window(window_Y, strip.window, tuple(a[index] for a in positions), bits[index])
+                watermarked_Y = window_Y[y0 - wy0:y1 - wy0]
+            sink[y0:y1] = self._recombine(core, Y, watermarked_Y, Cr, Cb)
+        
+        if hasattr(sink, 'flush'):
+            sink.flush()
+        logger.info(f"Streaming embedding completed: {len(buckets)} of {len(strips)} strips hold bits")
+        return sink
+
+    @reports_peak_memory
+    def extract_streaming(self, source, bit_count, strip_height=256):
+        """
+        Extract bit_count bits from an array-like source, reading only the strips that hold them
+        Counterpart of embed_streaming; same bits as extract_watermark with a full transform
+        """
+        logger.info(f"Streaming extraction of {bit_count} bits from a {source.shape} image")
+        if not self._can_tile(source.shape):
+            raise ValueError(f"Streaming needs a size the {self.wavelet} transform reconstructs in place, got {source.shape[:2]}")
         
-        # Calculate number of robust positions
-        robust_positions = self._get_robust_coefficients(None)  # Dummy call to get count
-        # For simplicity, estimate based on image size
-        estimated_positions = (height // 4) * (width // 4) * 2  # LH and HL subbands
+        plan = self.get_plan(source.shape)
+        if plan.capacity < bit_count:
+            logger.warning(f"Not enough robust positions: need {bit_count}, got {plan.capacity}")
+            bit_count = plan.capacity
         
-        return min(estimated_positions, 1000)  # Cap at 1000 bits for safety
+        step = 2 ** self.level
+        strip_shape = (-(-strip_height // step) * step, source.shape[1])
+        positions = tuple(a[:bit_count] for a in plan.positions)
+        strips, buckets, _ = self._tile_jobs(source.shape, positions, strip_shape)
+        values = np.empty(bit_count, dtype=self.dtype)
+        for strip in strips:
+            index = buckets.get(strip.index)
+            if index is not None:
+                wy0, wy1, _, _ = strip.window
+                window_Y = extract_luma(np.asarray(source[wy0:wy1]))
+                values[index] = self._read_window(window_Y, strip.window, tuple(a[index] for a in positions))
+        
+        return self._values_to_bits(values)
+    
+    def open_reader(self, image):
+        """
+        Open an incremental reader over the watermark bits of image
+        Bits are only evaluated as they are read; see CoefficientBitReader
+        """
+        return CoefficientBitReader(self, image)
+    
+    def get_max_capacity(self, image):
+        """Calculate maximum number of bits that can be embedded"""
+        plan = self.get_plan(image.shape)
+        return min(plan.capacity, 1000)  # Cap at 1000 bits for safety
+
+class CoefficientBitReader:
+    """
+    Reads watermark bits from an image on demand, in embedding order
+    - Sparse engines probe only the coefficients being read
+    - Full engines run the wavelet transform once, on the first read
+    """
+    
+    def __init__(self, engine, image):
+        self.engine = engine
+        self.image = image
+        self.plan = engine.get_plan(image.shape)
+        self.position = 0
+        self._coeffs = None
+    
+    @property
+    def remaining(self):
+        """Number of bits left before the reader runs out of robust positions"""
+        return self.plan.capacity - self.position
+    
+    def read(self, count):
+        """Return the next count bits (fewer if the capacity runs out)"""
+        count = max(0, min(count, self.remaining))
+        if self.engine.mode == 'sparse' and self.plan.bases is not None:
+            vectors = self.engine._sparse_vectors(self.plan, count, start=self.position)
+            values, _, _ = self.engine._probe_coefficients(self.image, vectors)
+            bits = self.engine._values_to_bits(values)
+        else:
+            if self._coeffs is None:
+                Y = extract_luma(self.image)
+                self._coeffs = self.engine._forward_transform(Y)
+            positions = tuple(a[self.position:self.position + count] for a in self.plan.positions)
+            bits = self.engine._read_bits(self._coeffs, positions, count)
+        self.position += count
+        return bits
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+def get_engine(wavelet='haar', level=2, alpha=15.0, seed=42, mode='full', color_pipeline='ycrcb', dtype='float64',
+               transform='pywt'):
+    """Return the shared engine for a parameter set, creating it on first use"""
+    key = (wavelet, level, alpha, seed, mode, color_pipeline, np.dtype(dtype).name, transform)
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = RobustDWTWatermarkEngine(wavelet=wavelet, level=level, alpha=alpha, seed=seed,
+                                              mode=mode, color_pipeline=color_pipeline, dtype=dtype,
+                                              transform=transform)
+            _engines[key] = engine
+        return engine
 
 # Convenience functions for easy integration
-def embed_watermark_robust_dwt(image, watermark_bits, alpha=15.0):
+def embed_watermark_robust_dwt(image, watermark_bits, alpha=15.0, mode='full', color_pipeline='ycrcb'):
     """Simple function to embed watermark using robust DWT"""
-    engine = RobustDWTWatermarkEngine(alpha=alpha)
+    engine = get_engine(alpha=alpha, mode=mode, color_pipeline=color_pipeline)
     return engine.embed_watermark(image, watermark_bits)
 
-def extract_watermark_robust_dwt(image, bit_count, alpha=15.0):
+def extract_watermark_robust_dwt(image, bit_count, alpha=15.0, mode='full'):
     """Simple function to extract watermark using robust DWT"""
-    engine = RobustDWTWatermarkEngine(alpha=alpha)
-    return engine.extract_watermark(image, bit_count) 
\ No newline at end of file
+    engine = get_engine(alpha=alpha, mode=mode)
+    return engine.extract_watermark(image, bit_count)
+
+def open_reader_robust_dwt(image, alpha=15.0, mode='full'):
+    """Simple function to open an incremental robust DWT bit reader"""
+    engine = get_engine(alpha=alpha, mode=mode)
+    return engine.open_reader(image)
@@ -0,0 +1,70 @@
+import functools
+import numpy as np
+import pywt
+
+class Tile:
+    """
+    One tile of a luma plane
+    - core is the (y0, y1, x0, x1) pixel box the tile owns in the output
+    - window is the larger box it transforms, the core plus a halo of
+      context on each side (clipped to the image)
+    """
+
+    def __init__(self, index, core, window):
+        self.index = index
+        self.core = core
+        self.window = window
+
+@functools.lru_cache(maxsize=64)
+def tile_halo(wavelet, level):
+    """
+    Pixels of context a tile needs on each side so that every coarsest-level
+    coefficient touching its core matches the full-image transform
+
+    Haar supports are aligned 2**level blocks and never straddle an aligned
+    tile edge, so Haar needs no halo; longer filters need one full
+    coefficient support, rounded up to keep windows aligned.
+    """
+    step = 2 ** level
+    filter_len = pywt.Wavelet(wavelet).dec_len
+    if filter_len == 2:
+        return 0
+    support = (filter_len - 1) * (step - 1) + 1
+    return -(-support // step) * step
+
+def plan_tiles(shape, tile_shape, halo):
+    """
+    Split a (height, width) plane into a row-major grid of tile_shape tiles
+    A tile_shape as wide as the plane gives horizontal strips
+    """
+    height, width = shape[:2]
+    tile_h, tile_w = tile_shape
+    grid_h, grid_w = -(-height // tile_h), -(-width // tile_w)
+    tiles = []
+    for ty in range(grid_h):
+        for tx in range(grid_w):
+            y0, x0 = ty * tile_h, tx * tile_w
+            y1, x1 = min(y0 + tile_h, height), min(x0 + tile_w, width)
+            window = (max(y0 - halo, 0), min(y1 + halo, height), max(x0 - halo, 0), min(x1 + halo, width))
+            tiles.append(Tile((ty, tx), (y0, y1, x0, x1), window))
+    return tiles, (grid_h, grid_w)
+
+def bucket_positions(rows, cols, step, tile_shape, grid_shape):
+    """
+    Assign coarsest-level coefficients to the tile containing their anchor pixel
+    Returns {(ty, tx): indices into rows/cols}
+    """
+    ty = np.minimum(rows * step // tile_shape[0], grid_shape[0] - 1)
+    tx = np.minimum(cols * step // tile_shape[1], grid_shape[1] - 1)
+    keys = ty * grid_shape[1] + tx
+    order = np.argsort(keys, kind='stable')
+    unique, starts = np.unique(keys[order], return_index=True)
+    groups = np.split(order, starts[1:])
+    return {divmod(int(key), grid_shape[1]): group for key, group in zip(unique, groups)}
+
+def neighbour_indices(buckets, index, reach):
+    """Concatenated bucket entries of the tiles within reach of index (None if there are none)"""
+    ty, tx = index
+    near = [buckets[(ty + dy, tx + dx)] for dy in range(-reach, reach + 1) for dx in range(-reach, reach + 1)
+            if (ty + dy, tx + dx) in buckets]
+    return np.concatenate(near) if near else None
@@ -0,0 +1,109 @@
+import functools
+import numpy as np
+import pywt
+
+class AxisBasis:
+    """
+    Analysis and synthesis vectors of the coarsest-level coefficients along one axis
+    - Coefficient k reads and writes samples starts[k] .. starts[k] + width
+    - analysis[k] gives the coefficient as a dot product with those samples
+    - synthesis[k] is the change in those samples per unit change of the coefficient
+    """
+
+    def __init__(self, starts, analysis, synthesis):
+        self.starts = starts
+        self.analysis = analysis
+        self.synthesis = synthesis
+        self.width = analysis.shape[1]
+
+@functools.lru_cache(maxsize=256)
+def reconstructs_in_place(length, wavelet, level):
+    """True when the inverse transform returns exactly length samples (no padding)"""
+    zeros = pywt.wavedec(np.zeros(length), wavelet, level=level)
+    return len(pywt.waverec(zeros, wavelet)) == length
+
+@functools.lru_cache(maxsize=64)
+def get_axis_basis(length, wavelet, level, kind):
+    """
+    Build the basis LUT for one axis of a signal of the given length
+
+    Args:
+        length: Number of samples along the axis
+        wavelet: Orthogonal wavelet name ('haar', 'db2', 'sym4', ...)
+        level: Decomposition level; vectors are for the coarsest level
+        kind: 'a' for the approximation band, 'd' for the detail band
+
+    Returns:
+        AxisBasis, or None when the axis cannot be handled sparsely
+        (non-orthogonal wavelet, or a length the transform does not
+        reconstruct to the same size)
+    """
+    if not pywt.Wavelet(wavelet).orthogonal:
+        return None
+
+    if not reconstructs_in_place(length, wavelet, level):
+        return None
+    zeros = pywt.wavedec(np.zeros(length), wavelet, level=level)
+    band = 0 if kind == 'a' else 1
+    count = len(zeros[band])
+    step = 2 ** level
+
+    # Interior coefficients all share one template, shifted by `step` samples
+    reference = pywt.wavedec(np.zeros(16 * pywt.Wavelet(wavelet).dec_len * step), wavelet, level=level)
+    centre = len(reference[band]) // 2
+    reference[band][centre] = 1.0
+    response = pywt.waverec(reference, wavelet)
+    support = np.flatnonzero(np.abs(response) > 1e-12)
+    template = response[support[0]:support[-1] + 1]
+    offset = support[0] - centre * step
+    width = len(template)
+    if width > length:
+        return None
+
+    starts = np.arange(count) * step + offset
+    analysis = np.tile(template, (count, 1))
+    synthesis = analysis.copy()
+
+    # Coefficients whose template leaves the signal are shaped by the boundary
+    # extension; measure their vectors exactly from impulse responses instead
+    boundary = np.flatnonzero((starts < 0) | (starts + width > length))
+    if len(boundary):
+        impulses = [np.zeros((len(boundary), len(c))) for c in zeros]
+        impulses[band][np.arange(len(boundary)), boundary] = 1.0
+        synthesis_rows = pywt.waverec(impulses, wavelet, axis=-1)[:, :length]
+
+        edge = np.unique(np.concatenate([np.arange(min(width, length)),
+                                         np.arange(max(length - width, 0), length)]))
+        pixel_impulses = np.zeros((len(edge), length))
+        pixel_impulses[np.arange(len(edge)), edge] = 1.0
+        analysis_rows = np.zeros((len(boundary), length))
+        analysis_rows[:, edge] = pywt.wavedec(pixel_impulses, wavelet, level=level, axis=-1)[band][:, boundary].T
+
+        starts[boundary] = np.clip(starts[boundary], 0, length - width)
+        window = starts[boundary, None] + np.arange(width)
+        rows = np.arange(len(boundary))[:, None]
+        analysis[boundary] = analysis_rows[rows, window]
+        synthesis[boundary] = synthesis_rows[rows, window]
+
+    # Snap to 12 decimals so haar vectors are exact binary fractions (+-0.25 at level 2)
+    analysis, synthesis = np.round(analysis, 12), np.round(synthesis, 12)
+    for array in (starts, analysis, synthesis):
+        array.setflags(write=False)
+    return AxisBasis(starts, analysis, synthesis)
+
+def gather_patches(plane, row_starts, col_starts, height, width):
+    """Gather one (height, width) patch of plane per (row_start, col_start) pair"""
+    rows = row_starts[:, None, None] + np.arange(height)[None, :, None]
+    cols = col_starts[:, None, None] + np.arange(width)[None, None, :]
+    return plane[rows, cols], rows, cols
+
+def select_vectors(approx, detail, indices, use_detail):
+    """
+    Pick per-coefficient starts and vectors from the approximation or detail LUT
+    Returns (starts, analysis, synthesis) for each index
+    """
+    pick = use_detail[:, None]
+    starts = np.where(use_detail, detail.starts[indices], approx.starts[indices])
+    analysis = np.where(pick, detail.analysis[indices], approx.analysis[indices])
+    synthesis = np.where(pick, detail.synthesis[indices], approx.synthesis[indices])
+    return starts, analysis, synthesis
@@ -1,9 +1,13 @@
 import os
+import json
 import uuid
+import mimetypes
 import logging
-from flask import Blueprint, request, jsonify
-from utils.image_utils import load_image, save_image, image_to_base64
+from flask import Blueprint, Response, request, jsonify, send_from_directory
+from werkzeug.security import safe_join
+from utils.image_utils import load_image, ImageArtifact
 from utils.bit_utils import (
+    BitBuffer,
     string_to_bits,
     bits_to_string,
     int_to_bits,
@@ -11,13 +15,15 @@ from utils.bit_utils import (
     get_signature_bits,
     prepare_bitstream_with_headers,
     image_to_sha256_bits,
-    prepare_bitstream_with_hash_and_messages,
+    prepare_bitstream_v3,
     parse_bitstream_with_hash_and_messages,
-    detect_and_parse_bitstream,
+    detect_and_parse_reader,
 )
 import zlib
-from core.robust_dwt_engine import embed_watermark_robust_dwt, extract_watermark_robust_dwt
+from core.robust_dwt_engine import embed_watermark_robust_dwt, open_reader_robust_dwt
+from core.embedding_plan import plan_cache
 from utils.logger import setup_logger
+from utils.pipeline import Pipeline
 import time
 from datetime import datetime
 
@@ -33,6 +39,100 @@ WATERMARKED_FOLDER = os.path.join(UPLOAD_FOLDER, "watermarked")
 os.makedirs(ORIGINAL_FOLDER, exist_ok=True)
 os.makedirs(WATERMARKED_FOLDER, exist_ok=True)
 
+RESPONSE_FORMATS = ('base64', 'url', 'binary', 'preview')
+PREVIEW_EXT = '.jpg'  # Displayable everywhere; WebP is also supported by ImageArtifact.preview
+FILE_MAX_AGE = 24 * 3600  # Stored files never change: every request gets new file names
+
+def requested_format():
+    """Response format of a /watermark request (form field or query argument), None if unknown"""
+    response_format = request.form.get("format", request.args.get("format", "base64"))
+    return response_format if response_format in RESPONSE_FORMATS else None
+
+def image_response(response_format, artifact, filename, metadata, status=200):
+    """
+    Build a /watermark response in the requested format
+    - base64: metadata JSON with the image inline under "image" (the default)
+    - url: metadata JSON only; the image is fetched from "image_url" (/files/<name>)
+    - binary: the image bytes, with the metadata JSON in an X-Watermark-Metadata header
+    - preview: metadata JSON with a downscaled JPEG inline under "preview" (tens of
+      kilobytes, for display only); the full image is fetched from "image_url"
+    """
+    metadata = dict(metadata, image_url=f"/files/{filename}")
+    if response_format == "binary":
+        response = Response(artifact.data, status=status, mimetype=mimetypes.guess_type(filename)[0])
+        response.headers["Content-Disposition"] = f'inline; filename="{filename}"'
+        response.headers["X-Watermark-Metadata"] = json.dumps(metadata)
+        response.headers["Access-Control-Expose-Headers"] = "X-Watermark-Metadata"
+        return response
+    if response_format == "base64":
+        metadata["image"] = artifact.to_base64()
+    elif response_format == "preview":
+        preview = artifact.preview(ext=PREVIEW_EXT)
+        metadata["preview"] = preview.to_base64()
+        metadata["preview_type"] = mimetypes.guess_type(f"preview{PREVIEW_EXT}")[0]
+    return jsonify(metadata), status
+
+def probe_parent(image):
+    """
+    Try to extract an existing hash and messages for chaining.
+    Returns (parent_hash, parent_hash_extracted, existing_messages), with the zero hash if there is none.
+    """
+    logger.debug("Attempting to extract existing hash and messages for appending support")
+    parent_hash = '00' * 32  # Default to zero hash
+    parent_hash_extracted = False
+    existing_messages = []
+    try:
+        # Try to extract existing watermark using robust DWT, reading only as far as the headers allow
+        reader = open_reader_robust_dwt(image, mode='sparse')
+        hash_bits, existing_messages, format_type = detect_and_parse_reader(reader, max_bits=1000)
+        logger.debug(f"Read {reader.position} bits from image for parent hash extraction.")
+        logger.debug(f"Detected format: {format_type}, found {len(existing_messages)} existing messages.")
+        
+        if format_type in ('hash_based', 'v3') and len(hash_bits) > 0:
+            # Compute parent hash from extracted hash_bits (a prefix for truncated v3 hashes)
+            parent_hash = BitBuffer(hash_bits).to_hex()
+            parent_hash_extracted = True
+            logger.info(f"Extracted parent hash from image: {parent_hash}")
+        else:
+            logger.info(f"Legacy format detected or no hash available. Using zero hash.")
+    except Exception as e:
+        logger.warning(f"No valid watermark found in image for chaining. Using zero hash. Details: {e}")
+    return parent_hash, parent_hash_extracted, existing_messages
+
+def check_file_chain(hash_original, probe_parent):
+    """File-level validation: an extracted parent hash should prefix the hash of the uploaded file"""
+    parent_hash, parent_hash_extracted, _ = probe_parent
+    if parent_hash_extracted:
+        if hash_original.startswith(parent_hash):
+            logger.info("File-level chain intact: parent hash matches uploaded image hash.")
+        else:
+            logger.warning(f"File-level chain broken: parent hash ({parent_hash}) does not match uploaded image hash ({hash_original}).")
+    else:
+        logger.info("No parent hash extracted; treating as genesis watermark.")
+
+def embed_messages(image, existing_messages, message):
+    """Append message to the existing ones and embed them all; returns (watermarked_image, all_messages)"""
+    all_messages = existing_messages + [message]
+    logger.info(f"Total messages to embed: {len(all_messages)}")
+
+    # Prepare bitstream: compact v3 frame with a truncated SHA256 and varint-framed, optionally compressed messages
+    logger.debug("Preparing v3 bitstream with truncated SHA256 hash and multi-message framing")
+    combined_stream = prepare_bitstream_v3(image, all_messages, engine='robust_dwt')
+    combined_length = len(combined_stream)
+    logger.info(f"Combined bitstream length: {combined_length} bits")
+
+    # Embed into image using robust DWT
+    logger.debug("Embedding combined bitstream into image via robust DWT")
+    watermarked_image = embed_watermark_robust_dwt(image, combined_stream, mode='sparse')
+    logger.info("Robust DWT embedding complete")
+    return watermarked_image, all_messages
+
+def save_as(artifact, path, label):
+    logger.debug(f"Saving {label} image to {path}")
+    artifact.save(path)
+    logger.info(f"{label.capitalize()} image saved successfully")
+    return path
+
 @watermark_bp.route("/watermark", methods=["POST"])
 def watermark_image():
     logger.info("POST /watermark called")
@@ -48,10 +148,15 @@ def watermark_image():
             return jsonify({"error": "Message is required."}), 400
         logger.debug(f"Received file: filename={image_file.filename}, content_type={image_file.content_type}")
         logger.debug(f"Received message of length {len(message)} characters")
+        response_format = requested_format()
+        if response_format is None:
+            logger.error("Unknown response format requested")
+            return jsonify({"error": f"Unknown format. Expected one of {list(RESPONSE_FORMATS)}."}), 400
 
-        # Load image
+        # Load image, keeping the uploaded bytes as the stored original
         logger.debug("Loading original image from uploaded file")
-        image = load_image(image_file)
+        original = ImageArtifact.from_upload(image_file)
+        image = original.array
         logger.info(f"Original image loaded: shape={image.shape}, dtype={image.dtype}")
         
         # Check minimum image size for DWT watermarking
@@ -62,96 +167,40 @@ def watermark_image():
                 "error": f"Image too small. Minimum size required: {min_size}x{min_size} pixels. Your image: {width}x{height} pixels."
             }), 400
 
-        # Try to extract existing hash and messages for chaining
-        logger.debug("Attempting to extract existing hash and messages for appending support")
-        parent_hash = '00' * 32  # Default to zero hash
-        parent_hash_extracted = False
-        existing_messages = []
-        try:
-            # Try to extract existing watermark using robust DWT
-            raw_bits = extract_watermark_robust_dwt(image, 1000)  # Extract more bits to be safe
-            logger.debug(f"Extracted {len(raw_bits)} bits from image for parent hash extraction.")
-            hash_bits, existing_messages, format_type = detect_and_parse_bitstream(raw_bits)
-            logger.debug(f"Detected format: {format_type}, found {len(existing_messages)} existing messages.")
-            
-            if format_type == 'hash_based' and len(hash_bits) == 256:
-                # Compute parent hash from extracted hash_bits
-                parent_hash_bytes = bytearray()
-                for i in range(0, 256, 8):
-                    byte = 0
-                    for b in hash_bits[i:i+8]:
-                        byte = (byte << 1) | b
-                    parent_hash_bytes.append(byte)
-                parent_hash = parent_hash_bytes.hex()
-                parent_hash_extracted = True
-                logger.info(f"Extracted parent hash from image: {parent_hash}")
-            else:
-                logger.info(f"Legacy format detected or no hash available. Using zero hash.")
-        except Exception as e:
-            logger.warning(f"No valid watermark found in image for chaining. Using zero hash. Details: {e}")
-
-        # File-level validation
-        uploaded_image_hash = image_to_sha256_bits(image)
-        logger.info(f"SHA256 of uploaded image: {uploaded_image_hash}")
-        if parent_hash_extracted:
-            if parent_hash == uploaded_image_hash:
-                logger.info("File-level chain intact: parent hash matches uploaded image hash.")
-            else:
-                logger.warning(f"File-level chain broken: parent hash ({parent_hash}) does not match uploaded image hash ({uploaded_image_hash}).")
-        else:
-            logger.info("No parent hash extracted; treating as genesis watermark.")
-
-        # Append new message
-        all_messages = existing_messages + [message]
-        logger.info(f"Total messages to embed: {len(all_messages)}")
-
-        # Prepare bitstream: [256-bit hash][16-bit length][msg bits] ...
-        logger.debug("Preparing bitstream with SHA256 hash and multi-message framing")
-        combined_stream = prepare_bitstream_with_hash_and_messages(image, all_messages)
-        combined_length = len(combined_stream)
-        logger.info(f"Combined bitstream length: {combined_length} bits")
-
-        # Embed into image using robust DWT
-        logger.debug("Embedding combined bitstream into image via robust DWT")
-        watermarked_image = embed_watermark_robust_dwt(image, combined_stream)
-        logger.info("Robust DWT embedding complete")
-
-        # Save original and watermarked images
         uid = uuid.uuid4().hex
-        orig_filename = f"{uid}_orig.png"
+        orig_filename = f"{uid}_orig{original.ext}"
         wm_filename   = f"{uid}_wm.png"
         orig_path = os.path.join(ORIGINAL_FOLDER, orig_filename)
         wm_path   = os.path.join(WATERMARKED_FOLDER, wm_filename)
 
-        logger.debug(f"Saving original image to {orig_path}")
-        save_image(image, orig_path)
-        logger.info("Original image saved successfully")
-
-        logger.debug(f"Saving watermarked image to {wm_path}")
-        save_image(watermarked_image, wm_path)
-        logger.info("Watermarked image saved successfully")
-
-        # Convert images to base64 for response
-        logger.debug("Converting images to base64 for response")
-        orig_base64 = image_to_base64(orig_path)
-        wm_base64 = image_to_base64(wm_path)
-
-        # Compute hashes for response
-        orig_hash_bits = image_to_sha256_bits(image)
-        original_hash = bytearray(int(''.join(str(b) for b in orig_hash_bits[i:i+8]), 2) for i in range(0, 256, 8)).hex()
-        wm_hash_bits = image_to_sha256_bits(watermarked_image)
-        watermarked_hash = bytearray(int(''.join(str(b) for b in wm_hash_bits[i:i+8]), 2) for i in range(0, 256, 8)).hex()
+        # Every stage starts as soon as its inputs are ready: hashing, the parent
+        # probe and saving the original overlap, as do the two hashes and the saves.
+        # The watermarked image is encoded once for both the file and the response
+        pipeline = Pipeline("watermark")
+        pipeline.add("probe_parent", probe_parent, deps=["image"])
+        pipeline.add("hash_original", lambda image: image_to_sha256_bits(image).to_hex(), deps=["image"])
+        pipeline.add("check_file_chain", check_file_chain, deps=["hash_original", "probe_parent"])
+        pipeline.add("save_original", lambda original: save_as(original, orig_path, "original"), deps=["original"], pool="io")
+        pipeline.add("embed", lambda image, probe_parent: embed_messages(image, probe_parent[2], message),
+                     deps=["image", "probe_parent"])
+        pipeline.add("hash_watermarked", lambda embed: image_to_sha256_bits(embed[0]).to_hex(), deps=["embed"])
+        pipeline.add("encode_watermarked", lambda embed: ImageArtifact.from_array(embed[0]), deps=["embed"])
+        pipeline.add("save_watermarked", lambda encode_watermarked: save_as(encode_watermarked, wm_path, "watermarked"),
+                     deps=["encode_watermarked"], pool="io")
+        result = pipeline.run(image=image, original=original)
+        logger.info(f"SHA256 of uploaded image: {result['hash_original']}")
+        logger.info(f"Watermark pipeline stages: {result.summary()}")
+        watermarked_image, all_messages = result["embed"]
 
         # Prepare response to match frontend expectations
         response_data = {
             "success": True,
             "message": "Watermark embedded successfully using robust DWT",
-            "image": wm_base64,  # Frontend expects 'image' field
             "original_filename": orig_filename,
             "watermarked_filename": wm_filename,
-            "original_hash": original_hash,
-            "watermarked_hash": watermarked_hash,
-            "parent_hash": parent_hash,
+            "original_hash": result["hash_original"],
+            "watermarked_hash": result["hash_watermarked"],
+            "parent_hash": result["probe_parent"][0],
             "embedded_messages": all_messages,
             "timestamp": datetime.now().isoformat(),
             "algorithm": "Robust DWT",
@@ -162,12 +211,29 @@ def watermark_image():
         }
 
         logger.info("Watermark embedding completed successfully")
-        return jsonify(response_data), 200
+        return image_response(response_format, result["encode_watermarked"], wm_filename, response_data)
 
     except Exception as e:
         logger.exception("Error in watermark_image endpoint")
         return jsonify({"error": str(e)}), 500
 
+@watermark_bp.route("/files/<filename>", methods=["GET"])
+def serve_file(filename):
+    """
+    Stream a stored original or watermarked image
+    conditional=True makes Flask answer If-None-Match (304) and Range (206) from the file's ETag
+    ?download=1 serves it as an attachment, so browsers save it even from another origin
+    """
+    as_attachment = request.args.get("download") == "1"
+    for folder in (WATERMARKED_FOLDER, ORIGINAL_FOLDER):
+        path = safe_join(folder, filename)
+        if path and os.path.isfile(path):
+            logger.debug(f"Serving {path}")
+            return send_from_directory(folder, filename, conditional=True, etag=True, max_age=FILE_MAX_AGE,
+                                       as_attachment=as_attachment)
+    logger.warning(f"Requested file not found: {filename}")
+    return jsonify({"error": "File not found."}), 404
+
 @watermark_bp.route("/extract", methods=["POST"])
 def extract_watermark():
     logger.info("POST /extract called")
@@ -184,25 +250,16 @@ def extract_watermark():
         image = load_image(image_file)
         logger.info(f"Image loaded: shape={image.shape}, dtype={image.dtype}")
 
-        # Extract watermark using robust DWT
+        # Extract and parse the watermark using robust DWT, reading bits as the headers require
         logger.debug("Extracting watermark using robust DWT")
-        raw_bits = extract_watermark_robust_dwt(image, 1000)  # Extract more bits to be safe
-        logger.info(f"Extracted {len(raw_bits)} bits from image")
-
-        # Parse the bitstream
-        logger.debug("Parsing extracted bitstream")
-        hash_bits, messages, format_type = detect_and_parse_bitstream(raw_bits)
+        reader = open_reader_robust_dwt(image, mode='sparse')
+        hash_bits, messages, format_type = detect_and_parse_reader(reader, max_bits=1000)
+        logger.info(f"Extracted {reader.position} bits from image")
         logger.info(f"Detected format: {format_type}, found {len(messages)} messages")
 
         # Convert hash bits to hex string
-        if len(hash_bits) == 256:
-            hash_bytes = bytearray()
-            for i in range(0, 256, 8):
-                byte = 0
-                for b in hash_bits[i:i+8]:
-                    byte = (byte << 1) | b
-                hash_bytes.append(byte)
-            image_hash = hash_bytes.hex()
+        if len(hash_bits) > 0:
+            image_hash = BitBuffer(hash_bits).to_hex()
         else:
             image_hash = None
 
@@ -240,5 +297,6 @@ def health_check():
     return jsonify({
         "status": "healthy",
         "service": "Robust DWT Watermarking API",
+        "plan_cache": plan_cache.stats(),
         "timestamp": datetime.now().isoformat()
     }), 200
@@ -6,9 +6,26 @@ Tests embedding and extraction functionality
 
 import cv2
 import numpy as np
-from core.robust_dwt_engine import RobustDWTWatermarkEngine
-from utils.bit_utils import string_to_bits, bits_to_string
+import pywt
+from core.robust_dwt_engine import RobustDWTWatermarkEngine, get_engine
+from core.embedding_plan import plan_cache
+from utils.pipeline import Pipeline
+from utils.image_utils import ImageArtifact
+from utils.bit_utils import (
+    BitBuffer,
+    string_to_bits,
+    bits_to_string,
+    prepare_bitstream_with_hash_and_messages,
+    detect_and_parse_bitstream,
+    detect_and_parse_reader,
+    iter_parse_bitstream,
+    prepare_bitstream_v3,
+    image_to_sha256_bits,
+)
 import os
+import io
+import sys
+import tempfile
 
 def create_test_image(size=(512, 512)):
     """Create a test image with some texture"""
@@ -154,26 +171,434 @@ def test_capacity():
         except Exception as e:
             print(f"✗ ERROR: {e}")
 
+def test_vectorized_positions():
+    """Test that vectorized embedding matches a per-position reference loop"""
+    print("\n=== Testing Vectorized Coefficient Selection ===")
+    
+    image = create_test_image((300, 260))
+    engine = RobustDWTWatermarkEngine()
+    bits = list(np.random.randint(0, 2, 150))
+    
+    Y = cv2.split(cv2.cvtColor(image, cv2.COLOR_RGB2YCrCb))[0].astype(np.float64)
+    coeffs = pywt.wavedec2(Y, engine.wavelet, level=engine.level)
+    
+    # Reference: walk the stride-4 lattice of LH then HL one position at a time
+    expected = [band.copy() for band in coeffs[1][:2]]
+    reference = [(s, i, j) for s, band in enumerate(expected)
+                 for i in range(0, band.shape[0], 4) for j in range(0, band.shape[1], 4)]
+    for bit, (s, i, j) in zip(bits, reference):
+        value = abs(expected[s][i, j]) + engine.alpha
+        expected[s][i, j] = value if bit == 1 else -value
+    
+    positions = engine._get_robust_coefficients(coeffs)
+    assert len(positions[0]) == len(reference)
+    engine._embed_bits(coeffs, positions, bits)
+    identical = all(np.array_equal(a, b) for a, b in zip(coeffs[1][:2], expected))
+    read_back = engine._read_bits(coeffs, positions, len(bits))
+    
+    assert identical and read_back == bits, "Vectorized path differs from the reference loop"
+    print("✓ SUCCESS: Vectorized path is bit-identical to the reference loop")
+    return True
+
+def test_plan_cache():
+    """Test that embedding plans and engines are reused across calls"""
+    print("\n=== Testing Embedding Plan Cache ===")
+    
+    plan_cache.clear()
+    image = create_test_image()
+    engine = get_engine()
+    assert get_engine() is engine
+    
+    message_bits = string_to_bits("Plan cache")
+    watermarked = engine.embed_watermark(image, message_bits)
+    extracted_bits = engine.extract_watermark(watermarked, len(message_bits))
+    stats = plan_cache.stats()
+    print(f"Plan cache stats: {stats}")
+    
+    assert extracted_bits == message_bits and stats["misses"] == 1 and stats["hits"] == 1, "Plan cache was not reused"
+    print("✓ SUCCESS: Plan built once and reused for extraction")
+    return True
+
+def test_sparse_embedding():
+    """Test that sparse basis-patch embedding matches the full transform"""
+    print("\n=== Testing Sparse Embedding ===")
+    
+    image = create_test_image()
+    message_bits = string_to_bits("Sparse embedding matches the full transform")
+    
+    full_engine = RobustDWTWatermarkEngine(mode='full')
+    sparse_engine = RobustDWTWatermarkEngine(mode='sparse')
+    full = full_engine.embed_watermark(image, message_bits)
+    sparse = sparse_engine.embed_watermark(image, message_bits)
+    
+    max_diff = np.abs(full.astype(np.int16) - sparse.astype(np.int16)).max()
+    extracted_bits = full_engine.extract_watermark(sparse, len(message_bits))
+    print(f"Max pixel difference from full transform: {max_diff}")
+    assert max_diff <= 1, "Sparse embedding drifted from the full transform"
+    assert extracted_bits == message_bits, "Sparse-embedded watermark could not be extracted"
+    print("✓ SUCCESS: Sparse embedding matches the full transform within rounding")
+    return True
+
+def test_sparse_extraction():
+    """Test that sparse coefficient probes read the same bits as the full transform"""
+    print("\n=== Testing Sparse Extraction ===")
+    
+    image = create_test_image()
+    message_bits = string_to_bits("Sparse extraction probe")
+    watermarked = RobustDWTWatermarkEngine().embed_watermark(image, message_bits)
+    
+    # Read only marked coefficients: unmarked ones can be zero, and the sign
+    # of their float64 round-off differs between the two paths
+    bit_count = len(message_bits)
+    full_bits = RobustDWTWatermarkEngine(mode='full').extract_watermark(watermarked, bit_count)
+    sparse_bits = RobustDWTWatermarkEngine(mode='sparse').extract_watermark(watermarked, bit_count)
+    assert sparse_bits == full_bits == message_bits, "Sparse extraction differs from the full transform"
+    print("✓ SUCCESS: Sparse extraction matches the full transform")
+    return True
+
+def test_lazy_reader():
+    """Test that header-driven lazy extraction matches a fixed 1000-bit read"""
+    print("\n=== Testing Lazy Header-Driven Extraction ===")
+    
+    image = create_test_image()
+    engine = RobustDWTWatermarkEngine(mode='sparse')
+    bitstream = prepare_bitstream_with_hash_and_messages(image, ["first", "second"])
+    watermarked = engine.embed_watermark(image, bitstream)
+    
+    for name, candidate in (("watermarked", watermarked), ("unmarked", image)):
+        reader = engine.open_reader(candidate)
+        lazy = detect_and_parse_reader(reader, max_bits=1000)
+        eager = detect_and_parse_bitstream(engine.extract_watermark(candidate, 1000))
+        print(f"{name}: read {reader.position} bits, found {lazy[1]}")
+        assert lazy == eager and reader.position < 1000, f"Lazy extraction differs for the {name} image"
+    
+    print("✓ SUCCESS: Lazy extraction matches and stops early")
+    return True
+
+def test_luma_delta_pipeline():
+    """Test that the luma-delta colour pipeline stays within 1 level of YCrCb and keeps the bits"""
+    print("\n=== Testing Luma-Delta Colour Pipeline ===")
+    
+    image = create_test_image()
+    bits = [1, 0, 1, 1, 0, 0, 1, 0] * 20
+    
+    for mode in RobustDWTWatermarkEngine.MODES:
+        reference = RobustDWTWatermarkEngine(mode=mode).embed_watermark(image, bits)
+        engine = RobustDWTWatermarkEngine(mode=mode, color_pipeline='luma_delta')
+        watermarked = engine.embed_watermark(image, bits)
+        
+        max_diff = np.abs(watermarked.astype(np.int16) - reference).max()
+        errors = sum(a != b for a, b in zip(bits, engine.extract_watermark(watermarked, len(bits))))
+        print(f"{mode}: max difference vs ycrcb {max_diff}, {errors} bit errors")
+        assert max_diff <= 1 and not errors, f"Luma-delta pipeline drifted in {mode} mode"
+    
+    print("✓ SUCCESS: Luma-delta pipeline matches the YCrCb pipeline")
+    return True
+
+def psnr(original, distorted):
+    """Peak signal-to-noise ratio in dB between two uint8 images"""
+    mse = np.mean((original.astype(np.float64) - distorted) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+def test_float32_parity():
+    """Test that the float32 transform matches float64 in BER and PSNR"""
+    print("\n=== Testing float32 Transform Parity ===")
+    
+    image = create_test_image()
+    bits = [1, 0, 1, 1, 0, 0, 1, 0] * 50
+    
+    results = {}
+    for dtype in ('float64', 'float32'):
+        engine = RobustDWTWatermarkEngine(dtype=dtype, track_memory=True)
+        watermarked = engine.embed_watermark(image, bits)
+        peak = engine.last_peak_bytes
+        extracted = engine.extract_watermark(watermarked, len(bits))
+        ber = sum(a != b for a, b in zip(bits, extracted)) / len(bits)
+        results[dtype] = (ber, psnr(image, watermarked), peak)
+        print(f"{dtype}: BER {ber:.4f}, PSNR {results[dtype][1]:.2f} dB, embed peak {peak / 2**20:.1f} MiB")
+    
+    (ber64, psnr64, peak64), (ber32, psnr32, peak32) = results['float64'], results['float32']
+    assert ber32 <= ber64 and abs(psnr32 - psnr64) <= 0.5 and peak32 < peak64, "float32 transform is not on par with float64"
+    print("✓ SUCCESS: float32 transform matches float64 with a lower peak")
+    return True
+
+def test_batch_api():
+    """Test that batched embedding and extraction match per-image calls for mixed shapes"""
+    print("\n=== Testing Batch API ===")
+    
+    images = [create_test_image(), create_test_image((256, 384)), create_test_image(), create_test_image((131, 97))]
+    bitstreams = [string_to_bits(message) for message in ("first", "second image", "third", "4th")]
+    
+    for mode in RobustDWTWatermarkEngine.MODES:
+        engine = RobustDWTWatermarkEngine(mode=mode)
+        batch = engine.embed_batch(images, bitstreams)
+        single = [engine.embed_watermark(image, bits) for image, bits in zip(images, bitstreams)]
+        extracted = engine.extract_batch(batch, 100)
+        
+        same_images = all(np.array_equal(a, b) for a, b in zip(batch, single))
+        same_bits = extracted == [engine.extract_watermark(image, 100) for image in batch]
+        recovered = all(bits[:len(stream)] == stream for bits, stream in zip(extracted, bitstreams))
+        print(f"{mode}: images identical {same_images}, bits identical {same_bits}, recovered {recovered}")
+        assert same_images and same_bits and recovered, f"Batch API differs from per-image calls in {mode} mode"
+    
+    print("✓ SUCCESS: Batch API matches per-image calls")
+    return True
+
+def test_tiled_mode():
+    """Test that tile-parallel embedding and extraction match the full transform"""
+    print("\n=== Testing Tiled Mode ===")
+    
+    image = create_test_image((300, 452))
+    
+    for wavelet in ('haar', 'db4'):
+        full = RobustDWTWatermarkEngine(wavelet=wavelet)
+        tiled = RobustDWTWatermarkEngine(wavelet=wavelet, mode='tiled', tile_size=64, workers=4)
+        bits = [(i * 7 + 3) % 5 % 2 for i in range(full.get_plan(image.shape).capacity)]
+        
+        expected = full.embed_watermark(image, bits)
+        watermarked = tiled.embed_watermark(image, bits)
+        same_bits = tiled.extract_watermark(expected, len(bits)) == full.extract_watermark(expected, len(bits))
+        print(f"{wavelet}: images identical {np.array_equal(expected, watermarked)}, bits identical {same_bits}")
+        assert np.array_equal(expected, watermarked) and same_bits, f"Tiled {wavelet} transform differs from the full transform"
+    
+    print("✓ SUCCESS: Tiled mode matches the full transform")
+    return True
+
+def test_streaming_mode():
+    """Test that strip-by-strip embedding through memory maps matches embedding the whole image within one level"""
+    print("\n=== Testing Streaming Mode ===")
+    
+    import tempfile
+    image = create_test_image((300, 452))
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        source_path = os.path.join(tmp, 'source.npy')
+        np.save(source_path, image)
+        source = np.load(source_path, mmap_mode='r')
+        
+        for wavelet in ('haar', 'db4'):
+            engine = RobustDWTWatermarkEngine(wavelet=wavelet)
+            bits = [(i * 7 + 3) % 5 % 2 for i in range(engine.get_plan(image.shape).capacity // 3)]
+            
+            expected = engine.embed_watermark(image, bits)
+            sink = np.lib.format.open_memmap(os.path.join(tmp, f'{wavelet}.npy'), mode='w+', dtype=np.uint8, shape=image.shape)
+            engine.embed_streaming(source, sink, bits, strip_height=40)
+            same_bits = engine.extract_streaming(sink, len(bits), strip_height=40) == engine.extract_watermark(expected, len(bits))
+            max_diff = np.abs(expected.astype(np.int16) - sink).max()
+            print(f"{wavelet}: max difference {max_diff}, bits identical {same_bits}")
+            assert max_diff <= 1 and same_bits, f"Streaming {wavelet} embedding differs from whole-image embedding"
+            del sink
+    
+    print("✓ SUCCESS: Streaming mode matches whole-image embedding")
+    return True
+
+def test_lifting_transform():
+    """Test that the integer lifting transform is exact and embeds like the pywt path"""
+    print("\n=== Testing Lifting Transform ===")
+    
+    from core import lifting_haar
+    planes = np.random.default_rng(0).integers(0, 256, (3, 61, 90)).astype(np.uint8)
+    exact = np.array_equal(lifting_haar.waverec2(lifting_haar.wavedec2(planes, 3)), planes)
+    print(f"Integer round trip exact: {exact}")
+    
+    image = create_test_image((300, 452))
+    full = RobustDWTWatermarkEngine(transform='lifting')
+    tiled = RobustDWTWatermarkEngine(transform='lifting', mode='tiled', tile_size=64)
+    bits = [(i * 7 + 3) % 5 % 2 for i in range(full.get_plan(image.shape).capacity)]
+    
+    watermarked = full.embed_watermark(image, bits)
+    recovered = full.extract_watermark(watermarked, len(bits)) == bits
+    same_tiles = np.array_equal(watermarked, tiled.embed_watermark(image, bits))
+    quality = psnr(image, watermarked)
+    print(f"Bits recovered {recovered}, tiled identical {same_tiles}, PSNR {quality:.2f} dB")
+    assert exact and recovered and same_tiles and quality > 30, "Lifting transform is inexact or embeds incorrectly"
+    print("✓ SUCCESS: Lifting transform is exact and embeds correctly")
+    return True
+
+def test_bit_buffer():
+    """Test that BitBuffer round-trips bytes and stays compatible with list bitstreams"""
+    print("\n=== Testing BitBuffer ===")
+    
+    message = "watermark ✓"
+    bits = string_to_bits(message)
+    as_list = [int(bit) for byte in message.encode('utf-8') for bit in format(byte, '08b')]
+    checks = {
+        'matches list bits': bits == as_list,
+        'string round trip': bits_to_string(bits) == message and bits_to_string(as_list) == message,
+        'hex round trip': BitBuffer.from_hex(bits.to_hex()) == bits,
+        'slice is a view': np.shares_memory(bits[8:24].bits, bits.bits),
+        'np.array copies': not np.shares_memory(np.array(bits), bits.bits),
+        'np.asarray is a view': np.shares_memory(np.asarray(bits), bits.bits),
+        'list concatenation': ([1, 0] + bits)[:2] == [1, 0] and len(bits + [1]) == len(bits) + 1,
+    }
+    print(checks)
+    assert all(checks.values()), f"BitBuffer checks failed: {[name for name, ok in checks.items() if not ok]}"
+    print("✓ SUCCESS: BitBuffer behaves like a list bitstream")
+    return True
+
+def test_streaming_parser():
+    """Test that the generator parser yields items as soon as their bits are read"""
+    print("\n=== Testing Streaming Parser ===")
+    
+    image = np.full((64, 64, 3), 128, dtype=np.uint8)
+    bitstream = prepare_bitstream_with_hash_and_messages(image, ["first", "second"])
+    consumed = []
+    
+    def source():
+        for bit in bitstream:
+            consumed.append(bit)
+            yield bit
+    
+    parser = iter_parse_bitstream(source())
+    format_item, hash_item, first_item = next(parser), next(parser), next(parser)
+    first_cost = len(consumed)
+    items = list(parser)
+    print(f"First message after {first_cost} of {len(bitstream)} bits")
+    
+    assert format_item == ('format', 'hash_based')
+    assert hash_item[0] == 'hash' and list(hash_item[1]) == list(bitstream[:256])
+    assert first_item == ('message', 'first') and items == [('message', 'second')]
+    assert first_cost == 256 + 16 + len(string_to_bits("first"))
+    assert detect_and_parse_reader(iter(bitstream), max_bits=len(bitstream)) == detect_and_parse_bitstream(bitstream)
+    print("✓ SUCCESS: Streaming parser yields messages incrementally")
+    return True
+
+def test_v3_framing():
+    """Test that v3 frames are smaller than hash_based ones and parse back in every variant"""
+    print("\n=== Testing v3 Framing ===")
+    
+    image = np.full((64, 64, 3), 128, dtype=np.uint8)
+    messages = ["Created by studio A", "Edited by studio B", "Edited by studio B again"]
+    hash_based = prepare_bitstream_with_hash_and_messages(image, messages)
+    for hash_bytes in (0, 16, 32):
+        for compress in (False, True):
+            frame = prepare_bitstream_v3(image, messages, engine='robust_dwt', hash_bytes=hash_bytes, compress=compress)
+            hash_bits, parsed, format_type = detect_and_parse_bitstream(frame)
+            assert format_type == 'v3' and parsed == messages
+            assert hash_bits == image_to_sha256_bits(image)[:8 * hash_bytes]
+            assert detect_and_parse_reader(iter(frame), max_bits=len(frame)) == (hash_bits, parsed, format_type)
+    
+    frame = prepare_bitstream_v3(image, messages, engine='robust_dwt')
+    print(f"v3: {len(frame)} bits, hash_based: {len(hash_based)} bits")
+    assert len(frame) < len(hash_based)
+    assert dict(item for item in iter_parse_bitstream(frame) if item[0] != 'message')['engine'] == 'robust_dwt'
+    
+    # A SHA256 that starts with the v3 magic still parses as hash_based
+    fake = prepare_bitstream_v3(image, [], hash_bytes=32)[:16] + hash_based[16:]
+    assert detect_and_parse_bitstream(fake)[1:] == (messages, 'hash_based')
+    print("✓ SUCCESS: v3 framing round-trips and falls back to hash_based")
+    return True
+
+def test_pipeline():
+    """Test that pipeline stages run after their dependencies and record timings"""
+    print("\n=== Testing Stage Pipeline ===")
+    
+    image = np.full((64, 64, 3), 128, dtype=np.uint8)
+    pipeline = Pipeline("test")
+    pipeline.add("hash", lambda image: image_to_sha256_bits(image).to_hex(), deps=["image"])
+    pipeline.add("bits", lambda image: prepare_bitstream_v3(image, ["pipeline"]), deps=["image"])
+    pipeline.add("parsed", lambda bits: detect_and_parse_bitstream(bits)[1], deps=["bits"], pool="io")
+    result = pipeline.run(image=image)
+    print(f"Stages: {result.summary()}")
+    
+    assert result["parsed"] == ["pipeline"]
+    assert result["hash"] == image_to_sha256_bits(image).to_hex()
+    assert set(result.timings) == {"hash", "bits", "parsed"}
+    assert result.timings["parsed"]["start"] >= result.timings["bits"]["start"] + result.timings["bits"]["seconds"]
+    
+    failing = Pipeline("failing").add("boom", lambda: 1 // 0).add("after", lambda boom: boom, deps=["boom"])
+    try:
+        failing.run()
+        assert False, "stage error was swallowed"
+    except ZeroDivisionError:
+        pass
+    print("✓ SUCCESS: Pipeline respects dependencies and re-raises stage errors")
+    return True
+
+def test_image_artifact():
+    """Test that artifacts encode once, keep uploads verbatim and save the same bytes"""
+    print("\n=== Testing Image Artifacts ===")
+    
+    image = cv2.GaussianBlur(np.random.default_rng(0).integers(0, 256, (64, 64, 3), dtype=np.uint8), (5, 5), 0)
+    jpeg = cv2.imencode('.jpg', image)[1].tobytes()
+    original = ImageArtifact.from_upload(io.BytesIO(jpeg))
+    assert original.data == jpeg and original.ext == '.jpg' and original.array.shape == image.shape
+    
+    encoded = ImageArtifact.from_array(image)
+    assert np.array_equal(cv2.imdecode(np.frombuffer(encoded.data, np.uint8), cv2.IMREAD_COLOR), image)
+    with tempfile.TemporaryDirectory() as folder:
+        path = encoded.save(os.path.join(folder, "image.png"))
+        with open(path, 'rb') as f:
+            assert f.read() == encoded.data
+        assert os.listdir(folder) == ["image.png"]
+    print("✓ SUCCESS: Artifacts reuse one encoded buffer")
+    return True
+
+def test_image_preview():
+    """Test that previews are bounded, keep the aspect ratio and decode as JPEG"""
+    print("\n=== Testing Image Previews ===")
+    
+    image = np.random.default_rng(0).integers(0, 256, (600, 1000, 3), dtype=np.uint8)
+    preview = ImageArtifact.from_array(image).preview(max_edge=256)
+    decoded = cv2.imdecode(np.frombuffer(preview.data, np.uint8), cv2.IMREAD_COLOR)
+    assert preview.ext == '.jpg' and preview.data[:3] == b'\xff\xd8\xff'
+    assert decoded.shape == (154, 256, 3)
+    
+    small = ImageArtifact.from_array(image[:100, :100]).preview(max_edge=256)
+    assert small.array.shape == (100, 100, 3)
+    print(f"✓ SUCCESS: 1000x600 preview is {decoded.shape[1]}x{decoded.shape[0]}, {len(preview.data)} bytes")
+    return True
+
+def run_test(test):
+    """Run one test, counting a failed assertion or an exception as a failure so the rest of the suite still runs"""
+    try:
+        return test()
+    except Exception as e:
+        print(f"✗ FAILED: {test.__name__}: {type(e).__name__}: {e}")
+        return False
+
 def main():
     """Run all tests"""
     print("Robust DWT Watermarking Test Suite")
     print("=" * 50)
     
     # Run tests
-    basic_success = test_basic_embedding()
-    compression_success = test_compression_resistance()
-    test_capacity()
+    tests = [
+        ("Basic embedding/extraction", test_basic_embedding),
+        ("Compression resistance", test_compression_resistance),
+        ("Vectorized positions", test_vectorized_positions),
+        ("Plan cache", test_plan_cache),
+        ("Sparse embedding", test_sparse_embedding),
+        ("Sparse extraction", test_sparse_extraction),
+        ("Lazy reader", test_lazy_reader),
+        ("Luma-delta pipeline", test_luma_delta_pipeline),
+        ("float32 parity", test_float32_parity),
+        ("Batch API", test_batch_api),
+        ("Tiled mode", test_tiled_mode),
+        ("Streaming mode", test_streaming_mode),
+        ("Lifting transform", test_lifting_transform),
+        ("BitBuffer", test_bit_buffer),
+        ("Streaming parser", test_streaming_parser),
+        ("v3 framing", test_v3_framing),
+        ("Pipeline", test_pipeline),
+        ("Image artifacts", test_image_artifact),
+        ("Image previews", test_image_preview),
+    ]
+    results = [(name, run_test(test)) for name, test in tests]
+    test_capacity()  # Informational: reports capacity, has no pass condition
     
     # Summary
     print("\n" + "=" * 50)
     print("TEST SUMMARY:")
-    print(f"Basic embedding/extraction: {'✓ PASS' if basic_success else '✗ FAIL'}")
-    print(f"Compression resistance: {'✓ PASS' if compression_success else '✗ FAIL'}")
+    for name, passed in results:
+        print(f"{name}: {'✓ PASS' if passed else '✗ FAIL'}")
     
-    if basic_success and compression_success:
-        print("\n🎉 All critical tests passed! Robust DWT watermarking is working correctly.")
+    all_passed = all(passed for _, passed in results)
+    if all_passed:
+        print("\n🎉 All tests passed! Robust DWT watermarking is working correctly.")
     else:
         print("\n⚠️  Some tests failed. Please check the implementation.")
+    return all_passed
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    sys.exit(0 if main() else 1)
@@ -13,16 +13,21 @@ if not PINATA_API_KEY or not PINATA_SECRET_API_KEY:
     logger.error("Pinata API keys are not set in environment.")
     raise EnvironmentError("Pinata API keys are not set in environment.")
 
-def upload_to_pinata(file_path):
+def upload_to_pinata(file_path, data=None):
+    """Pin a file to IPFS; with data (the encoded bytes already in memory) the file is not re-read"""
     logger.info(f"Uploading {file_path} to Pinata Cloud...")
     url = "https://api.pinata.cloud/pinning/pinFileToIPFS"
     headers = {
         "pinata_api_key": PINATA_API_KEY,
         "pinata_secret_api_key": PINATA_SECRET_API_KEY,
     }
-    with open(file_path, "rb") as file:
-        files = {"file": (os.path.basename(file_path), file)}
+    if data is not None:
+        files = {"file": (os.path.basename(file_path), data)}
         response = requests.post(url, files=files, headers=headers)
+    else:
+        with open(file_path, "rb") as file:
+            files = {"file": (os.path.basename(file_path), file)}
+            response = requests.post(url, files=files, headers=headers)
     if response.status_code == 200:
         cid = response.json()["IpfsHash"]
         logger.info(f"File uploaded successfully to Pinata. CID: {cid}")
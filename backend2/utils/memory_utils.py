@@ -0,0 +1,75 @@
+import functools
+import threading
+import tracemalloc
+import numpy as np
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+TRANSFORM_DTYPES = ('float64', 'float32')
+
+def resolve_dtype(dtype):
+    """Validate a transform dtype option and return it as an np.dtype"""
+    dtype = np.dtype(dtype)
+    if dtype.name not in TRANSFORM_DTYPES:
+        raise ValueError(f"Unsupported transform dtype '{dtype.name}', expected one of {TRANSFORM_DTYPES}")
+    return dtype
+
+# Open PeakMemory blocks across threads, and whether they started tracemalloc
+# (rather than finding it already running); tracing stops when the last one exits
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_tracing_started = False
+
+class PeakMemory:
+    """
+    Context manager measuring the peak bytes allocated inside the block
+    - Uses tracemalloc, which also sees numpy array buffers
+    - Tracing is reference-counted: the first block starts it if nothing
+      else is tracing, and the last one to exit stops it
+    - Peaks are process-wide and each block resets the peak on entry, so
+      measurements that overlap in time (other threads, nested blocks) are
+      not meaningful; only a block running alone gives a usable figure
+    """
+
+    def __init__(self):
+        self.peak_bytes = None
+        self._baseline = 0
+
+    def __enter__(self):
+        global _tracing_users, _tracing_started
+        with _tracing_lock:
+            if _tracing_users == 0:
+                _tracing_started = not tracemalloc.is_tracing()
+                if _tracing_started:
+                    tracemalloc.start()
+            _tracing_users += 1
+            self._baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        global _tracing_users
+        with _tracing_lock:
+            _, peak = tracemalloc.get_traced_memory()
+            self.peak_bytes = max(peak - self._baseline, 0)
+            _tracing_users -= 1
+            if _tracing_users == 0 and _tracing_started:
+                tracemalloc.stop()
+        return False
+
+def reports_peak_memory(method):
+    """
+    Decorate an engine method so that, when the engine has track_memory set,
+    the peak bytes allocated by the call are stored in engine.last_peak_bytes
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.track_memory:
+            return method(self, *args, **kwargs)
+        with PeakMemory() as peak:
+            result = method(self, *args, **kwargs)
+        self.last_peak_bytes = peak.peak_bytes
+        logger.debug(f"{method.__name__}: peak {peak.peak_bytes / 2**20:.1f} MiB allocated")
+        return result
+    return wrapper
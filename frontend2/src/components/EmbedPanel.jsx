@@ -29,11 +29,15 @@ function EmbedPanel() {
     const formData = new FormData();
     formData.append('image', image);
     formData.append('message', message);
+    formData.append('format', 'preview');
 
     setLoading(true);
     try {
       const res = await axios.post('http://localhost:5000/watermark', formData);
-      setWatermarked(`data:image/png;base64,${res.data.image}`);
+      setWatermarked({
+        preview: `data:${res.data.preview_type};base64,${res.data.preview}`,
+        url: `http://localhost:5000${res.data.image_url}?download=1`,
+      });
       setEmbedResult(res.data);
     } catch (err) {
       let msg = "Failed to embed watermark.";
@@ -69,7 +73,8 @@ function EmbedPanel() {
       {watermarked && (
         <>
           <h4>Watermarked Image:</h4>
-          <img src={watermarked} alt="Watermarked" />
+          <img src={watermarked.preview} alt="Watermarked" />
+          <p><a href={watermarked.url}>Download full-resolution image</a></p>
         </>
       )}
 
@@ -108,7 +113,7 @@ function EmbedPanel() {
           <div className="result-section">
             <h5>Next Steps:</h5>
             <ul style={{ textAlign: 'left', paddingLeft: '20px' }}>
-              <li>Download the watermarked image above</li>
+              <li>Download the full-resolution watermarked image above (the preview does not keep the watermark)</li>
               <li>Use the "Extract Watermark" panel to verify the embedding</li>
               <li>The robust DWT algorithm provides better resistance to compression and noise</li>
             </ul>